@@ -1,29 +1,139 @@
-import asyncpg
-import httpx
 import logging
 import json
 
-from time import time
+from time import time, perf_counter
+from typing import Optional
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.responses import JSONResponse, HTMLResponse, PlainTextResponse
 
 from config import *
 from db import *
-from bot import bot, process_comment_event, process_task_event, process_deal_event
+from bot import bot, dp, notify_event, refresh_mirror
+from delivery import TelegramDelivery, PRIORITY_HIGH
 from utils import *
+from workers import EventQueue
+from coalesce import EventCoalescer
+from dedupe import WebhookDedupe, event_fingerprint
+from events import BitrixEvent
+from tokens import TokenManager
+from mirror import EntityMirror, task_mirror, deal_mirror, sync_portal
+from catchup import CatchUpSync
+from telegram_webhook import TelegramWebhook
+from metrics import *
+from tracing import span, set_attributes, current_traceparent, SpanExporter, KIND_SERVER
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Жизненный цикл процесса API: пулы соединений и обработчики очереди событий"""
+    await Database.get_pool()
+    await Database.init_schema()
+    await MemberCache.subscribe()
+    await RecipientCache.subscribe()
+    await EntityMirror.subscribe()
+    TelegramDelivery.start(bot)
+    await EventQueue.start(process_webhook_event)
+    CatchUpSync.start(EventQueue.put)
+    TokenManager.start()
+    SpanExporter.start()
+    if TELEGRAM_MODE == "webhook":
+        await TelegramWebhook.start(bot, dp)
+    try:
+        yield
+    finally:
+        await TelegramWebhook.stop()
+        await CatchUpSync.stop()
+        await TokenManager.stop()
+        # Сначала дообрабатываем принятые события и отправляем уведомления,
+        # затем закрываем общие пулы соединений
+        await EventQueue.stop()
+        await update_coalescer.flush()
+        await TelegramDelivery.stop()
+        await BitrixClient.close()
+        await PgListener.close()
+        await Database.close()
+        await SpanExporter.stop()
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 
 # --- API ---
+@app.get("/stats")
+async def stats_handler():
+    """Метрики загруженности пула соединений с БД"""
+    return JSONResponse({
+        "db_pool": Database.stats(),
+        "webhook_queue": EventQueue.depth(),
+        "telegram_queue": TelegramDelivery.depth(),
+        "telegram_updates": TelegramWebhook.depth(),
+        "coalescing": len(update_coalescer)
+    })
+
+
+@app.get("/metrics")
+async def metrics_handler():
+    """Метрики в текстовом формате Prometheus"""
+    collect_runtime_metrics()
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+def collect_runtime_metrics():
+    """Снимает текущие значения пула, очередей и кэшей перед выдачей /metrics"""
+    pool = Database.stats()
+    DB_POOL.set(pool["size"], state="size")
+    DB_POOL.set(pool["idle"], state="idle")
+    DB_POOL.set(pool["in_use"], state="in_use")
+    DB_POOL.set(pool["waiting"], state="waiting")
+    DB_POOL.set(pool["max_size"], state="max_size")
+    DB_POOL_WAIT_SECONDS.inc_to(pool["wait_time_total"])
+
+    QUEUE_DEPTH.set(EventQueue.depth(), queue="webhook")
+    QUEUE_DEPTH.set(TelegramDelivery.depth(), queue="telegram")
+    QUEUE_DEPTH.set(len(update_coalescer), queue="coalescing")
+    QUEUE_DEPTH.set(TelegramWebhook.depth(), queue="telegram_updates")
+
+    for name, cache in (
+        ("member", MemberCache),
+        ("recipient", RecipientCache),
+        ("user_name", user_name_cache),
+        ("deal_stage", deal_stage_cache),
+        ("task_mirror", task_mirror.hot),
+        ("deal_mirror", deal_mirror.hot),
+    ):
+        CACHE_REQUESTS.inc_to(cache.hits, cache=name, result="hit")
+        CACHE_REQUESTS.inc_to(cache.misses, cache=name, result="miss")
+        total = cache.hits + cache.misses
+        CACHE_HIT_RATIO.set(round(cache.hits / total, 4) if total else 0.0, cache=name)
+
+
 @app.api_route("/callback", methods=["GET", "POST", "HEAD"])
 async def unified_handler(request: Request):
     """Обработка запросов Битрикс"""
-    if request.method == "GET":  # регистрация
-        return await handle_oauth_callback(request)
-    elif request.method == "POST":  # обработка событий
-        return await handle_webhook_event(request)
-    return JSONResponse({"status": "ok"})
+    with span(f"{request.method} /callback", kind=KIND_SERVER, **{"http.method": request.method}):
+        if request.method == "GET":  # регистрация
+            return await handle_oauth_callback(request)
+        elif request.method == "POST":  # обработка событий
+            return await handle_webhook_event(request)
+        return JSONResponse({"status": "ok"})
+
+
+@app.post(TELEGRAM_WEBHOOK_PATH)
+async def telegram_webhook_handler(request: Request):
+    """Обновления Telegram в режиме TELEGRAM_MODE=webhook"""
+    if TELEGRAM_MODE != "webhook":
+        raise HTTPException(status_code=404)
+    if not TelegramWebhook.check_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token")):
+        TELEGRAM_UPDATES.inc(outcome="rejected")
+        raise HTTPException(status_code=401)
+
+    try:
+        await TelegramWebhook.feed(json.loads(await request.body()))
+    except ValueError:  # не JSON или не похоже на Update
+        TELEGRAM_UPDATES.inc(outcome="invalid")
+        raise HTTPException(status_code=400)
+    return JSONResponse({"ok": True})
 
 
 async def handle_oauth_callback(request: Request):
@@ -32,8 +142,6 @@ async def handle_oauth_callback(request: Request):
     #logging.info(f"OAuth callback params: {params}")  # Логи
     domain = params['domain']
 
-    global is_registered_events
-
     try:
         required = ["code", "state", "domain"]
         if missing := [key for key in required if key not in params]:
@@ -41,72 +149,50 @@ async def handle_oauth_callback(request: Request):
 
         chat_id = int(params["state"])
 
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(
-                f"https://{params['domain']}/oauth/token/",
-                data={
-                    "grant_type": "authorization_code",
-                    "code": params["code"],
-                    "client_id": BITRIX_CLIENT_ID,
-                    "client_secret": BITRIX_CLIENT_SECRET,
-                    "redirect_uri": REDIRECT_URI
-                }
-            )
-            token_data = resp.json()
-
-        if not is_registered_events.get(domain, False):
+        resp = await BitrixClient.post(
+            f"https://{params['domain']}/oauth/token/",
+            data={
+                "grant_type": "authorization_code",
+                "code": params["code"],
+                "client_id": BITRIX_CLIENT_ID,
+                "client_secret": BITRIX_CLIENT_SECRET,
+                "redirect_uri": REDIRECT_URI
+            }
+        )
+        token_data = resp.json()
+
+        if not await is_events_registered(domain):
             try:
                 await register_webhooks(domain=domain, access_token=token_data['access_token'])
-                is_registered_events[domain] = True
+                await mark_events_registered(domain)
             except Exception as e:
                 logging.error(f"Webhook registration failed for {domain}: {e}")
 
-        member_id = params.get("member_id")
-        if member_id:
-            member_map[member_id].add(chat_id)
-
         user_info = await get_user_info(params['domain'], token_data['access_token'])
 
-        # Сохранение в PostgreSQL
-        conn = await asyncpg.connect(DATABASE_URL)
-        try:
-            # Сохраняем пользователя
-            await conn.execute("""
-                INSERT INTO users (
-                    chat_id, access_token, refresh_token, expires,
-                    domain, member_id, user_id, user_name, is_admin
-                ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
-                ON CONFLICT (chat_id) DO UPDATE SET
-                    access_token = EXCLUDED.access_token,
-                    refresh_token = EXCLUDED.refresh_token,
-                    expires = EXCLUDED.expires,
-                    domain = EXCLUDED.domain,
-                    member_id = EXCLUDED.member_id,
-                    user_id = EXCLUDED.user_id,
-                    user_name = EXCLUDED.user_name,
-                    is_admin = EXCLUDED.is_admin
-            """,
-                               chat_id,
-                               token_data["access_token"],
-                               token_data["refresh_token"],
-                               int(time()) + int(token_data["expires_in"]),
-                               params["domain"],
-                               params.get("member_id", ""),
-                               int(user_info["id"]),
-                               user_info["name"],
-                               user_info["is_admin"]
-                               )
-
-            # Создаем настройки по умолчанию
-            await conn.execute("""
-                INSERT INTO notification_settings (chat_id)
-                VALUES ($1)
-                ON CONFLICT (chat_id) DO NOTHING
-            """, chat_id)
-        finally:
-            await conn.close()
-
-        await bot.send_message(chat_id, "✅ Авторизация успешна!")
+        # Сохранение в PostgreSQL через общий пул соединений
+        await save_user({
+            "chat_id": chat_id,
+            "access_token": token_data["access_token"],
+            "refresh_token": token_data["refresh_token"],
+            "expires": int(time()) + int(token_data["expires_in"]),
+            "domain": params["domain"],
+            "member_id": params.get("member_id", ""),
+            "user_id": int(user_info["id"]),
+            "user_name": user_info["name"],
+            "is_admin": user_info["is_admin"]
+        })
+
+        # Создаем настройки по умолчанию
+        await create_notification_settings(chat_id)
+
+        if USER_NAME_WARMUP:
+            run_in_background(warm_user_names(domain, token_data["access_token"]))
+        if user_info["is_admin"]:
+            # Токен администратора видит все задачи и сделки — выгружаем портал в локальную копию
+            sync_portal(domain)
+
+        await TelegramDelivery.send(chat_id, "✅ Авторизация успешна!", priority=PRIORITY_HIGH)
         return HTMLResponse("""
             <html><head><meta charset='utf-8'><title>Авторизация</title>
             <style>
@@ -126,86 +212,155 @@ async def handle_oauth_callback(request: Request):
 
 
 async def handle_webhook_event(request: Request):
-    """Обработка событий"""
+    """Приём событий: разбор, проверка и постановка в очередь без ожидания обработки"""
     try:
-        form_data = await request.form()
-        parsed_data = parse_form_data(dict(form_data))
+        body = await request.body()
+        with WEBHOOK_PHASE_SECONDS.time(phase="parse"):
+            event = BitrixEvent.from_body(body)
+        label = event_label(event.name)
+        set_attributes(**{
+            "bitrix.event": event.name,
+            "bitrix.member_id": event.member_id,
+            "bitrix.domain": event.domain
+        })
 
-        #logging.info(f"Parsed webhook data: {json.dumps(parsed_data, indent=2)}")  # Логи
+        #logging.info(f"Parsed webhook data: {json.dumps(event.data, indent=2)}")  # Логи
 
-        auth_data = parsed_data.get('auth', {})
-        event = parsed_data.get('event', '').lower()
-        member_id = auth_data.get('member_id')
+        member_id = event.member_id
 
         if not member_id:
+            WEBHOOK_EVENTS.inc(event=label, outcome="invalid")
             return JSONResponse({"status": "invalid_member_id"}, status_code=400)
 
-        chat_ids = member_map.get(member_id, set())
+        if not event.name:
+            WEBHOOK_EVENTS.inc(event=label, outcome="invalid")
+            return JSONResponse({"status": "invalid_event"}, status_code=400)
+
+        with WEBHOOK_PHASE_SECONDS.time(phase="db"):
+            chat_ids = await get_member_chat_ids(member_id)
         if not chat_ids:
+            WEBHOOK_EVENTS.inc(event=label, outcome="unknown_member")
             logging.error(f"Member ID {member_id} not mapped to any chat")
             return JSONResponse({"status": "member_not_found"}, status_code=404)
 
-        conn = await asyncpg.connect(DATABASE_URL)
-        try:
-            for chat_id in chat_ids:
-                # Получаем данные пользователя из БД
-                user_data = await conn.fetchrow(
-                    "SELECT * FROM users WHERE chat_id = $1",
-                    int(chat_id)
-                )
-
-                if not user_data:
-                    logging.error(f"User data not found for chat {chat_id}")
-                    continue
-
-                user_data = dict(user_data)
-                logging.info(f"Sending to chat {chat_id} with token expires at {user_data['expires']}")
-
-                # Проверяем срок действия токена
-                if time() > user_data["expires"]:
-                    if not await refresh_token(chat_id):
-                        logging.error(f"Token refresh failed for chat {chat_id}")
-                        continue
-
-                # Получаем настройки уведомлений
-                settings = await conn.fetchrow(
-                    "SELECT * FROM notification_settings WHERE chat_id = $1",
-                    int(chat_id)
-                )
-                settings = dict(settings) if settings else {
-                    'new_deals': True,
-                    'deal_updates': True,
-                    'task_creations': True,
-                    'task_updates': True,
-                    'comments': True
-                }
-
-                # Проверяем настройки уведомлений
-                event_handlers = {
-                    "oncrmdealadd": settings['new_deals'],
-                    "oncrmdealupdate": settings['deal_updates'],
-                    "ontaskadd": settings['task_creations'],
-                    "ontaskupdate": settings['task_updates'],
-                    "ontaskcommentadd": settings['comments']
-                }
-
-                event_type = event.split('_')[0]  # Для обработки составных событий
-                if not event_handlers.get(event_type, True):
-                    continue
-
-                # Обработка событий
-                if event.startswith("ontaskcomment"):
-                    await process_comment_event(event, parsed_data, user_data, chat_id)
-                elif event.startswith("ontask"):
-                    await process_task_event(event, parsed_data, user_data, chat_id)
-                elif event.startswith("oncrmdeal"):
-                    await process_deal_event(event, parsed_data, user_data, chat_id)
-
-        finally:
-            await conn.close()
+        # Повторная доставка того же события — подтверждаем без обработки
+        fingerprint = event_fingerprint(event)
+        if not await WebhookDedupe.claim(fingerprint):
+            WEBHOOK_EVENTS.inc(event=label, outcome="duplicate")
+            return JSONResponse({"status": "duplicate"})
+
+        # Трассировка продолжается в обработчике очереди
+        if traceparent := current_traceparent():
+            event.data['_trace'] = traceparent
+
+        if not await EventQueue.put(event.data, key=coalesce_key(event)):
+            # Очередь переполнена — просим Битрикс повторить позже
+            await WebhookDedupe.release(fingerprint)
+            WEBHOOK_EVENTS.inc(event=label, outcome="rejected")
+            logging.warning(f"Webhook queue is full, rejecting event for {member_id}")
+            return JSONResponse({"status": "busy"}, status_code=503, headers={"Retry-After": "5"})
 
+        WEBHOOK_EVENTS.inc(event=label, outcome="accepted")
         return JSONResponse({"status": "ok"})
 
     except Exception as e:
+        WEBHOOK_EVENTS.inc(event="other", outcome="error")
         logging.error(f"Webhook handler error: {e}")
         return JSONResponse({"status": "error", "message": str(e)}, status_code=500)
+
+
+def coalesce_key(event: BitrixEvent) -> Optional[str]:
+    """Ключ склейки для событий изменения задачи или сделки, иначе None"""
+    if COALESCE_WINDOW <= 0 or event.name not in ("ontaskupdate", "oncrmdealupdate") or not event.entity_id:
+        return None
+    return f"{event.member_id}:{event.name}:{event.entity_id}"
+
+
+async def process_webhook_event(parsed_data: dict):
+    """Обработка события из очереди. Серии изменений одной сущности склеиваются —
+    в общей очереди при постановке, в очереди процесса здесь"""
+    key = None if EventQueue.coalesces else coalesce_key(BitrixEvent.from_dict(parsed_data))
+    if key is None:
+        await dispatch_webhook_event(parsed_data)
+    else:
+        update_coalescer.submit(key, parsed_data)
+
+
+async def dispatch_webhook_event(parsed_data: dict):
+    """Рассылка события по всем чатам портала"""
+    auth_data = parsed_data.get('auth', {})
+    with span("dispatch " + parsed_data.get('event', '').lower(), parent=parsed_data.get('_trace'), **{
+        "bitrix.event": parsed_data.get('event', '').lower(),
+        "bitrix.member_id": auth_data.get('member_id'),
+        "bitrix.domain": auth_data.get('domain')
+    }):
+        await _dispatch_webhook_event(parsed_data)
+
+
+async def _dispatch_webhook_event(parsed_data: dict):
+    auth_data = parsed_data.get('auth', {})
+    event = parsed_data.get('event', '').lower()
+    member_id = auth_data.get('member_id')
+
+    started = perf_counter()
+    with WEBHOOK_PHASE_SECONDS.time(phase="db"):
+        chat_ids = await get_member_chat_ids(member_id)
+        # Пользователи и их настройки — одним запросом (или из кэша) для всех чатов портала
+        users = await get_recipients(chat_ids)
+    event_type = event.split('_')[0]  # Для обработки составных событий
+
+    recipients = []
+    for chat_id in chat_ids:
+        if chat_id not in users:
+            logging.error(f"User data not found for chat {chat_id}")
+            continue
+        user_data, settings = users[chat_id]
+
+        # Проверяем настройки уведомлений
+        event_handlers = {
+            "oncrmdealadd": settings['new_deals'],
+            "oncrmdealupdate": settings['deal_updates'],
+            "ontaskadd": settings['task_creations'],
+            "ontaskupdate": settings['task_updates'],
+            "ontaskcommentadd": settings['comments']
+        }
+
+        if not event_handlers.get(event_type, True):
+            continue
+
+        recipients.append(user_data)
+
+    if not recipients:
+        WEBHOOK_EVENTS.inc(event=event_label(event), outcome="no_recipients")
+        # Уведомлять некого, но локальная копия задач и сделок должна узнать об изменении
+        await refresh_mirror(event, parsed_data, iter_token_users([user for user, _ in users.values()]))
+        return
+
+    await notify_event(event, parsed_data, recipients, iter_token_users(recipients))
+    WEBHOOK_PROCESSING_SECONDS.observe(perf_counter() - started, event=event_label(event))
+
+
+async def dispatch_coalesced_event(parsed_data: dict):
+    """Обработка склеенного события; если портал перегружен — событие возвращается в очередь"""
+    try:
+        await dispatch_webhook_event(parsed_data)
+    except BitrixRetryLater as e:
+        EventQueue.retry_later(parsed_data, e.delay)
+
+
+update_coalescer = EventCoalescer(dispatch_coalesced_event, concurrency=WEBHOOK_WORKERS)
+
+
+async def iter_token_users(recipients: list[dict]):
+    """Пользователи с действующим токеном для загрузки сущности.
+
+    Токен администратора видит все задачи и сделки, поэтому они идут первыми.
+    Обычно токены уже обновлены планировщиком TokenManager; если нет — токен
+    обновляется только когда до пользователя дошла очередь.
+    """
+    for user_data in sorted(recipients, key=lambda u: not u.get('is_admin')):
+        with WEBHOOK_PHASE_SECONDS.time(phase="token"):
+            user_data = await TokenManager.get_valid_user(user_data["chat_id"], user_data)
+        if not user_data:
+            continue
+        yield user_data
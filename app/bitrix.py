@@ -0,0 +1,327 @@
+import re
+import httpx
+import asyncio
+import logging
+
+from time import time, monotonic, perf_counter
+
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit, urlunsplit, urlencode, quote
+
+from config import *
+from metrics import BITRIX_REQUEST_SECONDS, BITRIX_REQUESTS, BITRIX_THROTTLED, BITRIX_WAIT_SECONDS
+from tracing import span, KIND_CLIENT
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+BATCH_LIMIT = 50  # максимум команд в одном вызове batch
+LIST_LIMIT = 50  # записей на странице списочных методов (*.list, user.get)
+
+# За сколько секунд без отказов скорость после снижения возвращается к BITRIX_RATE
+_RECOVERY_TIME = 60
+# Окно, за которое портал считает время работы метода (operating)
+_OPERATING_WINDOW = 600
+
+# Блок time в конце ответа: {"start": ..., "operating_reset_at": 1700000600, "operating": 12.5}
+_OPERATING = re.compile(rb'"operating":([0-9.]+)')
+_OPERATING_RESET_AT = re.compile(rb'"operating_reset_at":([0-9]+)')
+
+
+class BitrixError(Exception):
+    """Ошибка, которую вернул REST Битрикс24"""
+
+    def __init__(self, error: str, description: str = ""):
+        super().__init__(f"{error}: {description}" if description else error)
+        self.error = error
+        self.description = description
+
+
+class BitrixRetryLater(Exception):
+    """Портал сейчас не примет запрос: ждать дольше BITRIX_MAX_WAIT.
+
+    Обработчик очереди возвращает событие в очередь через delay секунд,
+    а не держит обработчика в ожидании.
+    """
+
+    def __init__(self, domain: str, delay: float):
+        super().__init__(f"Bitrix portal {domain} is rate limited, retry in {delay:.0f}s")
+        self.domain = domain
+        self.delay = delay
+
+
+def flatten_params(params: Dict[str, Any], prefix: str = "") -> List[Tuple[str, Any]]:
+    """Раскладывает вложенные параметры в нотацию Битрикса: filter[ID][0]=1"""
+    items = []
+    for key, value in params.items():
+        name = f"{prefix}[{key}]" if prefix else str(key)
+        if isinstance(value, dict):
+            items.extend(flatten_params(value, name))
+        elif isinstance(value, (list, tuple)):
+            items.extend(flatten_params(dict(enumerate(value)), name))
+        elif value is not None:
+            items.append((name, value))
+    return items
+
+
+def batch_command(method: str, params: Dict[str, Any]) -> str:
+    """Строка команды для batch. Ссылки вида $result[deal][ID] не экранируются"""
+    return f"{method}?{urlencode(flatten_params(params), safe='$[]', quote_via=quote)}"
+
+
+class PortalLimiter:
+    """Очередь запросов к одному порталу по модели leaky bucket Битрикс24.
+
+    Каждый запрос добавляет в ведро единицу, ведро вытекает со скоростью
+    rate в секунду; запрос, для которого нет места, ждёт своей очереди
+    вместо QUERY_LIMIT_EXCEEDED. После отказа портала скорость снижается
+    вдвое и затем, пока отказов нет, линейно возвращается к BITRIX_RATE.
+    Метод, почти исчерпавший время работы (time.operating) за 10 минут,
+    ждёт operating_reset_at, чтобы портал его не заблокировал.
+    """
+
+    def __init__(self, rate: float = BITRIX_RATE, capacity: float = BITRIX_BURST):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.level = 0.0
+        self.updated = monotonic()
+        self.adjusted = self.updated  # время последнего изменения скорости
+        self.throttled_at = float("-inf")
+        self.blocked_until: Dict[str, float] = {}  # метод → время сброса operating (unix)
+
+    def _drain(self):
+        now = monotonic()
+        self.level = max(0.0, self.level - (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, method: str) -> float:
+        """Занимает место в ведре. Возвращает, сколько секунд ждать перед запросом"""
+        self._drain()
+        wait = max(0.0, (self.level + 1 - self.capacity) / self.rate)
+        self.level += 1
+        blocked = self.blocked_until.get(method)
+        if blocked is not None:
+            if blocked <= time():
+                del self.blocked_until[method]
+            else:
+                wait = max(wait, blocked - time())
+        return wait
+
+    def cancel(self):
+        """Освобождает место, занятое reserve, если запрос так и не был отправлен"""
+        self.level = max(0.0, self.level - 1)
+
+    def throttled(self):
+        """Портал ответил QUERY_LIMIT_EXCEEDED: его ведро полно, снижаем скорость"""
+        self._drain()
+        self.level = max(self.level, self.capacity)
+        # Отказы на запросы, отправленные до прошлого снижения, скорость больше не снижают
+        if self.updated - self.throttled_at >= 1:
+            self.rate = max(self.max_rate / 10, self.rate / 2)
+            self.adjusted = self.throttled_at = self.updated
+
+    def succeeded(self, method: str, body: bytes):
+        if self.rate < self.max_rate:
+            now = monotonic()
+            self.rate = min(self.max_rate, self.rate + self.max_rate * (now - self.adjusted) / _RECOVERY_TIME)
+            self.adjusted = now
+
+        tail = body[-512:]
+        operating = _OPERATING.findall(tail)
+        if operating and float(operating[-1]) >= BITRIX_OPERATING_LIMIT * 0.9:
+            reset_at = _OPERATING_RESET_AT.findall(tail)
+            self.block(method, float(reset_at[-1]) if reset_at else None)
+
+    def block(self, method: str, until: Optional[float] = None):
+        """Откладывает вызовы метода до сброса operating-времени"""
+        self.blocked_until[method] = until or time() + _OPERATING_WINDOW
+
+
+def method_label(path: str) -> str:
+    """Имя метода для метрик: /rest/user.get.json → user.get, /oauth/token/ → oauth.token"""
+    path = path.strip("/")
+    if path.startswith("rest/"):
+        path = path[5:]
+    elif path.startswith("oauth/"):
+        return path.replace("/", ".")
+    return path[:-5] if path.endswith(".json") else path
+
+
+class BitrixClient:
+    """Общий HTTP-клиент для запросов к Битрикс24.
+
+    На каждый домен держится свой httpx.AsyncClient с keep-alive пулом,
+    поэтому повторные запросы к порталу не платят за TCP+TLS рукопожатие.
+    """
+    _clients: Dict[str, httpx.AsyncClient] = {}
+    _limiters: Dict[str, PortalLimiter] = {}
+
+    @classmethod
+    def get_client(cls, host: str) -> httpx.AsyncClient:
+        client = cls._clients.get(host)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                http2=BITRIX_HTTP2 and HTTP2_AVAILABLE,
+                limits=httpx.Limits(
+                    max_connections=BITRIX_HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=BITRIX_HTTP_MAX_KEEPALIVE,
+                    keepalive_expiry=BITRIX_HTTP_KEEPALIVE_EXPIRY
+                ),
+                timeout=httpx.Timeout(BITRIX_HTTP_TIMEOUT, connect=BITRIX_HTTP_CONNECT_TIMEOUT)
+            )
+            cls._clients[host] = client
+        return client
+
+    @classmethod
+    def get_limiter(cls, domain: str) -> PortalLimiter:
+        limiter = cls._limiters.get(domain)
+        if limiter is None:
+            limiter = cls._limiters[domain] = PortalLimiter()
+        return limiter
+
+    @classmethod
+    async def request(cls, method: str, url: str, **kwargs) -> httpx.Response:
+        """Выполняет запрос через пул соединений домена из url.
+
+        Запросы к порталу проходят через его PortalLimiter; при
+        QUERY_LIMIT_EXCEEDED и OPERATION_TIME_LIMIT запрос повторяется после
+        паузы (до BITRIX_RETRY_ATTEMPTS раз), а не возвращает ошибку сразу.
+        Если ждать очереди дольше BITRIX_MAX_WAIT или повторы исчерпаны —
+        BitrixRetryLater: запрос не отправляется в обход лимита.
+        """
+        parts = urlsplit(url)
+        if BITRIX_API_OVERRIDE:
+            url = urlunsplit(urlsplit(BITRIX_API_OVERRIDE)[:2] + parts[2:])
+        host = urlsplit(url).netloc
+
+        labels = {"method": method_label(parts.path), "domain": parts.netloc}
+        # OAuth-сервер не ограничивается лимитами портала
+        if parts.path.startswith("/oauth/"):
+            return await cls._send(method, url, host, labels, **kwargs)
+
+        limiter = cls.get_limiter(parts.netloc)
+        for attempt in range(BITRIX_RETRY_ATTEMPTS + 1):
+            wait = limiter.reserve(labels["method"])
+            if wait > BITRIX_MAX_WAIT:
+                limiter.cancel()
+                BITRIX_THROTTLED.inc(domain=labels["domain"], reason="deferred")
+                raise BitrixRetryLater(labels["domain"], wait)
+            if wait > 0:
+                BITRIX_WAIT_SECONDS.observe(wait, domain=labels["domain"])
+                await asyncio.sleep(wait)
+
+            resp = await cls._send(method, url, host, labels, **kwargs)
+            if resp.status_code != 503:
+                break
+            if b"QUERY_LIMIT_EXCEEDED" in resp.content:
+                BITRIX_THROTTLED.inc(domain=labels["domain"], reason="query_limit")
+                limiter.throttled()
+            elif b"OPERATION_TIME_LIMIT" in resp.content:
+                BITRIX_THROTTLED.inc(domain=labels["domain"], reason="operating_time")
+                limiter.block(labels["method"], limiter.blocked_until.get(labels["method"]))
+            else:
+                break
+            logging.warning(f"Bitrix throttled {labels['method']} on {labels['domain']}, retry {attempt + 1}")
+        else:
+            BITRIX_THROTTLED.inc(domain=labels["domain"], reason="deferred")
+            raise BitrixRetryLater(labels["domain"], BITRIX_MAX_WAIT)
+
+        if resp.status_code < 400:
+            limiter.succeeded(labels["method"], resp.content)
+        return resp
+
+    @classmethod
+    async def _send(cls, method: str, url: str, host: str, labels: Dict[str, str], **kwargs) -> httpx.Response:
+        status = "error"
+        started = perf_counter()
+        try:
+            with span(f"bitrix {labels['method']}", kind=KIND_CLIENT,
+                      **{"bitrix.method": labels["method"], "bitrix.domain": labels["domain"]}) as s:
+                resp = await cls.get_client(host).request(method, url, **kwargs)
+                status = str(resp.status_code)
+                if s is not None:
+                    s.set(**{"http.status_code": resp.status_code})
+            return resp
+        finally:
+            BITRIX_REQUEST_SECONDS.observe(perf_counter() - started, **labels)
+            BITRIX_REQUESTS.inc(status=status, **labels)
+
+    @classmethod
+    async def get(cls, url: str, **kwargs) -> httpx.Response:
+        return await cls.request("GET", url, **kwargs)
+
+    @classmethod
+    async def post(cls, url: str, **kwargs) -> httpx.Response:
+        return await cls.request("POST", url, **kwargs)
+
+    @classmethod
+    async def call(cls, domain: str, access_token: str, method: str, params: Dict[str, Any] = None) -> Any:
+        """Вызов REST-метода. Возвращает result или бросает BitrixError"""
+        resp = await cls.post(
+            f"https://{domain}/rest/{method}",
+            params={"auth": access_token},
+            json=params or {}
+        )
+        data = resp.json()
+        if 'error' in data:
+            raise BitrixError(data['error'], data.get('error_description', ''))
+        return data.get('result')
+
+    @classmethod
+    async def list_page(cls, domain: str, access_token: str, method: str,
+                        params: Dict[str, Any] = None, start: int = 0) -> Tuple[Any, Optional[int], Optional[int]]:
+        """Одна страница списочного метода: (result, next, total).
+
+        next — значение start для следующей страницы или None, если это последняя.
+        """
+        resp = await cls.post(
+            f"https://{domain}/rest/{method}",
+            params={"auth": access_token},
+            json={**(params or {}), "start": start}
+        )
+        data = resp.json()
+        if 'error' in data:
+            raise BitrixError(data['error'], data.get('error_description', ''))
+        return data.get('result'), data.get('next'), data.get('total')
+
+    @classmethod
+    async def batch(cls, domain: str, access_token: str,
+                    commands: Dict[str, Tuple[str, Dict[str, Any]]]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """Выполняет несколько методов через batch — по одному запросу на 50 команд.
+
+        commands: {ключ: (метод, параметры)}. В параметрах можно ссылаться на
+        результат предыдущей команды той же пачки: "$result[deal][ASSIGNED_BY_ID]".
+        Возвращает (результаты, ошибки) по ключам команд.
+        """
+        results, errors = {}, {}
+        keys = list(commands)
+        for i in range(0, len(keys), BATCH_LIMIT):
+            chunk = {key: batch_command(*commands[key]) for key in keys[i:i + BATCH_LIMIT]}
+            resp = await cls.post(
+                f"https://{domain}/rest/batch",
+                params={"auth": access_token},
+                json={"halt": 0, "cmd": chunk}
+            )
+            data = resp.json()
+            if 'error' in data:
+                raise BitrixError(data['error'], data.get('error_description', ''))
+
+            result = data.get('result', {})
+            # Пустые результаты Битрикс отдаёт списком, а не объектом
+            results.update(result.get('result') or {})
+            errors.update(result.get('result_error') or {})
+        return results, errors
+
+    @classmethod
+    async def close(cls):
+        clients, cls._clients = cls._clients, {}
+        for host, client in clients.items():
+            try:
+                await client.aclose()
+            except Exception as e:
+                logging.warning(f"Failed to close Bitrix client for {host}: {e}")
@@ -1,12 +1,14 @@
+import asyncio
 import logging
 import httpx
-import json
 import html
 
 from datetime import datetime
+from typing import AsyncIterator, Optional
 from aiogram import F
-from aiogram.fsm.state import State, StatesGroup
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
 from aiogram.types import Message
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
@@ -17,275 +19,403 @@ from aiogram.fsm.context import FSMContext
 from config import *
 from db import *
 from utils import *
+from delivery import *
+from fsm import create_fsm_storage
+from mirror import task_mirror, deal_mirror
+from metrics import WEBHOOK_PHASE_SECONDS, WEBHOOK_EVENTS, event_label
 
-bot = Bot(token=TELEGRAM_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=TELEGRAM_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+dp = Dispatcher(storage=create_fsm_storage())
 
 
 # --- Уведомления ---
-async def process_task_event(event: str, data: dict, user_data: dict, chat_id: str):
-    """Получение уведомлений о задачах из Битрикса"""
+async def fetch_task_event(event: str, data: dict, user_data: dict) -> Optional[dict]:
+    """Получение задачи из Битрикса — один запрос на событие для всех чатов портала"""
     try:
         task_id = None
+        task = {}
+        changed_by_name = None
         #logging.info(f"data: {data}")  # Логи
 
-        if event != "ontaskdelete":
+        if event == "ontaskdelete":
+            await task_mirror.delete(user_data['domain'], data.get('data', {}).get('FIELDS_BEFORE', {}).get('ID'))
+        else:
             task_id = data.get('data', {}).get('FIELDS_AFTER', {}).get('ID')
             if not task_id and event:
                 logging.error("No task ID in webhook data")
-                return
-
-            async with httpx.AsyncClient() as client:
-                resp = await client.get(
-                    f"https://{user_data['domain']}/rest/tasks.task.get",
-                    params={
-                        "taskId": task_id,
-                        "auth": user_data["access_token"]
-                    }
-                )
-                resp.raise_for_status()
-                task_data = resp.json()
-
-                if 'error' in task_data:
-                    logging.error(f"Bitrix API error: {task_data['error_description']}")
-                    return
-
-                task = task_data.get('result', {}).get('task', {})
-
-                #logging.info(f"Task data: {task}")  # Логи
-
-        message = ""
-        responsible_id = None
-
-        status_map = {
-            '2': "🆕 Ждет выполнения",
-            '3': "🔄 Выполняется",
-            '4': "⏳ Ожидает контроля",
-            '5': "✅ Завершена",
-            '6': "⏸ Отложена"
-        }
+                return None
 
-        priority_map = {
-            '0': "Низкий",
-            '1': "Средний",
-            '2': "Высокий"
-        }
+            # Задача и автор изменения — одним запросом batch. Имя автора не запрашиваем,
+            # если имена сотрудников портала уже в кэше
+            commands = {"task": ("tasks.task.get", {"taskId": task_id})}
+            if event == "ontaskupdate" and not names_warm(user_data['domain']):
+                commands["changed_by"] = ("user.get", {"ID": "$result[task][task][changedBy]"})
+            results, errors = await BitrixClient.batch(user_data['domain'], user_data["access_token"], commands)
 
-        title = task.get('title', 'Без названия')
-        description = task.get('description', 'Отсутствует')
-        priority_code = task.get('priority')
-        priority = priority_map.get(priority_code)
-        status_code = task.get('status')
-        status = status_map.get(status_code, f"Неизвестный статус ({status_code})")
-        responsible_id = task.get('responsibleId')
-        creator_name = task.get('creator').get('name')
-        responsible_name = task.get('responsible').get('name')
-        deadline = task.get('deadline')
-        user_id = user_data["user_id"]
-
-        deadline_str = deadline
-        if deadline:
-            try:
-                deadline_date = datetime.strptime(deadline, "%Y-%m-%dT%H:%M:%S%z")  # Добавляем обработку часового пояса
-                deadline_str = deadline_date.strftime("%Y-%m-%d %H:%M")  # Новый формат
-            except Exception as e:
-                logging.error(f"Ошибка обработки даты: {deadline}")
-
-        if event == "ontaskadd":
-            message = (
-                f"Задача <b><a href='https://{BITRIX_DOMAIN}/company/personal/user/{user_id}/tasks/task/view/{task_id}/'>№{task_id}</a></b> - 🆕Создана🆕\n"
-                f"📌Название: {title}\n"
-                f"📝Описание: {description}\n"
-                f"🚨Приоритет: {priority}\n"
-                f"📊Cтатус: {status}\n"
-                f"⏰Срок исполнения: {deadline_str}\n"
-                f"👤Постановщик: {creator_name}\n"
-                f"👤Исполнитель: {responsible_name}"
-            )
-        elif event == "ontaskupdate":
-            changed_by_id = task.get('changedBy')
+            if 'task' in errors:
+                logging.error(f"Bitrix API error: {errors['task'].get('error_description')}")
+                return None
 
+            task = (results.get('task') or {}).get('task', {})
+            cache_user_names(user_data['domain'], results.get('changed_by'))
+            await task_mirror.put(user_data['domain'], task)
+
+            #logging.info(f"Task data: {task}")  # Логи
+
+        if event == "ontaskupdate":
+            # Обычно имя уже в кэше, запрос в Битрикс — только при промахе
             changed_by_name = await get_user_name(
                 domain=user_data['domain'],
                 access_token=user_data["access_token"],
-                user_id=changed_by_id
+                user_id=task.get('changedBy')
             )
 
-            message = (
-                f"Задача <b><a href='https://{BITRIX_DOMAIN}/company/personal/user/{user_id}/tasks/task/view/{task_id}/'>№{task_id}</a></b> - 🔄Изменена🔄\n"
-                f"📌Название: {title}\n"
-                f"📝Описание: {description}\n"
-                f"🚨Приоритет: {priority}\n"
-                f"📊Cтатус: {status}\n"
-                f"⏰Срок исполнения: {deadline_str}\n"
-                f"👤Постановщик: {creator_name}\n"
-                f"👤Исполнитель: {responsible_name}\n"
-                f"👤Кто изменил: {changed_by_name}"
-            )
-        if responsible_id:
-            if not (str(user_data.get('user_id')) == str(responsible_id) or user_data.get('is_admin')):
-                return
-        await bot.send_message(chat_id, message)
+        return {"task_id": task_id, "task": task, "changed_by_name": changed_by_name}
+    except BitrixRetryLater:
+        raise  # событие вернётся в очередь
     except httpx.HTTPStatusError as e:
         logging.error(f"API request failed: {e.response.text}")
     except Exception as e:
         logging.error(f"Task processing error: {e}")
+    return None
+
+
+def render_task_event(event: str, entity: dict, user_data: dict) -> Optional[str]:
+    """Формирование уведомления о задаче для конкретного пользователя.
+    Возвращает None, если пользователю не положено видеть уведомление."""
+    task_id = entity["task_id"]
+    task = entity["task"]
+    message = ""
 
-async def process_deal_event(event: str, data: dict, user_data: dict, chat_id: str):
-    """Получение уведомлений о сделках из Битрикса"""
+    status_map = {
+        '2': "🆕 Ждет выполнения",
+        '3': "🔄 Выполняется",
+        '4': "⏳ Ожидает контроля",
+        '5': "✅ Завершена",
+        '6': "⏸ Отложена"
+    }
+
+    priority_map = {
+        '0': "Низкий",
+        '1': "Средний",
+        '2': "Высокий"
+    }
+
+    title = task.get('title', 'Без названия')
+    description = task.get('description', 'Отсутствует')
+    priority_code = task.get('priority')
+    priority = priority_map.get(priority_code)
+    status_code = task.get('status')
+    status = status_map.get(status_code, f"Неизвестный статус ({status_code})")
+    responsible_id = task.get('responsibleId')
+    creator_name = (task.get('creator') or {}).get('name')
+    responsible_name = (task.get('responsible') or {}).get('name')
+    deadline = task.get('deadline')
+    user_id = user_data["user_id"]
+
+    deadline_str = deadline
+    if deadline:
+        try:
+            deadline_date = datetime.strptime(deadline, "%Y-%m-%dT%H:%M:%S%z")  # Добавляем обработку часового пояса
+            deadline_str = deadline_date.strftime("%Y-%m-%d %H:%M")  # Новый формат
+        except Exception as e:
+            logging.error(f"Ошибка обработки даты: {deadline}")
+
+    if event == "ontaskadd":
+        message = (
+            f"Задача <b><a href='https://{BITRIX_DOMAIN}/company/personal/user/{user_id}/tasks/task/view/{task_id}/'>№{task_id}</a></b> - 🆕Создана🆕\n"
+            f"📌Название: {title}\n"
+            f"📝Описание: {description}\n"
+            f"🚨Приоритет: {priority}\n"
+            f"📊Cтатус: {status}\n"
+            f"⏰Срок исполнения: {deadline_str}\n"
+            f"👤Постановщик: {creator_name}\n"
+            f"👤Исполнитель: {responsible_name}"
+        )
+    elif event == "ontaskupdate":
+        message = (
+            f"Задача <b><a href='https://{BITRIX_DOMAIN}/company/personal/user/{user_id}/tasks/task/view/{task_id}/'>№{task_id}</a></b> - 🔄Изменена🔄\n"
+            f"📌Название: {title}\n"
+            f"📝Описание: {description}\n"
+            f"🚨Приоритет: {priority}\n"
+            f"📊Cтатус: {status}\n"
+            f"⏰Срок исполнения: {deadline_str}\n"
+            f"👤Постановщик: {creator_name}\n"
+            f"👤Исполнитель: {responsible_name}\n"
+            f"👤Кто изменил: {entity['changed_by_name']}"
+        )
+    if responsible_id:
+        if not (str(user_data.get('user_id')) == str(responsible_id) or user_data.get('is_admin')):
+            return None
+    return message or None
+
+
+async def fetch_deal_event(event: str, data: dict, user_data: dict) -> Optional[dict]:
+    """Получение сделки из Битрикса — один запрос на событие для всех чатов портала"""
     try:
-        responsible_id = None
-        message = ""
-        deal = {}
         domain = user_data['domain']
-        user_id = user_data["user_id"]
-
-        if event != "oncrmdealdelete":
-            deal_id = data.get('data', {}).get('FIELDS', {}).get('ID')
-            if not deal_id:
-                return
-
-            async with httpx.AsyncClient() as client:
-                resp = await client.get(
-                    f"https://{domain}/rest/crm.deal.get",
-                    params={
-                        "id": deal_id,
-                        "auth": user_data["access_token"]
-                    }
-                )
-                deal = resp.json().get("result", {})
-                responsible_id = deal.get('ASSIGNED_BY_ID')
-
-            # Получение имен
-            responsible_name = await get_user_name(
-                domain=domain,
-                access_token=user_data["access_token"],
-                user_id=responsible_id
-            ) if responsible_id else "Не указан"
 
-            changed_by_id = deal.get('MODIFY_BY_ID') or deal.get('MODIFIED_BY_ID')
-            changed_by_name = await get_user_name(
-                domain=domain,
-                access_token=user_data["access_token"],
-                user_id=changed_by_id
-            ) if changed_by_id else "Неизвестно"
-
-            stage_map = {}
-
-            async with httpx.AsyncClient() as client:
-                resp = await client.get(
-                    f"https://{user_data['domain']}/rest/crm.dealcategory.stage.list",
-                    params={"auth": user_data["access_token"]}
-                )
-                stages = resp.json().get('result', [])
-
-                for stage in stages:
-                    stage_map[stage['STATUS_ID']] = stage['NAME']
-
-            # Формирование сообщения
-            deal_url = f"https://{domain}/crm/deal/details/{deal_id}/"
-            title = deal.get('TITLE', 'Без названия')
-            address = deal.get('COMMENTS', 'Не указано')
-            stage = stage_map.get(deal.get('STAGE_ID'), deal.get('STAGE_ID'))
-
-            if event == "oncrmdealadd":
-                message = (
-                    f"Сделка <b><a href='{deal_url}'>№{deal_id}</a></b> - 🆕Создана🆕\n"
-                    f"🏢 Название: {title}\n"
-                    f"📍 Адрес: {address}\n"
-                    f"📈 Стадия: {stage}\n"
-                    f"👤 Ответственный: {responsible_name}"
-                )
-            elif event == "oncrmdealupdate":
-                message = (
-                    f"Сделка <b><a href='{deal_url}'>№{deal_id}</a></b> - 🔄Изменена🔄\n"
-                    f"🏢 Название: {title}\n"
-                    f"📍 Адрес: {address}\n"
-                    f"📈 Стадия: {stage}\n"
-                    f"👤 Ответственный: {responsible_name}\n"
-                    f"✍️ Изменено: {changed_by_name}"
-                )
-
-            # logging.info(f"Deal data: {deal}")  # Логи
-
-        if responsible_id:
-            if str(user_data.get('user_id')) == str(responsible_id) or user_data.get('is_admin'):
-                await bot.send_message(chat_id, message, parse_mode='HTML')
+        deal_id = data.get('data', {}).get('FIELDS', {}).get('ID')
+        if event == "oncrmdealdelete":
+            await deal_mirror.delete(domain, deal_id)
+            return None
+        if not deal_id:
+            return None
+
+        # Сделка, ответственный, автор изменения и стадии направления — одним запросом batch.
+        # Справочники добавляются, только если их может не быть в кэше
+        results, errors = await BitrixClient.batch(
+            domain, user_data["access_token"], await deal_commands(domain, deal_id)
+        )
+        if 'deal' in errors:
+            logging.error(f"Bitrix API error: {errors['deal'].get('error_description')}")
+            return None
+
+        deal = results.get('deal') or {}
+        await deal_mirror.put(domain, deal)
+        responsible_id = deal.get('ASSIGNED_BY_ID')
+        changed_by_id = deal.get('MODIFY_BY_ID') or deal.get('MODIFIED_BY_ID')
+        cache_user_names(domain, results.get('responsible'))
+        cache_user_names(domain, results.get('changed_by'))
+        if 'stages' in results:
+            cache_deal_stages(domain, deal.get('CATEGORY_ID'), results['stages'])
+
+        # Получение имен
+        responsible_name = await get_user_name(
+            domain=domain,
+            access_token=user_data["access_token"],
+            user_id=responsible_id
+        ) if responsible_id else "Не указан"
+
+        changed_by_name = await get_user_name(
+            domain=domain,
+            access_token=user_data["access_token"],
+            user_id=changed_by_id
+        ) if changed_by_id else "Неизвестно"
 
+        try:
+            stage_map = await get_stage_map(domain, user_data["access_token"], deal.get('CATEGORY_ID') or 0)
+        except Exception as e:
+            logging.warning(f"Deal stages unavailable for {domain}: {e}")
+            stage_map = {}  # покажем STAGE_ID без названия
+
+        # logging.info(f"Deal data: {deal}")  # Логи
+
+        return {
+            "deal_id": deal_id,
+            "deal": deal,
+            "domain": domain,
+            "responsible_name": responsible_name,
+            "changed_by_name": changed_by_name,
+            "stage": stage_map.get(deal.get('STAGE_ID'), deal.get('STAGE_ID'))
+        }
+    except BitrixRetryLater:
+        raise
     except Exception as e:
         logging.error(f"Ошибка обработки сделки: {e}")
+    return None
 
-async def process_comment_event(event: str, data: dict, user_data: dict, chat_id: str):
-    """Обработка комментариев к задачам из Битрикса"""
-    settings = await get_notification_settings(chat_id)
-    if not settings['comments']:
-        logging.info("Comments notifications are disabled")
-        return
+
+async def deal_commands(domain: str, deal_id) -> dict:
+    """Команды batch для события сделки.
+
+    ID ответственного и направления до запроса неизвестны, поэтому промах кэша
+    предсказывается по прошлой версии сделки из локальной копии. Если
+    предсказание не сбылось, недостающее догрузится отдельным запросом.
+    """
+    commands = {"deal": ("crm.deal.get", {"id": deal_id})}
+    known = await deal_mirror.get(domain, deal_id) or {}
+    if not names_warm(domain):
+        responsible_id = known.get('ASSIGNED_BY_ID')
+        if not responsible_id or user_name_cache.get((domain, str(responsible_id))) is None:
+            commands["responsible"] = ("user.get", {"ID": "$result[deal][ASSIGNED_BY_ID]"})
+        commands["changed_by"] = ("user.get", {"ID": "$result[deal][MODIFY_BY_ID]"})
+    if 'CATEGORY_ID' not in known or deal_stage_cache.get((domain, int(known['CATEGORY_ID'] or 0))) is None:
+        commands["stages"] = ("crm.dealcategory.stage.list", {"id": "$result[deal][CATEGORY_ID]"})
+    return commands
+
+
+def render_deal_event(event: str, entity: dict, user_data: dict) -> Optional[str]:
+    """Формирование уведомления о сделке для конкретного пользователя"""
+    deal_id = entity["deal_id"]
+    deal = entity["deal"]
+    responsible_id = deal.get('ASSIGNED_BY_ID')
+    message = ""
+
+    # Формирование сообщения
+    deal_url = f"https://{entity['domain']}/crm/deal/details/{deal_id}/"
+    title = deal.get('TITLE', 'Без названия')
+    address = deal.get('COMMENTS', 'Не указано')
+    stage = entity["stage"]
+
+    if event == "oncrmdealadd":
+        message = (
+            f"Сделка <b><a href='{deal_url}'>№{deal_id}</a></b> - 🆕Создана🆕\n"
+            f"🏢 Название: {title}\n"
+            f"📍 Адрес: {address}\n"
+            f"📈 Стадия: {stage}\n"
+            f"👤 Ответственный: {entity['responsible_name']}"
+        )
+    elif event == "oncrmdealupdate":
+        message = (
+            f"Сделка <b><a href='{deal_url}'>№{deal_id}</a></b> - 🔄Изменена🔄\n"
+            f"🏢 Название: {title}\n"
+            f"📍 Адрес: {address}\n"
+            f"📈 Стадия: {stage}\n"
+            f"👤 Ответственный: {entity['responsible_name']}\n"
+            f"✍️ Изменено: {entity['changed_by_name']}"
+        )
+
+    if responsible_id:
+        if str(user_data.get('user_id')) == str(responsible_id) or user_data.get('is_admin'):
+            return message or None
+    return None
+
+
+async def fetch_comment_event(event: str, data: dict, user_data: dict) -> Optional[dict]:
+    """Получение комментария и задачи из Битрикса — один раз на событие"""
     try:
         comment_data = data.get('data', {}).get('FIELDS_AFTER')
         logging.info(f"Comment data: {comment_data}") # Логи
 
         if not comment_data:
             logging.warning("No FIELDS_AFTER in webhook data for comment")
-            return
+            return None
 
         comment_id = comment_data.get('ID')
         task_id = comment_data.get('TASK_ID')
         if not comment_id or not task_id:
             logging.warning(f"Invalid comment webhook payload: {comment_data}")
-            return
-
-        message = ""
-        responsible_id = None
-        user_id = user_data["user_id"]
-
+            return None
+
+        # Комментарий и ответственный по задаче — одним запросом batch.
+        # Задача из локальной копии, если она там есть
+        commands = {"comment": ("task.commentitem.get", {"taskId": task_id, "itemId": comment_id})}
+        task = await task_mirror.get(user_data['domain'], task_id)
+        if task is None:
+            commands["task"] = ("tasks.task.get", {"taskId": task_id, "select": ["ID", "RESPONSIBLE_ID"]})
         try:
-            async with httpx.AsyncClient() as client:
-                resp = await client.get(
-                    f"https://{user_data['domain']}/rest/task.commentitem.get",
-                    params={
-                        "taskId": task_id,
-                        "itemId": comment_id,
-                        "auth": user_data["access_token"]
-                    }
-                )
-                comment = resp.json().get('result', {})
-                #logging.info(f"Comment data: {comment}")  # Логи
+            results, errors = await BitrixClient.batch(user_data['domain'], user_data["access_token"], commands)
+        except BitrixRetryLater:
+            raise
         except Exception as e:
             logging.error(f"Failed to fetch comment {comment_id} for task {task_id}: {e}")
-            return
+            return None
+
+        if 'comment' in errors:
+            logging.error(f"Failed to fetch comment {comment_id} for task {task_id}: {errors['comment']}")
+            return None
+        comment = results.get('comment') or {}
+        #logging.info(f"Comment data: {comment}")  # Логи
+
+        if task is None:
+            task = (results.get('task') or {}).get('task', {})
+        if not task:
+            logging.warning(f"Task {task_id} not found when resolving responsible for comment")
+            return None
+
+        return {"task_id": task_id, "comment": comment, "responsible_id": task.get('responsibleId')}
+    except BitrixRetryLater:
+        raise
+    except Exception as e:
+        logging.error(f"Ошибка обработки комментария: {e}")
+    return None
 
-        author_name = comment.get('AUTHOR_NAME')
-        comment_text = comment.get('POST_MESSAGE', '')[:1000]  # Обрезаем длинные сообщения
-        comment_date = datetime.strptime(comment['POST_DATE'], "%Y-%m-%dT%H:%M:%S%z").strftime("%Y-%m-%d %H:%M")
-        message = (
-            f"💬 Новый комментарий к задаче <b><a href='https://{BITRIX_DOMAIN}/company/personal/user/{user_id}/tasks/task/view/{task_id}/'>№{task_id}</a></b>\n"
-            f"Автор: {author_name}\n"
-            f"Текст: {comment_text}\n"
-            f"Дата: {comment_date}\n"
-        )
 
-        # Добавляем ответственного
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(
-                f"https://{user_data['domain']}/rest/tasks.task.get",
-                params={
-                    "taskId": task_id,
-                    "auth": user_data["access_token"]
-                }
-            )
-            task = resp.json().get('result', {}).get('task', {})
-            if not task:
-                logging.warning(f"Task {task_id} not found when resolving responsible for comment")
-                return
-            responsible_id = task.get('responsibleId')
+def render_comment_event(event: str, entity: dict, user_data: dict) -> Optional[str]:
+    """Формирование уведомления о комментарии для конкретного пользователя"""
+    task_id = entity["task_id"]
+    comment = entity["comment"]
+    responsible_id = entity["responsible_id"]
+    user_id = user_data["user_id"]
 
-        if responsible_id:
-            if str(user_data.get('user_id')) == str(responsible_id) or user_data.get('is_admin'):
-                await bot.send_message(chat_id, message)
+    author_name = comment.get('AUTHOR_NAME')
+    comment_text = comment.get('POST_MESSAGE', '')[:1000]  # Обрезаем длинные сообщения
+    comment_date = datetime.strptime(comment['POST_DATE'], "%Y-%m-%dT%H:%M:%S%z").strftime("%Y-%m-%d %H:%M")
+    message = (
+        f"💬 Новый комментарий к задаче <b><a href='https://{BITRIX_DOMAIN}/company/personal/user/{user_id}/tasks/task/view/{task_id}/'>№{task_id}</a></b>\n"
+        f"Автор: {author_name}\n"
+        f"Текст: {comment_text}\n"
+        f"Дата: {comment_date}\n"
+    )
+
+    if responsible_id:
+        if str(user_data.get('user_id')) == str(responsible_id) or user_data.get('is_admin'):
+            return message
+    return None
 
+
+def get_event_processor(event: str):
+    """Пара (загрузка сущности, формирование сообщения) для типа события"""
+    if event.startswith("ontaskcomment"):
+        return fetch_comment_event, render_comment_event
+    elif event.startswith("ontask"):
+        return fetch_task_event, render_task_event
+    elif event.startswith("oncrmdeal"):
+        return fetch_deal_event, render_deal_event
+    return None
+
+
+async def send_notification(chat_id, message: str, priority: int = PRIORITY_NORMAL):
+    """Ставит уведомление в очередь отправки с учётом лимитов Telegram"""
+    try:
+        await TelegramDelivery.send(chat_id, message, priority=priority)
     except Exception as e:
-        logging.error(f"Ошибка обработки комментария: {e}")
+        logging.error(f"Failed to queue notification to chat {chat_id}: {e}")
+
+
+async def notify_event(event: str, data: dict, recipients: list[dict], token_users: AsyncIterator[dict]):
+    """Рассылка события по чатам портала.
+
+    Сущность загружается из Битрикса один раз (токеном первого подходящего
+    пользователя из token_users), затем права и текст проверяются для каждого
+    получателя в памяти, а сообщения ставятся в очередь TelegramDelivery.
+    """
+    processor = get_event_processor(event)
+    if not processor or not recipients:
+        return
+    fetch, render = processor
+
+    entity = None
+    async for user_data in token_users:
+        with WEBHOOK_PHASE_SECONDS.time(phase="bitrix"):
+            entity = await fetch(event, data, user_data)
+        if entity is not None:
+            break
+    if entity is None:
+        logging.error(f"Could not fetch entity for event {event}")
+        WEBHOOK_EVENTS.inc(event=event_label(event), outcome="fetch_failed")
+        return
+
+    # Изменения, найденные догоняющей синхронизацией, уступают свежим событиям
+    priority = PRIORITY_LOW if data.get('_catchup') else PRIORITY_NORMAL
+    sends = []
+    with WEBHOOK_PHASE_SECONDS.time(phase="render"):
+        for user_data in recipients:
+            try:
+                message = render(event, entity, user_data)
+            except Exception as e:
+                logging.error(f"Render error for chat {user_data['chat_id']}: {e}")
+                continue
+            if message:
+                sends.append(send_notification(user_data["chat_id"], message, priority))
+
+    WEBHOOK_EVENTS.inc(event=event_label(event), outcome="notified" if sends else "filtered")
+    await asyncio.gather(*sends)
+
+
+async def refresh_mirror(event: str, data: dict, token_users: AsyncIterator[dict]):
+    """Загрузка изменённой задачи или сделки только ради локальной копии — когда уведомлять некого"""
+    domain = data.get('auth', {}).get('domain')
+    mirror = task_mirror if event.startswith("ontask") else deal_mirror if event.startswith("oncrmdeal") else None
+    if mirror is None or event.startswith("ontaskcomment") or not await mirror.is_ready(domain):
+        return
+
+    fetch, _ = get_event_processor(event)
+    async for user_data in token_users:
+        if await fetch(event, data, user_data) is not None:
+            break
 
 
 # --- Команды Telegram Bot --- 
@@ -348,7 +478,6 @@ async def process_task_description(m: Message, state: FSMContext):
 async def process_task_responsible(m: Message, state: FSMContext):
 
     user_data = await get_user(m.from_user.id)
-    data = await state.get_data()
 
     if m.text.lower() == "нет":
         responsible_id = user_data["user_id"]
@@ -402,20 +531,19 @@ async def process_task_deadline(m: Message, state: FSMContext):
     }
 
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(
-                f"https://{user_data['domain']}/rest/tasks.task.add.json",
-                params={"auth": user_data["access_token"]},
-                json={"fields": task_data}
-            )
-            data = resp.json()
+        resp = await BitrixClient.post(
+            f"https://{user_data['domain']}/rest/tasks.task.add.json",
+            params={"auth": user_data["access_token"]},
+            json={"fields": task_data}
+        )
+        data = resp.json()
 
-            if data.get('error'):
-                error_msg = data.get('error_description', 'Неизвестная ошибка Bitrix')
-                raise ValueError(error_msg)
+        if data.get('error'):
+            error_msg = data.get('error_description', 'Неизвестная ошибка Bitrix')
+            raise ValueError(error_msg)
 
-            task_id = data['result']['task']['id']
-            await m.answer(f"✅ Задача создана! ID: {task_id}")
+        task_id = data['result']['task']['id']
+        await m.answer(f"✅ Задача создана! ID: {task_id}")
 
     except Exception as e:
         await m.answer(f"❌ Ошибка при создании задачи.")
@@ -470,18 +598,19 @@ async def process_deal_stage(m: Message, state: FSMContext):
     if m.text.lower() != "нет":
         # Проверка существования стадии
         try:
-            async with httpx.AsyncClient() as client:
-                resp = await client.get(
-                    f"https://{user_data['domain']}/rest/crm.dealcategory.stage.list",
-                    params={"auth": user_data["access_token"]}
-                )
-                stages = resp.json().get('result', [])
+            stages = await get_deal_stages(user_data['domain'], user_data["access_token"])
+            stage_ids = {stage['STATUS_ID'] for stage in stages}
+
+            if m.text not in stage_ids:
+                # Стадию могли добавить недавно — перечитываем список из Битрикса
+                invalidate_deal_stages(user_data['domain'], 0)
+                stages = await get_deal_stages(user_data['domain'], user_data["access_token"])
                 stage_ids = {stage['STATUS_ID'] for stage in stages}
 
-                if m.text not in stage_ids:
-                    return await m.answer("❌ Неверный ID стадии. Введите корректный ID или 'нет':")
+            if m.text not in stage_ids:
+                return await m.answer("❌ Неверный ID стадии. Введите корректный ID или 'нет':")
 
-                stage_id = m.text
+            stage_id = m.text
         except Exception as e:
             return await m.answer(f"❌ Ошибка проверки стадии: {str(e)}")
 
@@ -496,20 +625,19 @@ async def process_deal_stage(m: Message, state: FSMContext):
         deal_data["STAGE_ID"] = stage_id
 
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(
-                f"https://{user_data['domain']}/rest/crm.deal.add.json",
-                params={"auth": user_data["access_token"]},
-                json={"fields": deal_data}
-            )
-            deal_data = resp.json()
+        resp = await BitrixClient.post(
+            f"https://{user_data['domain']}/rest/crm.deal.add.json",
+            params={"auth": user_data["access_token"]},
+            json={"fields": deal_data}
+        )
+        deal_data = resp.json()
 
-            if deal_data.get('error'):
-                error_msg = deal_data.get('error_description', 'Неизвестная ошибка Bitrix')
-                raise ValueError(error_msg)
+        if deal_data.get('error'):
+            error_msg = deal_data.get('error_description', 'Неизвестная ошибка Bitrix')
+            raise ValueError(error_msg)
 
-            deal_id = deal_data.get('result')
-            await m.answer(f"✅ Сделка создана! ID: {deal_id}")
+        deal_id = deal_data.get('result')
+        await m.answer(f"✅ Сделка создана! ID: {deal_id}")
 
     except Exception as e:
         await m.answer(f"❌ Ошибка при создании сделки: {str(e)}")
@@ -538,25 +666,31 @@ async def process_comment_task_id(m: Message, state: FSMContext):
 
     task_id = int(m.text)
 
+    # Задача из локальной копии, если пользователь её участник; иначе проверяет Битрикс
+    task = await task_mirror.get(user_data['domain'], task_id)
+    if task is not None and (user_data.get('is_admin') or int(user_data['user_id']) in task_mirror.owners(task)):
+        await state.update_data(task_id=task_id)
+        await m.answer("Введите текст комментария:")
+        return await state.set_state(CommentCreationStates.waiting_for_comment_text)
+
     # Проверка существования задачи
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(
-                f"https://{user_data['domain']}/rest/tasks.task.get.json",
-                params={
-                    "taskId": task_id,
-                    "auth": user_data["access_token"]
-                }
-            )
-            task_data = resp.json()
-            #logging.info(f"Task Data: {task_data}")  # Логи
+        resp = await BitrixClient.get(
+            f"https://{user_data['domain']}/rest/tasks.task.get.json",
+            params={
+                "taskId": task_id,
+                "auth": user_data["access_token"]
+            }
+        )
+        task_data = resp.json()
+        #logging.info(f"Task Data: {task_data}")  # Логи
 
-            if task_data.get('result') == []:
-                return await m.answer("❌ Задача не найдена или нет доступа. Введите другой ID:")
+        if task_data.get('result') == []:
+            return await m.answer("❌ Задача не найдена или нет доступа. Введите другой ID:")
 
-            await state.update_data(task_id=task_id)
-            await m.answer("Введите текст комментария:")
-            await state.set_state(CommentCreationStates.waiting_for_comment_text)
+        await state.update_data(task_id=task_id)
+        await m.answer("Введите текст комментария:")
+        await state.set_state(CommentCreationStates.waiting_for_comment_text)
 
     except Exception as e:
         await m.answer(f"❌ Ошибка проверки доступа к задаче.")
@@ -573,25 +707,24 @@ async def process_comment_text(m: Message, state: FSMContext):
         return await m.answer("❌ Комментарий не может быть пустым. Введите снова:")
 
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(
-                f"https://{user_data['domain']}/rest/task.commentitem.add.json",
-                params={"auth": user_data["access_token"]},
-                json={
-                    "TASK_ID": task_id,
-                    "fields": {
-                        "AUTHOR_ID": user_data["user_id"],
-                        "POST_MESSAGE": m.text
-                    }
+        resp = await BitrixClient.post(
+            f"https://{user_data['domain']}/rest/task.commentitem.add.json",
+            params={"auth": user_data["access_token"]},
+            json={
+                "TASK_ID": task_id,
+                "fields": {
+                    "AUTHOR_ID": user_data["user_id"],
+                    "POST_MESSAGE": m.text
                 }
-            )
-            comment_data = resp.json()
+            }
+        )
+        comment_data = resp.json()
 
-            if 'error' in comment_data:
-                error_msg = comment_data.get('error_description', 'Ошибка добавления комментария')
-                raise ValueError(error_msg)
+        if 'error' in comment_data:
+            error_msg = comment_data.get('error_description', 'Ошибка добавления комментария')
+            raise ValueError(error_msg)
 
-            await m.answer(f"💬 Комментарий добавлен к задаче {task_id}")
+        await m.answer(f"💬 Комментарий добавлен к задаче {task_id}")
 
     except Exception as e:
         await m.answer(f"❌ Ошибка добавления комментария.")
@@ -602,208 +735,220 @@ async def process_comment_text(m: Message, state: FSMContext):
 async def show_stage_list(chat_id: int, domain: str, token: str):
     """Получает список стадий сделок"""
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(
-                f"https://{domain}/rest/crm.dealcategory.stage.list",
-                params={"auth": token}
-            )
-            stages = resp.json().get('result', [])
+        stages = await get_deal_stages(domain, token)
 
-            if not stages:
-                await bot.send_message(chat_id, "❗ Стадии сделок не найдены.")
-                return
+        if not stages:
+            await bot.send_message(chat_id, "❗ Стадии сделок не найдены.")
+            return
 
-            message = "📊 Доступные стадии сделок:\n"
-            for stage in stages:
-                message += f"{stage['NAME']} (ID: {stage['STATUS_ID']})\n"
+        message = "📊 Доступные стадии сделок:\n"
+        for stage in stages:
+            message += f"{stage['NAME']} (ID: {stage['STATUS_ID']})\n"
 
-            return message
+        return message
 
     except Exception as e:
         logging.error(f"Ошибка при получении стадий: {e}")
         await bot.send_message(chat_id, f"❌ Ошибка при получении стадий: {e}")
 
 
-@dp.message(Command("employees"))
-async def cmd_employees(m: Message):
-    """Получить список сотрудников Bitrix24"""
+# --- Постраничные списки ---
+async def render_task_items(user_data: dict, tasks: list) -> list:
+    user_id = user_data['user_id']
+    lines = []
+    for task in tasks:
+        task_id = task.get('id')
+        title = task.get('title', 'Без названия')
+        lines.extend((
+            f"Задача <b><a href='https://{BITRIX_DOMAIN}/company/personal/user/{user_id}/tasks/task/view/{task_id}/'>№{task_id}</a></b>",
+            f"📌 Название: {title}",
+            "―――――――――――――――――――――"
+        ))
+    return lines
+
+
+async def render_deal_items(user_data: dict, deals: list) -> list:
+    domain = user_data['domain']
+
+    # Стадии всех направлений, в которых есть сделки со страницы
+    category_ids = sorted({int(deal.get('CATEGORY_ID') or 0) for deal in deals})
+    stage_maps = await asyncio.gather(*(
+        get_stage_map(domain, user_data["access_token"], category_id) for category_id in category_ids
+    ))
+    stage_map = {}
+    for category_stage_map in stage_maps:
+        stage_map.update(category_stage_map)
+
+    lines = []
+    for deal in deals:
+        deal_id = deal.get('ID')
+        title = deal.get('TITLE', 'Без названия')
+        stage = stage_map.get(deal.get('STAGE_ID'), deal.get('STAGE_ID'))
+
+        deal_url = f"https://{domain}/crm/deal/details/{deal_id}/"
+        lines.append(
+            f"🔗 <b><a href='{deal_url}'>Сделка №{deal_id}</a></b>\n"
+            f"🏷 Название: {title}\n"
+            f"📌 Стадия: {stage}\n"
+            "―――――――――――――――――――――"
+        )
+    return lines
+
+
+async def render_employee_items(user_data: dict, users: list) -> list:
+    cache_user_names(user_data['domain'], users)
+    return [f"👤 {format_user_name(user)} (ID: {user.get('ID', 'N/A')})" for user in users]
+
+
+# Списки, которые показываются постранично: метод Битрикса, параметры запроса и оформление
+LISTS = {
+    "tasks": {
+        "method": "tasks.task.list",
+        "params": lambda user_data: {
+            "order": {"CREATED_DATE": "DESC"},
+            "select": ["ID", "TITLE", "RESPONSIBLE_ID", "CREATED_BY", "STATUS", "DEADLINE"]
+        },
+        "render": render_task_items,
+        # Права на задачи (подчинённые, рабочие группы) в копии не хранятся —
+        # из неё отдаётся только список администратора
+        "mirror": task_mirror,
+        "mirror_for_owners": False,
+        "title": "📋 Список задач:\n",
+        "empty": "📭 У вас нет задач."
+    },
+    "deals": {
+        "method": "crm.deal.list",
+        "params": lambda user_data: {
+            "order": {"DATE_CREATE": "DESC"},
+            # Фильтр в зависимости от прав
+            "filter": {} if user_data.get("is_admin") else {"ASSIGNED_BY_ID": user_data["user_id"]},
+            "select": ["ID", "TITLE", "STAGE_ID", "CATEGORY_ID", "ASSIGNED_BY_ID"]
+        },
+        "render": render_deal_items,
+        "mirror": deal_mirror,
+        "mirror_for_owners": True,  # тот же фильтр по ASSIGNED_BY_ID, что и в запросе
+        "title": "🏢 Список сделок:\n",
+        "empty": "📭 У вас нет сделок."
+    },
+    "employees": {
+        "method": "user.get",
+        "params": lambda user_data: {
+            "FILTER": {"USER_TYPE": "employee"},
+            "SELECT": ["ID", "NAME", "LAST_NAME"]
+        },
+        "render": render_employee_items,
+        "title": "Список сотрудников:\n",
+        "empty": "🤷 На портале нет сотрудников"
+    }
+}
+
+
+def list_keyboard(kind: str, page: int, pages: int) -> Optional[InlineKeyboardMarkup]:
+    """Кнопки «Назад» / «Вперёд» под страницей списка"""
+    if pages <= 1:
+        return None
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(text="◀️ Назад", callback_data=f"list:{kind}:{page - 1}"))
+    buttons.append(InlineKeyboardButton(text=f"{page + 1} / {pages}", callback_data="list:noop"))
+    if page + 1 < pages:
+        buttons.append(InlineKeyboardButton(text="Вперёд ▶️", callback_data=f"list:{kind}:{page + 1}"))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons])
+
+
+async def render_list_page(user_data: dict, kind: str, page: int) -> Optional[tuple]:
+    """Текст и клавиатура страницы списка или None, если список пуст"""
+    spec = LISTS[kind]
+    offset = page * LIST_PAGE_SIZE
+    mirror = spec.get("mirror")
+    if not user_data.get('is_admin') and not spec.get("mirror_for_owners"):
+        mirror = None
+    if mirror is not None and await mirror.is_ready(user_data['domain']):
+        # Портал выгружен в локальную копию — без запросов к Битриксу
+        owner_id = None if user_data.get('is_admin') else int(user_data['user_id'])
+        items, total = await mirror.list(user_data['domain'], owner_id, offset, LIST_PAGE_SIZE)
+    else:
+        if mirror is not None:
+            mirror.ensure_synced(user_data['domain'])
+        items, total = await get_list_slice(
+            user_data, spec["method"], spec["params"](user_data), offset, LIST_PAGE_SIZE
+        )
+    if not items:
+        return None
+
+    pages = max(1, -(-total // LIST_PAGE_SIZE))
+    message = [spec["title"], *await spec["render"](user_data, items)]
+    message.append(f"\nПоказано {offset + 1}–{offset + len(items)} из {total}.")
+    return "\n".join(message), list_keyboard(kind, page, pages)
+
+
+async def send_list(m: Message, kind: str):
+    """Первая страница списка по команде"""
     user_data = await get_user(m.from_user.id)
     if not user_data:
         return await m.answer("❗ Сначала авторизуйтесь через /start")
 
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(
-                f"https://{user_data['domain']}/rest/user.get.json",
-                params={
-                    "auth": user_data["access_token"],
-                    "FILTER": {"USER_TYPE": "employee"},
-                    "SELECT": ["ID", "NAME", "LAST_NAME"]
-                }
-            )
-            data = resp.json()
-
-            if 'error' in data:
-                error_msg = data.get('error_description', 'Неизвестная ошибка')
-                return await m.answer(f"❌ Ошибка Bitrix: {error_msg}")
-
-            users = data.get('result', [])
-            if not users:
-                return await m.answer("🤷 На портале нет сотрудников")
-
-            # Формируем список
-            user_list = []
-            for user in users:
-                user_id = user.get('ID', 'N/A')
-                name = f"{user.get('NAME', '')} {user.get('LAST_NAME', '')}".strip()
-                user_list.append(f"👤 {name} (ID: {user_id})")
-
-            # Разбиваем на сообщения по 20 пользователей
-            chunk_size = 20
-            for i in range(0, len(user_list), chunk_size):
-                chunk = user_list[i:i + chunk_size]
-                await m.answer(
-                    "Список сотрудников:\n\n" + "\n".join(chunk),
-                    parse_mode="HTML"
-                )
-
+        # Команда всегда показывает свежий список, кэш нужен для листания
+        reset_list_pages(user_data['chat_id'], LISTS[kind]["method"])
+        page = await render_list_page(user_data, kind, 0)
+        if page is None:
+            return await m.answer(LISTS[kind]["empty"])
+
+        text, keyboard = page
+        await m.answer(text, reply_markup=keyboard)
+
+    except BitrixError as e:
+        await m.answer(f"❌ Ошибка Bitrix: {e.description or e.error}")
+    except httpx.HTTPError as e:
+        logging.error(f"HTTP error in /{kind}: {e}")
+        await m.answer("❌ Ошибка подключения к Bitrix24.")
     except Exception as e:
-        logging.error(f"Employees error: {str(e)}", exc_info=True)
-        await m.answer(f"⚠️ Ошибка при получении списка: {str(e)}")
+        logging.error(f"Ошибка в /{kind}: {str(e)}", exc_info=True)
+        await m.answer("⚠️ Ошибка при получении списка.")
 
 
-@dp.message(Command("tasks"))
-async def cmd_tasks(m: Message):
-    """Показать список задач пользователя"""
-    user_data = await get_user(m.from_user.id)
+@dp.callback_query(F.data.startswith("list:"))
+async def process_list_page(callback: CallbackQuery):
+    """Листание списка: сообщение заменяется выбранной страницей"""
+    parts = callback.data.split(":")
+    if len(parts) != 3 or parts[1] not in LISTS:
+        return await callback.answer()
+    kind, page = parts[1], int(parts[2])
+
+    user_data = await get_user(callback.from_user.id)
     if not user_data:
-        return await m.answer("❗ Сначала авторизуйтесь через /start")
+        return await callback.answer("❗ Сначала авторизуйтесь через /start", show_alert=True)
 
     try:
-        user_id = user_data['user_id']
-
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(
-                f"https://{user_data['domain']}/rest/tasks.task.list.json",
-                params={"auth": user_data["access_token"]},
-                json={
-                    "order": {"CREATED_DATE": "DESC"},
-                    "select": ["ID", "TITLE", "RESPONSIBLE_ID", "CREATED_BY", "STATUS", "DEADLINE"]
-                }
-            )
-            resp.raise_for_status()
-            data = resp.json()
-
-            if 'error' in data:
-                error_msg = data.get('error_description', 'Неизвестная ошибка')
-                raise ValueError(f"Bitrix API: {error_msg}")
-
-            tasks = data.get('result', {}).get('tasks', [])
-            if not tasks:
-                await m.answer("📭 У вас нет задач.")
-                return
-
-            status_map = {
-                '2': "🆕 Ждет выполнения",
-                '3': "🔄 Выполняется",
-                '4': "⏳ Ожидает контроля",
-                '5': "✅ Завершена",
-                '6': "⏸ Отложена"
-            }
+        result = await render_list_page(user_data, kind, page)
+        if result is None:
+            return await callback.answer(LISTS[kind]["empty"], show_alert=True)
 
-            message = ["📋 Список задач:\n"]
-            for task in tasks:
-                task_id = task.get('id')
-                title = task.get('title', 'Без названия')
+        text, keyboard = result
+        await callback.message.edit_text(text, reply_markup=keyboard)
+        await callback.answer()
+    except Exception as e:
+        logging.error(f"List page error ({kind}, {page}): {e}")
+        await callback.answer("⚠️ Ошибка при получении списка.", show_alert=True)
 
-                task_info = (
-                    f"Задача <b><a href='https://{BITRIX_DOMAIN}/company/personal/user/{user_id}/tasks/task/view/{task_id}/'>№{task_id}</a></b>",
-                    f"📌 Название: {title}",
-                    "―――――――――――――――――――――"
-                )
-                message.extend(task_info)
-            message.append(f"\nПоказано {len(tasks)} задач.")
 
-            await m.answer("\n".join(message))
+@dp.message(Command("employees"))
+async def cmd_employees(m: Message):
+    """Получить список сотрудников Bitrix24"""
+    await send_list(m, "employees")
 
-    except httpx.HTTPStatusError as e:
-        logging.error(f"HTTP error: {e.response.text}")
-        await m.answer("❌ Ошибка подключения к Bitrix24.")
-    except ValueError as e:
-        await m.answer(f"❌ {str(e)}")
-    except Exception as e:
-        logging.error(f"Ошибка в /tasks: {str(e)}", exc_info=True)
-        await m.answer("⚠️ Ошибка при получении задач.")
+
+@dp.message(Command("tasks"))
+async def cmd_tasks(m: Message):
+    """Показать список задач пользователя"""
+    await send_list(m, "tasks")
 
 
 @dp.message(Command("deals"))
 async def cmd_deals(m: Message):
     """Показать список сделок"""
-    user_data = await get_user(m.from_user.id)
-    if not user_data:
-        return await m.answer("❗ Сначала авторизуйтесь через /start")
-
-    try:
-        domain = user_data['domain']
-        user_id = user_data["user_id"]
-        is_admin = user_data.get("is_admin", False)
-
-        # Формируем фильтр в зависимости от прав
-        filter_params = {} if is_admin else {"ASSIGNED_BY_ID": user_id}
-
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(
-                f"https://{domain}/rest/crm.deal.list",
-                params={"auth": user_data["access_token"]},
-                json={
-                    "order": {"DATE_CREATE": "DESC"},
-                    "filter": filter_params,
-                    "select": ["ID", "TITLE", "STAGE_ID", "ASSIGNED_BY_ID"]
-                }
-            )
-            data = resp.json()
-
-            if 'error' in data:
-                error_msg = data.get('error_description', 'Неизвестная ошибка')
-                raise ValueError(f"Bitrix API: {error_msg}")
-
-            deals = data.get('result', [])
-            if not deals:
-                await m.answer("📭 У вас нет сделок.")
-                return
-
-            stage_map = {}
-
-            async with httpx.AsyncClient() as client:
-                resp = await client.get(
-                    f"https://{user_data['domain']}/rest/crm.dealcategory.stage.list",
-                    params={"auth": user_data["access_token"]}
-                )
-                stages = resp.json().get('result', [])
-
-                for stage in stages:
-                    stage_map[stage['STATUS_ID']] = stage['NAME']
-
-            message = ["🏢 Список сделок:\n"]
-            for deal in deals:
-                deal_id = deal.get('ID')
-                title = deal.get('TITLE', 'Без названия')
-                stage = stage_map.get(deal.get('STAGE_ID'), deal.get('STAGE_ID'))
-
-                deal_url = f"https://{domain}/crm/deal/details/{deal_id}/"
-                message.append(
-                    f"🔗 <b><a href='{deal_url}'>Сделка №{deal_id}</a></b>\n"
-                    f"🏷 Название: {title}\n"
-                    f"📌 Стадия: {stage}\n"
-                    "―――――――――――――――――――――"
-                )
-
-            message.append(f"\nПоказано {len(deals)} сделок.")
-            await m.answer("\n".join(message), parse_mode="HTML")
-
-    except Exception as e:
-        logging.error(f"Ошибка в /deals: {str(e)}", exc_info=True)
-        await m.answer(f"⚠️ Ошибка вывода.")
+    await send_list(m, "deals")
 
 
 @dp.message(Command("settings"))
@@ -873,27 +1018,12 @@ async def process_toggle(callback: CallbackQuery):
         :param callback: Объект нажатой callback-кнопки от пользователя
         """
 
-    pool = await Database.get_pool()
-
     # Извлекаем тип настройки из callback-данных, например: 'new_deals'
     action = callback.data.split('_', 1)[1]
     chat_id = callback.message.chat.id
 
-    async with pool.acquire() as conn:
-        # Получаем текущее значение этой настройки из базы данных
-        current_value = await conn.fetchval(
-            f"SELECT {action} FROM notification_settings WHERE chat_id = $1",
-            chat_id
-        )
-
-        # Инвертируем (меняем True на False и наоборот)
-        new_value = not current_value
-
-        # Сохраняем обновлённое значение в базу
-        await conn.execute(
-            f"UPDATE notification_settings SET {action} = $1 WHERE chat_id = $2",
-            new_value, chat_id
-        )
+    # Инвертируем значение (True на False и наоборот) одним запросом
+    await toggle_notification_setting(chat_id, action)
 
     # Удаляем старое меню и отправляем обновлённое
     await callback.message.delete()
@@ -930,13 +1060,12 @@ async def process_task_history_id(m: Message, state: FSMContext):
     user_id = user_data["user_id"]
 
     # Запрашиваем историю
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(
-            f"https://{domain}/rest/tasks.task.history.list.json",
-            params={"auth": token},
-            json={"taskId": int(task_id)}
-        )
-        data = resp.json()
+    resp = await BitrixClient.post(
+        f"https://{domain}/rest/tasks.task.history.list.json",
+        params={"auth": token},
+        json={"taskId": int(task_id)}
+    )
+    data = resp.json()
 
     if data.get("error"):
         return await m.answer(f"❌ Ошибка Bitrix24: {data.get('error_description')}")
@@ -965,7 +1094,15 @@ async def process_task_history_id(m: Message, state: FSMContext):
         '2': "Высокий"
     }
 
+    # Имена всех исполнителей из истории — одним запросом, параллельно с выводом первых записей
+    responsible_ids = set()
+    for entry in history:
+        if entry.get("field") == "RESPONSIBLE_ID":
+            responsible_ids.update((entry.get("value").get("from"), entry.get("value").get("to")))
+    names_task = asyncio.create_task(get_user_names(domain, token, responsible_ids)) if responsible_ids else None
+
     # Форматируем вывод
+    chunk_size = 10
     messages = [f"🗂 История задачи <b><a href='https://{BITRIX_DOMAIN}/company/personal/user/{user_id}/tasks/task/view/{task_id}/'>№{task_id}</a></b>:"]
     for entry in history:
         date = entry.get("createdDate", "–")
@@ -999,18 +1136,22 @@ async def process_task_history_id(m: Message, state: FSMContext):
             case "COMMENT":
                 text = f"Добавлен комментарий №{new}\n"
             case "RESPONSIBLE_ID":
-                old_resp_name = await get_user_name(domain, token, int(old))
-                new_resp_name = await get_user_name(domain, token, int(new))
+                names = await names_task
+                old_resp_name = names.get(str(old), "Неизвестный")
+                new_resp_name = names.get(str(new), "Неизвестный")
                 text = (f"Сменен Исполнитель\n"
                         f"Изменение: {old_resp_name} → {new_resp_name}\n")
         
         text += f"Автор: {author}"
         messages.append(f"\n<b>{date}</b> - {text}")
 
-    # В Телеграм нельзя отправить очень длинное сообщение, разбиваем по 10 записей
-    chunk_size = 10
-    for i in range(0, len(messages), chunk_size):
-        await m.answer("\n".join(messages[i:i+chunk_size]), parse_mode="HTML")
+        # В Телеграм нельзя отправить очень длинное сообщение — отправляем по 10 записей, как только они готовы
+        if len(messages) == chunk_size:
+            await m.answer("\n".join(messages), parse_mode="HTML")
+            messages = []
+
+    if messages:
+        await m.answer("\n".join(messages), parse_mode="HTML")
 
 
 def edit_fields_keyboard(changed: dict = None) -> InlineKeyboardMarkup:
@@ -1048,16 +1189,18 @@ async def process_edit_task_id(m: Message, state: FSMContext):
     if not user:
         return await m.answer("❗ Сначала авторизуйтесь через /start")
 
-    try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(
+    task = await task_mirror.get(user['domain'], task_id)
+    if task is None:
+        try:
+            resp = await BitrixClient.get(
                 f"https://{user['domain']}/rest/tasks.task.get",
                 params={"taskId": task_id, "auth": user["access_token"]}
             )
-        data = resp.json().get("result", {})
-        task = data.get("task") or {}
-    except:
-        return await m.answer("❌ Ошибка получения задачи по ID")
+            data = resp.json().get("result", {})
+            task = data.get("task") or {}
+        except:
+            return await m.answer("❌ Ошибка получения задачи по ID")
+        await task_mirror.put(user['domain'], task)
 
     is_admin   = user["is_admin"]
     is_creator = str(task.get("creatorId")) == str(user["user_id"])
@@ -1151,12 +1294,11 @@ async def callback_save(c: CallbackQuery, state: FSMContext):
     params = {"auth": user["access_token"]}
     body   = {"taskId": task_id, "fields": changes}
 
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(
-            f"https://{user['domain']}/rest/tasks.task.update",
-            params=params,
-            json=body
-        )
+    resp = await BitrixClient.post(
+        f"https://{user['domain']}/rest/tasks.task.update",
+        params=params,
+        json=body
+    )
     result = resp.json()
     if result.get("error"):
         text = result.get("error_description", "Неизвестная ошибка")
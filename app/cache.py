@@ -0,0 +1,88 @@
+import asyncio
+import logging
+
+from time import monotonic
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+_MISSING = object()
+
+
+class AsyncTTLCache:
+    """LRU-кэш с ограничением по времени жизни записей.
+
+    Одновременные промахи по одному ключу объединяются: загрузка выполняется
+    один раз, остальные вызовы ждут её результата. Ошибки загрузки не кэшируются.
+    Если задан refresh_after, запись старше этого возраста отдаётся как есть,
+    а в фоне запускается её обновление.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0, refresh_after: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.refresh_after = refresh_after
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, tuple[float, float, Any]]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Значение из кэша без загрузки (просроченные записи не возвращаются)"""
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, loaded_at, value = item
+        if expires_at < monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        now = monotonic()
+        self._data[key] = (now + (self.ttl if ttl is None else ttl), now, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def invalidate_where(self, predicate: Callable[[Hashable], bool]):
+        for key in [key for key in self._data if predicate(key)]:
+            del self._data[key]
+
+    def clear(self):
+        self._data.clear()
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            self.hits += 1
+            if self.refresh_after is not None and monotonic() - self._data[key][1] > self.refresh_after:
+                self._load(key, loader)  # фоновое обновление, ответ — из кэша
+            return value
+
+        self.misses += 1
+        # shield: отмена одного ожидающего не должна отменять загрузку для остальных
+        return await asyncio.shield(self._load(key, loader))
+
+    def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(loader())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._on_loaded(key, t))
+        return task
+
+    def _on_loaded(self, key: Hashable, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        if task.cancelled():
+            return
+        if task.exception() is None:
+            self.set(key, task.result())
+        else:
+            logging.warning(f"Cache load failed for {key}: {task.exception()}")
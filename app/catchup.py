@@ -0,0 +1,233 @@
+import asyncio
+import logging
+
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Optional
+
+from config import *
+from db import *
+from bitrix import *
+from tokens import TokenManager
+from mirror import task_mirror, deal_mirror
+from metrics import CATCHUP_CHANGES
+
+# Как искать изменения сущности и каким событием их отдавать в обработку
+KINDS = {
+    "task": {
+        "mirror": task_mirror,
+        "method": "tasks.task.list",
+        "changed_filter": "CHANGED_DATE",
+        "select": ["ID", "CHANGED_DATE", "CREATED_DATE"],
+        "id": "id",
+        "changed": "changedDate",
+        "created": "createdDate",
+        "events": ("ONTASKADD", "ONTASKUPDATE"),
+        "fields": "FIELDS_AFTER"
+    },
+    "deal": {
+        "mirror": deal_mirror,
+        "method": "crm.deal.list",
+        "changed_filter": "DATE_MODIFY",
+        "select": ["ID", "DATE_MODIFY", "DATE_CREATE"],
+        "id": "ID",
+        "changed": "DATE_MODIFY",
+        "created": "DATE_CREATE",
+        "events": ("ONCRMDEALADD", "ONCRMDEALUPDATE"),
+        "fields": "FIELDS"
+    }
+}
+
+
+def _iso(moment: datetime) -> str:
+    return moment.isoformat(timespec="seconds")
+
+
+def _parse(value: Optional[str]) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class CatchUpSync:
+    """Догоняющая синхронизация: изменения, для которых не пришёл вебхук.
+
+    Раз в CATCHUP_INTERVAL для каждого портала задачи и сделки, изменённые
+    после сохранённой отметки (watermark), читаются списочными методами —
+    несколько страниц в одном batch, не больше CATCHUP_BUDGET запросов за
+    проход. Изменение, которого нет в локальной копии (EntityMirror),
+    значит, до нас не дошло: оно ставится в ту же очередь, что и вебхуки.
+    Так простой /callback стоит задержки уведомлений, а не их потери.
+
+    Изменения моложе CATCHUP_LAG не трогаем — их вебхук может быть ещё в
+    очереди. Удаления по дате изменения не находятся.
+    """
+    _feed: Optional[Callable[[dict], Awaitable[bool]]] = None
+    _task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def start(cls, feed: Callable[[dict], Awaitable[bool]]):
+        if not CATCHUP_ENABLED or cls._task is not None:
+            return
+        if not MIRROR_ENABLED:
+            # Без копии не отличить пропущенное изменение от уже обработанного
+            logging.warning("Catch-up sync requires MIRROR_ENABLED, disabled")
+            return
+        cls._feed = feed
+        cls._task = asyncio.create_task(cls._run())
+
+    @classmethod
+    async def _run(cls):
+        while True:
+            await asyncio.sleep(CATCHUP_INTERVAL)
+            try:
+                await cls.run_once()
+            except Exception as e:
+                logging.error(f"Catch-up sync failed: {e}")
+
+    @classmethod
+    async def run_once(cls):
+        """Один проход по всем порталам"""
+        async with Database.acquire() as conn:
+            portals = await conn.fetch("SELECT DISTINCT domain, member_id FROM users WHERE member_id <> ''")
+
+        slots = asyncio.Semaphore(CATCHUP_CONCURRENCY)
+
+        async def reconcile(portal):
+            async with slots:
+                try:
+                    await cls.reconcile(portal["domain"], portal["member_id"])
+                except Exception as e:
+                    logging.error(f"Catch-up sync of {portal['domain']} failed: {e}")
+
+        await asyncio.gather(*(reconcile(portal) for portal in portals))
+
+    @classmethod
+    async def reconcile(cls, domain: str, member_id: str):
+        user_data = await portal_user(domain)
+        if user_data is None:
+            return
+        # Бюджет делится поровну, чтобы поток изменений задач не оставлял без проверки сделки
+        budget = max(1, CATCHUP_BUDGET // len(KINDS))
+        for kind in KINDS:
+            await cls._reconcile_kind(domain, member_id, user_data["access_token"], kind, budget)
+
+    @classmethod
+    async def _reconcile_kind(cls, domain: str, member_id: str, access_token: str, kind: str, budget: int):
+        async with Database.acquire() as conn:
+            state = await conn.fetchrow("""
+                INSERT INTO catchup_state (domain, kind, lease_until)
+                VALUES ($1, $2, now() + make_interval(secs => $3))
+                ON CONFLICT (domain, kind) DO UPDATE SET lease_until = EXCLUDED.lease_until
+                WHERE catchup_state.lease_until IS NULL OR catchup_state.lease_until < now()
+                RETURNING watermark
+            """, domain, kind, CATCHUP_INTERVAL)
+        if state is None:
+            return  # портал сейчас проверяет другой процесс
+
+        upper = datetime.now(timezone.utc) - timedelta(seconds=CATCHUP_LAG)
+        watermark = state["watermark"]
+        try:
+            if watermark is None:
+                # Первый проход: отсчёт с текущего момента, без полного пересмотра портала
+                watermark = _iso(upper)
+            else:
+                watermark = await cls._scan(domain, member_id, access_token, kind, watermark, upper, budget)
+        finally:
+            async with Database.acquire() as conn:
+                await conn.execute("""
+                    UPDATE catchup_state SET watermark = $3, checked_at = now(), lease_until = NULL
+                    WHERE domain = $1 AND kind = $2
+                """, domain, kind, watermark)
+
+    @classmethod
+    async def _scan(cls, domain: str, member_id: str, access_token: str, kind: str,
+                    watermark: str, upper: datetime, budget: int) -> str:
+        """Проверяет изменения из окна [watermark, upper) по возрастанию даты. Возвращает новую отметку"""
+        spec = KINDS[kind]
+        since = watermark
+        params = {
+            "order": {spec["changed_filter"]: "ASC", "ID": "ASC"},
+            # >= — изменения в ту же секунду, что и отметка, могли не попасть в прошлый проход;
+            # уже обработанные отсеет сверка с копией
+            "filter": {f">={spec['changed_filter']}": watermark, f"<{spec['changed_filter']}": _iso(upper)},
+            "select": spec["select"]
+        }
+
+        spent, start = 0, 0
+        while spent < budget:
+            # Несколько страниц одним запросом batch
+            commands = {
+                f"page_{i}": (spec["method"], {**params, "start": start + i * LIST_LIMIT})
+                for i in range(CATCHUP_BATCH_PAGES)
+            }
+            results, errors = await BitrixClient.batch(domain, access_token, commands)
+            spent += 1
+
+            for i in range(CATCHUP_BATCH_PAGES):
+                key = f"page_{i}"
+                if key in errors:
+                    # Отметка остаётся на последнем проверенном изменении
+                    logging.warning(f"Catch-up of {kind} for {domain} failed: {errors[key].get('error_description')}")
+                    return watermark
+                result = results.get(key)
+                # tasks.task.list оборачивает список в {"tasks": [...]}
+                items = result.get('tasks', []) if isinstance(result, dict) else (result or [])
+                for item in items:
+                    if not await cls._check(domain, member_id, kind, item, since):
+                        return watermark  # очередь переполнена — продолжим в следующий проход
+                    watermark = item.get(spec["changed"]) or watermark
+                if len(items) < LIST_LIMIT:
+                    return _iso(upper)  # окно проверено целиком
+            start += CATCHUP_BATCH_PAGES * LIST_LIMIT
+
+        # Бюджет исчерпан — остаток окна в следующий проход
+        return watermark
+
+    @classmethod
+    async def _check(cls, domain: str, member_id: str, kind: str, item: dict, since: str) -> bool:
+        """Отдаёт изменение в обработку, если его нет в копии. False — очередь переполнена"""
+        spec = KINDS[kind]
+        entity_id = item.get(spec["id"])
+        changed = item.get(spec["changed"])
+        known = await spec["mirror"].get(domain, entity_id)
+        if known is not None and known.get(spec["changed"]) == changed:
+            CATCHUP_CHANGES.inc(kind=kind, outcome="seen")
+            return True
+
+        # Создана внутри окна — пропущено событие создания
+        created, since = _parse(item.get(spec["created"])), _parse(since)
+        add_event, update_event = spec["events"]
+        event = add_event if created and since and created >= since else update_event
+        accepted = await cls._feed({
+            "event": event,
+            "data": {spec["fields"]: {"ID": str(entity_id)}},
+            "auth": {"domain": domain, "member_id": member_id},
+            "_catchup": True
+        })
+        CATCHUP_CHANGES.inc(kind=kind, outcome="queued" if accepted else "rejected")
+        return accepted
+
+    @classmethod
+    async def stop(cls):
+        if cls._task is not None:
+            cls._task.cancel()
+            try:
+                await cls._task
+            except asyncio.CancelledError:
+                pass
+            cls._task = None
+
+
+async def portal_user(domain: str) -> Optional[dict]:
+    """Пользователь портала с действующим токеном, администраторы — первыми"""
+    async with Database.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT * FROM users WHERE domain = $1 ORDER BY is_admin DESC, expires DESC",
+            domain
+        )
+    for row in rows:
+        user_data = await TokenManager.get_valid_user(row["chat_id"], dict(row))
+        if user_data:
+            return user_data
+    return None
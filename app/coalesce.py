@@ -0,0 +1,80 @@
+import asyncio
+import logging
+
+from time import monotonic
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Set
+
+from config import *
+
+
+class _Pending:
+    __slots__ = ("payload", "first_at", "count", "timer")
+
+    def __init__(self, payload: Any):
+        self.payload = payload
+        self.first_at = monotonic()
+        self.count = 1
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class EventCoalescer:
+    """Склейка серии событий по одному ключу в одно.
+
+    Событие откладывается на window секунд; каждое новое событие с тем же
+    ключом заменяет отложенное и сдвигает таймер. Чтобы непрерывно
+    редактируемая сущность не копилась бесконечно, обработка происходит не
+    позже чем через max_latency секунд после первого события серии.
+    Одновременно выполняется не больше concurrency обработчиков.
+    """
+
+    def __init__(self, handler: Callable[[Any], Awaitable[None]],
+                 window: float = COALESCE_WINDOW, max_latency: float = COALESCE_MAX_LATENCY,
+                 concurrency: int = WEBHOOK_WORKERS):
+        self.handler = handler
+        self.window = window
+        self.max_latency = max_latency
+        self._slots = asyncio.Semaphore(concurrency)
+        self.merged_total = 0
+        self._pending: Dict[Hashable, _Pending] = {}
+        self._running: Set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def submit(self, key: Hashable, payload: Any):
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = self._pending[key] = _Pending(payload)
+        else:
+            entry.payload = payload  # достаточно последнего события — данные всё равно читаются заново
+            entry.count += 1
+            self.merged_total += 1
+            entry.timer.cancel()
+
+        delay = min(self.window, entry.first_at + self.max_latency - monotonic())
+        entry.timer = asyncio.get_running_loop().call_later(max(delay, 0), self._fire, key)
+
+    def _fire(self, key: Hashable):
+        entry = self._pending.pop(key, None)
+        if entry is None:
+            return
+        task = asyncio.create_task(self._run(key, entry))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run(self, key: Hashable, entry: _Pending):
+        if entry.count > 1:
+            logging.info(f"Coalesced {entry.count} events for {key}")
+        try:
+            async with self._slots:
+                await self.handler(entry.payload)
+        except Exception as e:
+            logging.error(f"Coalesced event handler error for {key}: {e}")
+
+    async def flush(self):
+        """Немедленно обрабатывает все отложенные события (при остановке)"""
+        for key, entry in list(self._pending.items()):
+            entry.timer.cancel()
+            self._fire(key)
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
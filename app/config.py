@@ -1,8 +1,6 @@
 import os
 import logging
 from dotenv import load_dotenv
-from typing import Dict, Optional
-from collections import defaultdict
 from aiogram.fsm.state import State, StatesGroup
 
 load_dotenv()
@@ -20,15 +18,137 @@ BITRIX_DOMAIN = os.getenv("BITRIX_DOMAIN")  # Домен портала Битр
 REDIRECT_URI = os.getenv("REDIRECT_URI")
 WEBHOOK_DOMAIN = os.getenv("WEBHOOK_DOMAIN")
 
+# HTTP-клиент для REST Битрикс24 (общий пул соединений на каждый домен)
+BITRIX_HTTP_TIMEOUT = float(os.getenv("BITRIX_HTTP_TIMEOUT", "10"))
+BITRIX_HTTP_CONNECT_TIMEOUT = float(os.getenv("BITRIX_HTTP_CONNECT_TIMEOUT", "5"))
+BITRIX_HTTP_MAX_CONNECTIONS = int(os.getenv("BITRIX_HTTP_MAX_CONNECTIONS", "20"))
+BITRIX_HTTP_MAX_KEEPALIVE = int(os.getenv("BITRIX_HTTP_MAX_KEEPALIVE", "10"))
+BITRIX_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("BITRIX_HTTP_KEEPALIVE_EXPIRY", "60"))
+BITRIX_HTTP2 = os.getenv("BITRIX_HTTP2", "1") == "1"  # используется, только если установлен пакет h2
+# Все запросы к Битриксу (порталы и oauth.bitrix.info) уходят на этот адрес —
+# для заглушки из benchmarks/, в работе не задаётся
+BITRIX_API_OVERRIDE = os.getenv("BITRIX_API_OVERRIDE")
+
+# Ограничение частоты запросов к порталу (leaky bucket Битрикс24: 2 запроса/с, ёмкость 50;
+# на тарифе Enterprise 5 и 250). Лимит портала общий для приложения — при нескольких
+# процессах его стоит поделить между ними
+BITRIX_RATE = float(os.getenv("BITRIX_RATE", "2"))
+BITRIX_BURST = float(os.getenv("BITRIX_BURST", "50"))
+BITRIX_RETRY_ATTEMPTS = int(os.getenv("BITRIX_RETRY_ATTEMPTS", "5"))  # повторов после QUERY_LIMIT_EXCEEDED
+# Дольше этого запрос не ждёт очереди портала внутри обработчика: событие возвращается в очередь, сек
+BITRIX_MAX_WAIT = float(os.getenv("BITRIX_MAX_WAIT", "10"))
+BITRIX_OPERATING_LIMIT = float(os.getenv("BITRIX_OPERATING_LIMIT", "480"))  # сек работы одного метода за 10 минут
+
+# Режим запуска: all — API и бот в одном процессе, api — только приём вебхуков
+# (API_WORKERS процессов uvicorn), bot — только поллинг Telegram
+RUN_MODE = os.getenv("RUN_MODE", "all")
+API_HOST = os.getenv("API_HOST", "0.0.0.0")
+API_PORT = int(os.getenv("API_PORT", "5000"))
+API_WORKERS = int(os.getenv("API_WORKERS", "1"))
+
+# Очередь обработки вебхуков Битрикс
+WEBHOOK_QUEUE_BACKEND = os.getenv("WEBHOOK_QUEUE_BACKEND", "memory")  # memory | postgres (общая очередь процессов)
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))  # сколько событий обрабатывается одновременно
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv("WEBHOOK_ENQUEUE_TIMEOUT", "2"))  # ожидание места в очереди, сек
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "30"))  # дообработка очереди при остановке, сек
+WEBHOOK_JOB_LOCK_TIMEOUT = int(os.getenv("WEBHOOK_JOB_LOCK_TIMEOUT", "300"))  # через сколько сек зависшая задача снова доступна
+WEBHOOK_JOB_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_JOB_MAX_ATTEMPTS", "5"))
+WEBHOOK_JOB_POLL_INTERVAL = float(os.getenv("WEBHOOK_JOB_POLL_INTERVAL", "5"))  # опрос таблицы, если NOTIFY потерялся
+
+# Защита от повторной доставки событий Битриксом
+DEDUPE_TTL = float(os.getenv("DEDUPE_TTL", "900"))  # сколько помнить событие, сек
+DEDUPE_SIZE = int(os.getenv("DEDUPE_SIZE", "100000"))  # сколько событий помнить в памяти процесса
+DEDUPE_BACKEND = os.getenv("DEDUPE_BACKEND", WEBHOOK_QUEUE_BACKEND)  # memory | postgres (общий индекс процессов)
+
+# Склейка серий OnTaskUpdate / OnCrmDealUpdate по одной сущности (0 — отключено)
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "2"))  # пауза без новых изменений, после которой шлём уведомление, сек
+COALESCE_MAX_LATENCY = float(os.getenv("COALESCE_MAX_LATENCY", "10"))  # максимальная задержка уведомления, сек
+
+# Кэш имён сотрудников Битрикс24
+USER_NAME_CACHE_TTL = float(os.getenv("USER_NAME_CACHE_TTL", "3600"))
+USER_NAME_CACHE_SIZE = int(os.getenv("USER_NAME_CACHE_SIZE", "10000"))
+USER_NAME_WARMUP = os.getenv("USER_NAME_WARMUP", "1") == "1"  # загрузить всех сотрудников портала после авторизации
+
+# Кэш стадий сделок (по порталу и направлению)
+DEAL_STAGE_CACHE_TTL = float(os.getenv("DEAL_STAGE_CACHE_TTL", "3600"))
+DEAL_STAGE_REFRESH_AFTER = float(os.getenv("DEAL_STAGE_REFRESH_AFTER", "300"))  # после этого возраста обновляется в фоне
+
+# Постраничные списки /tasks, /deals, /employees
+LIST_PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE", "10"))  # записей в одном сообщении
+LIST_PAGE_CACHE_TTL = float(os.getenv("LIST_PAGE_CACHE_TTL", "120"))  # сек, страницы Битрикса по пользователю
+LIST_PAGE_CACHE_SIZE = int(os.getenv("LIST_PAGE_CACHE_SIZE", "2000"))
+
+# Локальная копия задач и сделок порталов (таблица mirror_entities), обновляется вебхуками
+MIRROR_ENABLED = os.getenv("MIRROR_ENABLED", "1") == "1"
+MIRROR_HOT_SIZE = int(os.getenv("MIRROR_HOT_SIZE", "5000"))  # задач и сделок в памяти процесса
+MIRROR_HOT_TTL = float(os.getenv("MIRROR_HOT_TTL", "300"))  # сек
+MIRROR_SYNC_LEASE = int(os.getenv("MIRROR_SYNC_LEASE", "900"))  # через сколько сек брошенная выгрузка портала начинается заново
+
+# Догоняющая синхронизация изменений, вебхук о которых не дошёл (сверяется с локальной копией, нужен MIRROR_ENABLED)
+CATCHUP_ENABLED = os.getenv("CATCHUP_ENABLED", "1") == "1"
+CATCHUP_INTERVAL = float(os.getenv("CATCHUP_INTERVAL", "300"))  # период проверки порталов, сек
+CATCHUP_LAG = int(os.getenv("CATCHUP_LAG", "60"))  # изменения моложе этого ещё могут прийти вебхуком, сек
+CATCHUP_BUDGET = int(os.getenv("CATCHUP_BUDGET", "4"))  # запросов batch к порталу за проход
+CATCHUP_BATCH_PAGES = int(os.getenv("CATCHUP_BATCH_PAGES", "10"))  # страниц списка (по 50 записей) в одном batch
+CATCHUP_CONCURRENCY = int(os.getenv("CATCHUP_CONCURRENCY", "4"))  # порталов одновременно
+
+# Обновление OAuth-токенов Битрикс24
+TOKEN_REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN", "60"))  # токен, истекающий раньше, считается просроченным, сек
+TOKEN_RENEW_BEFORE = int(os.getenv("TOKEN_RENEW_BEFORE", "600"))  # фоновое обновление за столько сек до истечения
+TOKEN_RENEW_INTERVAL = float(os.getenv("TOKEN_RENEW_INTERVAL", "60"))  # период проверки токенов, сек
+TOKEN_RENEW_CONCURRENCY = int(os.getenv("TOKEN_RENEW_CONCURRENCY", "5"))
+
 # Настройки Telegram
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # свой сервер Bot API или заглушка из benchmarks/
+
+# Приём обновлений Telegram: polling — dp.start_polling (режимы all и bot),
+# webhook — маршрут TELEGRAM_WEBHOOK_PATH в процессах API рядом с /callback
+TELEGRAM_MODE = os.getenv("TELEGRAM_MODE", "polling")
+TELEGRAM_WEBHOOK_PATH = os.getenv("TELEGRAM_WEBHOOK_PATH", "/telegram")
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL")  # по умолчанию WEBHOOK_DOMAIN + TELEGRAM_WEBHOOK_PATH
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")  # по умолчанию выводится из TELEGRAM_TOKEN
+TELEGRAM_WEBHOOK_CONCURRENCY = int(os.getenv("TELEGRAM_WEBHOOK_CONCURRENCY", "32"))  # обновлений одновременно на процесс
+TELEGRAM_WEBHOOK_MAX_CONNECTIONS = int(os.getenv("TELEGRAM_WEBHOOK_MAX_CONNECTIONS", "40"))  # соединений от Telegram (1-100)
+
+# Очередь отправки уведомлений в Telegram (лимиты Bot API: ~30 сообщений/с всего и ~1/с в один чат).
+# При нескольких процессах API глобальный лимит делится между ними.
+DELIVERY_GLOBAL_RATE = float(os.getenv("DELIVERY_GLOBAL_RATE", "25"))
+DELIVERY_GLOBAL_BURST = float(os.getenv("DELIVERY_GLOBAL_BURST", "25"))
+DELIVERY_CHAT_RATE = float(os.getenv("DELIVERY_CHAT_RATE", "1"))
+DELIVERY_CHAT_BURST = float(os.getenv("DELIVERY_CHAT_BURST", "1"))
+DELIVERY_MAX_ATTEMPTS = int(os.getenv("DELIVERY_MAX_ATTEMPTS", "5"))
+DELIVERY_QUEUE_SIZE = int(os.getenv("DELIVERY_QUEUE_SIZE", "10000"))
+DELIVERY_DRAIN_TIMEOUT = float(os.getenv("DELIVERY_DRAIN_TIMEOUT", "30"))
 
 # База данных
 DATABASE_URL = os.getenv("DATABASE_URL")
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "5"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "20"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))  # подготовленные запросы на соединение
+
+# Кэш соответствия member_id портала → chat_id (сами данные хранятся в PostgreSQL)
+MEMBER_CACHE_TTL = float(os.getenv("MEMBER_CACHE_TTL", "60"))  # сек, чтобы подхватить изменения других процессов
+
+# Хранилище состояний диалогов бота (/task, /deal, /comment, /edit_task)
+FSM_STORAGE = os.getenv("FSM_STORAGE", "postgres")  # postgres | memory (состояния теряются при перезапуске)
+FSM_TTL = int(os.getenv("FSM_TTL", "86400"))  # брошенный диалог удаляется через столько сек
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "0.5"))  # изменения пишутся в PostgreSQL пачкой раз в столько сек
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "300"))  # сколько сек держать сессию в памяти процесса
+# Записывать изменение сразу, а не пачкой. В режиме webhook обновления одного чата
+# приходят в разные процессы — следующий должен сразу видеть новое состояние
+FSM_WRITE_THROUGH = os.getenv("FSM_WRITE_THROUGH", "1" if TELEGRAM_MODE == "webhook" else "0") == "1"
 
-# Глобальные мапы
-is_registered_events: Dict[str, bool] = {}
-member_map: Dict[str, set[str]] = defaultdict(set)  # ключ — это member_id портала, а значение — set чат‑ID
+# Трассировка в формате OTLP JSON (выключена, если не задан ни файл, ни коллектор).
+# TRACE_FILE — файл, в который дописываются пачки спанов (по строке на пачку),
+# TRACE_ENDPOINT — коллектор OTLP/HTTP, например http://localhost:4318/v1/traces
+TRACE_FILE = os.getenv("TRACE_FILE")
+TRACE_ENDPOINT = os.getenv("TRACE_ENDPOINT")
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "bitrix-assistant")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1"))  # доля событий, попадающих в трассировку
+TRACE_FLUSH_INTERVAL = float(os.getenv("TRACE_FLUSH_INTERVAL", "5"))  # сек
+TRACING_ENABLED = bool(TRACE_FILE or TRACE_ENDPOINT)
 
 # Базовая конфигурация логирования для всего приложения
 logging.basicConfig(level=logging.INFO)
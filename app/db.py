@@ -1,25 +1,166 @@
-from typing import Optional
-from asyncpg import create_pool
+import os
+import logging
+
+from typing import Callable, Dict, List, Optional, Set
+from time import perf_counter, monotonic
+from contextlib import asynccontextmanager
+from asyncpg import create_pool, connect
 
 from config import *
+from tracing import log_query
 
 pool = None  # Глобальная переменная для пула подключений к базе данных
 
+# Таблицы, которые создаёт само приложение (users и notification_settings уже существуют)
+SCHEMA = """
+    CREATE INDEX IF NOT EXISTS users_member_id_idx ON users (member_id);
+
+    CREATE TABLE IF NOT EXISTS portals (
+        domain TEXT PRIMARY KEY,
+        events_registered BOOLEAN NOT NULL DEFAULT FALSE,
+        registered_at TIMESTAMPTZ
+    );
+
+    CREATE TABLE IF NOT EXISTS webhook_jobs (
+        id BIGSERIAL PRIMARY KEY,
+        payload JSONB NOT NULL,
+        attempts INT NOT NULL DEFAULT 0,
+        locked_until TIMESTAMPTZ,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS webhook_jobs_locked_until_idx ON webhook_jobs (locked_until);
+    -- Склейка изменений одной сущности: пока задачу не взяли в работу (attempts = 0),
+    -- новое событие с тем же ключом заменяет её и откладывает available_at
+    ALTER TABLE webhook_jobs ADD COLUMN IF NOT EXISTS coalesce_key TEXT;
+    ALTER TABLE webhook_jobs ADD COLUMN IF NOT EXISTS available_at TIMESTAMPTZ NOT NULL DEFAULT now();
+    CREATE UNIQUE INDEX IF NOT EXISTS webhook_jobs_coalesce_key_idx ON webhook_jobs (coalesce_key) WHERE attempts = 0;
+
+    CREATE TABLE IF NOT EXISTS webhook_dedupe (
+        fingerprint TEXT PRIMARY KEY,
+        expires_at TIMESTAMPTZ NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS fsm_sessions (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT NOT NULL DEFAULT '{}',
+        expires_at TIMESTAMPTZ NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS fsm_sessions_expires_at_idx ON fsm_sessions (expires_at);
+
+    CREATE TABLE IF NOT EXISTS mirror_entities (
+        domain TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        id BIGINT NOT NULL,
+        data TEXT NOT NULL,
+        owner_ids BIGINT[] NOT NULL DEFAULT '{}',
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (domain, kind, id)
+    );
+
+    -- Процесс, который сейчас обновляет токен чата (запрос к OAuth идёт вне транзакции)
+    CREATE TABLE IF NOT EXISTS token_refresh (
+        chat_id BIGINT PRIMARY KEY,
+        lease_until TIMESTAMPTZ NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS catchup_state (
+        domain TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        watermark TEXT,
+        checked_at TIMESTAMPTZ,
+        lease_until TIMESTAMPTZ,
+        PRIMARY KEY (domain, kind)
+    );
+
+    CREATE TABLE IF NOT EXISTS mirror_sync (
+        domain TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        synced_at TIMESTAMPTZ,
+        lease_until TIMESTAMPTZ,
+        items INT,
+        PRIMARY KEY (domain, kind)
+    );
+"""
+
+
+async def _trace_queries(conn):
+    """Спан на каждый запрос соединения пула"""
+    conn.add_query_logger(log_query)
+
 
 class Database:
     _pool = None
 
+    # Статистика загруженности пула
+    _in_use = 0
+    _waiting = 0
+    _acquired_total = 0
+    _wait_time_total = 0.0
+    _wait_time_max = 0.0
+
     @classmethod
     async def get_pool(cls):
         if cls._pool is None:
+            # asyncpg кэширует подготовленные запросы на каждом соединении,
+            # поэтому повторные запросы из пула не парсятся сервером заново
             cls._pool = await create_pool(
                 DATABASE_URL,
-                min_size=5,
-                max_size=20,
-                command_timeout=60
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=DB_POOL_MAX_SIZE,
+                statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+                command_timeout=60,
+                init=_trace_queries if TRACING_ENABLED else None
             )
         return cls._pool
 
+    @classmethod
+    @asynccontextmanager
+    async def acquire(cls):
+        """Берёт соединение из пула, учитывая время ожидания и число занятых соединений"""
+        pool = await cls.get_pool()
+
+        started = perf_counter()
+        cls._waiting += 1
+        try:
+            conn = await pool.acquire()
+        finally:
+            cls._waiting -= 1
+
+        waited = perf_counter() - started
+        cls._acquired_total += 1
+        cls._wait_time_total += waited
+        cls._wait_time_max = max(cls._wait_time_max, waited)
+
+        cls._in_use += 1
+        try:
+            yield conn
+        finally:
+            cls._in_use -= 1
+            await pool.release(conn)
+
+    @classmethod
+    def stats(cls) -> dict:
+        """Метрики насыщения пула соединений"""
+        pool = cls._pool
+        return {
+            "size": pool.get_size() if pool else 0,
+            "idle": pool.get_idle_size() if pool else 0,
+            "max_size": pool.get_max_size() if pool else DB_POOL_MAX_SIZE,
+            "in_use": cls._in_use,
+            "waiting": cls._waiting,
+            "acquired_total": cls._acquired_total,
+            "wait_time_total": round(cls._wait_time_total, 6),
+            "wait_time_avg": round(cls._wait_time_total / cls._acquired_total, 6) if cls._acquired_total else 0.0,
+            "wait_time_max": round(cls._wait_time_max, 6)
+        }
+
+    @classmethod
+    async def init_schema(cls):
+        """Создаёт недостающие таблицы и индексы приложения"""
+        async with cls.acquire() as conn:
+            await conn.execute(SCHEMA)
+
     @classmethod
     async def close(cls):
         if cls._pool:
@@ -27,21 +168,242 @@ class Database:
             cls._pool = None
 
 
+class PgListener:
+    """Выделенное соединение для LISTEN/NOTIFY — связь между процессами приложения"""
+    _conn = None
+    _channels: Dict[str, List[Callable[[str], None]]] = {}
+
+    @classmethod
+    async def listen(cls, channel: str, callback: Callable[[str], None]):
+        """Подписывает callback(payload) на канал"""
+        if cls._conn is None or cls._conn.is_closed():
+            cls._conn = await connect(DATABASE_URL)
+            cls._channels = {}
+
+        if channel not in cls._channels:
+            cls._channels[channel] = []
+            await cls._conn.add_listener(channel, cls._dispatch)
+        cls._channels[channel].append(callback)
+
+    @classmethod
+    def _dispatch(cls, conn, pid, channel, payload):
+        for callback in cls._channels.get(channel, []):
+            try:
+                callback(payload)
+            except Exception as e:
+                logging.error(f"Listener for {channel} failed: {e}")
+
+    @classmethod
+    async def close(cls):
+        if cls._conn is not None and not cls._conn.is_closed():
+            await cls._conn.close()
+        cls._conn = None
+        cls._channels = {}
+
+
+class MemberCache:
+    """Индекс member_id портала → chat_id пользователей.
+
+    Данные живут в таблице users, кэш заполняется лениво и сбрасывается при
+    сохранении и удалении пользователя. TTL нужен, чтобы подхватывать
+    изменения, сделанные другими процессами.
+    """
+    _chats: Dict[str, Set[int]] = {}
+    _loaded_at: Dict[str, float] = {}
+    _member_by_chat: Dict[int, str] = {}
+    hits = 0
+    misses = 0
+
+    @classmethod
+    async def get_chat_ids(cls, member_id: str) -> Set[int]:
+        loaded_at = cls._loaded_at.get(member_id)
+        if loaded_at is not None and monotonic() - loaded_at < MEMBER_CACHE_TTL:
+            cls.hits += 1
+            return cls._chats[member_id]
+        cls.misses += 1
+
+        async with Database.acquire() as conn:
+            rows = await conn.fetch("SELECT chat_id FROM users WHERE member_id = $1", member_id)
+
+        cls.invalidate(member_id)
+        chat_ids = {row["chat_id"] for row in rows}
+        cls._chats[member_id] = chat_ids
+        cls._loaded_at[member_id] = monotonic()
+        for chat_id in chat_ids:
+            cls._member_by_chat[chat_id] = member_id
+        return chat_ids
+
+    @classmethod
+    def invalidate(cls, member_id: Optional[str] = None, chat_id: Optional[int] = None):
+        """Сбрасывает кэш портала (по member_id или по chat_id одного из его пользователей)"""
+        if chat_id is not None:
+            member_id = cls._member_by_chat.get(chat_id, member_id)
+        if member_id is None:
+            return
+        for cached_chat_id in cls._chats.pop(member_id, ()):
+            cls._member_by_chat.pop(cached_chat_id, None)
+        cls._loaded_at.pop(member_id, None)
+
+    @classmethod
+    def clear(cls):
+        cls._chats.clear()
+        cls._loaded_at.clear()
+        cls._member_by_chat.clear()
+
+    @classmethod
+    async def subscribe(cls):
+        """Сброс кэша по уведомлениям других процессов"""
+        await PgListener.listen("member_cache", lambda member_id: cls.invalidate(member_id=member_id))
+
+
+# Настройки уведомлений по умолчанию (как DEFAULT в таблице notification_settings)
+DEFAULT_NOTIFICATION_SETTINGS = {
+    'new_deals': True,
+    'deal_updates': True,
+    'task_creations': True,
+    'task_updates': True,
+    'comments': True
+}
+
+
+class RecipientCache:
+    """Пользователь и его настройки уведомлений по chat_id.
+
+    Для всех чатов портала данные загружаются одним запросом с JOIN. Изменения,
+    сделанные этим процессом, сразу записываются в кэш, остальные процессы
+    получают уведомление через LISTEN/NOTIFY и сбрасывают свою запись.
+    """
+    _entries: Dict[int, tuple] = {}  # chat_id → (время загрузки, пользователь, настройки)
+    hits = 0
+    misses = 0
+
+    @classmethod
+    async def get_many(cls, chat_ids) -> Dict[int, tuple]:
+        """Возвращает {chat_id: (пользователь, настройки)} для найденных пользователей"""
+        now = monotonic()
+        result = {}
+        missing = []
+        for chat_id in chat_ids:
+            chat_id = int(chat_id)
+            entry = cls._entries.get(chat_id)
+            if entry is not None and now - entry[0] < MEMBER_CACHE_TTL:
+                result[chat_id] = (dict(entry[1]), dict(entry[2]))
+            else:
+                missing.append(chat_id)
+
+        cls.hits += len(result)
+        cls.misses += len(missing)
+        if not missing:
+            return result
+
+        async with Database.acquire() as conn:
+            rows = await conn.fetch(f"""
+                SELECT u.*, {", ".join(f"s.{name}" for name in DEFAULT_NOTIFICATION_SETTINGS)}
+                FROM users u
+                LEFT JOIN notification_settings s ON s.chat_id = u.chat_id
+                WHERE u.chat_id = ANY($1::bigint[])
+            """, missing)
+
+        loaded_at = monotonic()
+        for row in rows:
+            user_data = {key: value for key, value in row.items() if key not in DEFAULT_NOTIFICATION_SETTINGS}
+            settings = {
+                name: default if row[name] is None else row[name]
+                for name, default in DEFAULT_NOTIFICATION_SETTINGS.items()
+            }
+            cls._entries[user_data['chat_id']] = (loaded_at, user_data, settings)
+            result[user_data['chat_id']] = (dict(user_data), dict(settings))
+        return result
+
+    @classmethod
+    def update(cls, chat_id: int, user: Optional[dict] = None, settings: Optional[dict] = None):
+        """Записывает изменения в кэш, если чат уже загружен"""
+        entry = cls._entries.get(int(chat_id))
+        if entry is None:
+            return
+        if user:
+            entry[1].update(user)
+        if settings:
+            entry[2].update(settings)
+
+    @classmethod
+    def invalidate(cls, chat_id: int):
+        cls._entries.pop(int(chat_id), None)
+
+    @classmethod
+    def clear(cls):
+        cls._entries.clear()
+
+    @staticmethod
+    async def publish(conn, chat_id: int):
+        """Сообщает другим процессам, что данные чата изменились"""
+        await conn.execute("SELECT pg_notify('recipient_cache', $1)", f"{os.getpid()}:{chat_id}")
+
+    @classmethod
+    def _on_notify(cls, payload: str):
+        pid, _, chat_id = payload.partition(":")
+        # Свои изменения уже записаны в кэш
+        if pid != str(os.getpid()):
+            cls.invalidate(int(chat_id))
+
+    @classmethod
+    async def subscribe(cls):
+        """Сброс кэша по уведомлениям других процессов"""
+        await PgListener.listen("recipient_cache", cls._on_notify)
+
+
+async def get_recipients(chat_ids) -> Dict[int, tuple]:
+    """Пользователи и их настройки уведомлений для списка чатов: {chat_id: (пользователь, настройки)}"""
+    return await RecipientCache.get_many(chat_ids)
+
+
+async def get_member_chat_ids(member_id: str) -> Set[int]:
+    """Возвращает chat_id всех пользователей портала"""
+    return await MemberCache.get_chat_ids(member_id)
+
+
+_registered_domains: Set[str] = set()
+
+
+async def is_events_registered(domain: str) -> bool:
+    """Проверяет, привязаны ли обработчики событий для портала"""
+    if domain in _registered_domains:
+        return True
+    async with Database.acquire() as conn:
+        registered = await conn.fetchval(
+            "SELECT events_registered FROM portals WHERE domain = $1",
+            domain
+        )
+    if registered:
+        _registered_domains.add(domain)
+    return bool(registered)
+
+
+async def mark_events_registered(domain: str):
+    """Запоминает, что обработчики событий портала привязаны"""
+    async with Database.acquire() as conn:
+        await conn.execute("""
+            INSERT INTO portals (domain, events_registered, registered_at)
+            VALUES ($1, TRUE, now())
+            ON CONFLICT (domain) DO UPDATE SET
+                events_registered = TRUE,
+                registered_at = EXCLUDED.registered_at
+        """, domain)
+    _registered_domains.add(domain)
+
+
 async def get_user(chat_id: int) -> Optional[dict]:
     """Получает пользователя из базы данных по chat_id."""
-    pool = await Database.get_pool()
-    async with pool.acquire() as conn:
+    async with Database.acquire() as conn:
         row = await conn.fetchrow("SELECT * FROM users WHERE chat_id = $1", chat_id)
         return dict(row) if row else None
 
 
 async def save_user(user_data: dict):
     """Сохраняет или обновляет данные пользователя в таблице users."""
-    pool = await Database.get_pool()
-
-    async with pool.acquire() as conn:
+    async with Database.acquire() as conn:
         await conn.execute("""
-            INSERT INTO users (chat_id, access_token, refresh_token, expires, domain, 
+            INSERT INTO users (chat_id, access_token, refresh_token, expires, domain,
                              member_id, user_id, user_name, is_admin)
             VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
             ON CONFLICT (chat_id) DO UPDATE SET
@@ -64,13 +426,29 @@ async def save_user(user_data: dict):
                            user_data['user_name'],
                            user_data['is_admin'])
 
+        await conn.execute("SELECT pg_notify('member_cache', $1)", user_data['member_id'])
+        await RecipientCache.publish(conn, user_data['chat_id'])
+
+    # Пользователь мог сменить портал — сбрасываем и старую, и новую запись
+    MemberCache.invalidate(chat_id=user_data['chat_id'])
+    MemberCache.invalidate(member_id=user_data['member_id'])
+    RecipientCache.invalidate(user_data['chat_id'])
+
+
+async def create_notification_settings(chat_id: int):
+    """Создаёт настройки уведомлений по умолчанию, если их ещё нет."""
+    async with Database.acquire() as conn:
+        await conn.execute("""
+            INSERT INTO notification_settings (chat_id)
+            VALUES ($1)
+            ON CONFLICT (chat_id) DO NOTHING
+        """, chat_id)
+
 
 async def get_notification_settings(chat_id: int) -> dict:
     """Получает настройки уведомлений для пользователя.
     Если не существует — создаёт запись с настройками по умолчанию."""
-    pool = await Database.get_pool()
-
-    async with pool.acquire() as conn:
+    async with Database.acquire() as conn:
         row = await conn.fetchrow(
             "SELECT * FROM notification_settings WHERE chat_id = $1",
             chat_id
@@ -84,13 +462,7 @@ async def get_notification_settings(chat_id: int) -> dict:
             "INSERT INTO notification_settings (chat_id) VALUES ($1)",
             chat_id
         )
-        return {
-            'new_deals': True,
-            'deal_updates': True,
-            'task_creations': True,
-            'task_updates': True,
-            'comments': True
-        }
+        return dict(DEFAULT_NOTIFICATION_SETTINGS)
 
 
 async def update_notification_setting(chat_id: int, setting: str, value: bool):
@@ -101,14 +473,29 @@ async def update_notification_setting(chat_id: int, setting: str, value: bool):
         :param setting: Название поля настройки
         :param value: Новое значение (True/False)
         """
-    pool = await Database.get_pool()
-
-    async with pool.acquire() as conn:
+    async with Database.acquire() as conn:
         await conn.execute(
             f"UPDATE notification_settings SET {setting} = $1 WHERE chat_id = $2",
             value,
             chat_id
         )
+        await RecipientCache.publish(conn, chat_id)
+
+    RecipientCache.update(chat_id, settings={setting: value})
+
+
+async def toggle_notification_setting(chat_id: int, setting: str) -> Optional[bool]:
+    """Инвертирует настройку уведомлений и возвращает новое значение"""
+    async with Database.acquire() as conn:
+        value = await conn.fetchval(
+            f"UPDATE notification_settings SET {setting} = NOT {setting} WHERE chat_id = $1 RETURNING {setting}",
+            chat_id
+        )
+        await RecipientCache.publish(conn, chat_id)
+
+    if value is not None:
+        RecipientCache.update(chat_id, settings={setting: value})
+    return value
 
 
 async def delete_user(chat_id: int):
@@ -117,7 +504,11 @@ async def delete_user(chat_id: int):
         Для рефреш токен.
         :param chat_id: Telegram chat ID пользователя
         """
-    pool = await Database.get_pool()
+    async with Database.acquire() as conn:
+        member_id = await conn.fetchval("DELETE FROM users WHERE chat_id = $1 RETURNING member_id", chat_id)
+        if member_id is not None:
+            await conn.execute("SELECT pg_notify('member_cache', $1)", member_id)
+            await RecipientCache.publish(conn, chat_id)
 
-    async with pool.acquire() as conn:
-        await conn.execute("DELETE FROM users WHERE chat_id = $1", chat_id)
+    MemberCache.invalidate(member_id=member_id, chat_id=chat_id)
+    RecipientCache.invalidate(chat_id)
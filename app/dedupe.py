@@ -0,0 +1,79 @@
+import hashlib
+import logging
+
+from config import *
+from db import Database
+from cache import AsyncTTLCache
+from events import BitrixEvent
+
+# Удалять просроченные отпечатки из PostgreSQL раз в столько новых событий
+_CLEANUP_EVERY = 1000
+
+
+def event_fingerprint(event: BitrixEvent) -> str:
+    """Отпечаток события: имя, ID сущности, время отправки и токен приложения портала"""
+    raw = "|".join((
+        event.name,
+        str(event.entity_id or ''),
+        str(event.ts or ''),
+        event.application_token or event.member_id or ''
+    ))
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+class WebhookDedupe:
+    """Индекс уже принятых событий для отсечения повторов Битрикса.
+
+    В памяти процесса хранится ограниченный по размеру и времени жизни набор
+    отпечатков. С DEDUPE_BACKEND=postgres отпечатки дополнительно пишутся
+    в таблицу webhook_dedupe, чтобы повтор, пришедший в другой процесс,
+    тоже был распознан.
+    """
+    _seen = AsyncTTLCache(maxsize=DEDUPE_SIZE, ttl=DEDUPE_TTL)
+    _claims = 0
+    duplicates_total = 0
+
+    @classmethod
+    async def claim(cls, fingerprint: str) -> bool:
+        """Отмечает событие принятым. False — событие уже было принято раньше"""
+        if cls._seen.get(fingerprint):
+            cls.duplicates_total += 1
+            return False
+        cls._seen.set(fingerprint, True)
+
+        if DEDUPE_BACKEND == "postgres":
+            try:
+                if not await cls._claim_shared(fingerprint):
+                    cls.duplicates_total += 1
+                    return False
+            except Exception as e:
+                # Общий индекс недоступен — лучше повторное уведомление, чем потерянное
+                logging.warning(f"Shared dedupe index unavailable: {e}")
+        return True
+
+    @classmethod
+    async def release(cls, fingerprint: str):
+        """Снимает отметку, если событие не удалось поставить в очередь — повтор Битрикса нужен"""
+        cls._seen.invalidate(fingerprint)
+        if DEDUPE_BACKEND == "postgres":
+            try:
+                async with Database.acquire() as conn:
+                    await conn.execute("DELETE FROM webhook_dedupe WHERE fingerprint = $1", fingerprint)
+            except Exception as e:
+                logging.warning(f"Failed to release dedupe fingerprint: {e}")
+
+    @classmethod
+    async def _claim_shared(cls, fingerprint: str) -> bool:
+        async with Database.acquire() as conn:
+            claimed = await conn.fetchval(f"""
+                INSERT INTO webhook_dedupe (fingerprint, expires_at)
+                VALUES ($1, now() + interval '{int(DEDUPE_TTL)} seconds')
+                ON CONFLICT (fingerprint) DO UPDATE SET expires_at = EXCLUDED.expires_at
+                    WHERE webhook_dedupe.expires_at < now()
+                RETURNING fingerprint
+            """, fingerprint)
+
+            cls._claims += 1
+            if cls._claims % _CLEANUP_EVERY == 0:
+                await conn.execute("DELETE FROM webhook_dedupe WHERE expires_at < now()")
+        return claimed is not None
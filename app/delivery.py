@@ -0,0 +1,268 @@
+import heapq
+import asyncio
+import logging
+
+from time import monotonic
+from itertools import count
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
+
+from config import *
+from metrics import WEBHOOK_PHASE_SECONDS, TELEGRAM_MESSAGES
+from tracing import span, current_traceparent, KIND_CLIENT
+
+# Приоритеты сообщений: меньше — важнее
+PRIORITY_HIGH = 0  # ответы на действия пользователя (например, авторизация)
+PRIORITY_NORMAL = 10  # уведомления о событиях
+PRIORITY_LOW = 20  # сводки и догоняющая синхронизация
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity за раз"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        """Сколько секунд ждать до появления токена"""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self._refill()
+        self.tokens -= 1
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+@dataclass(order=True)
+class Outgoing:
+    priority: int
+    seq: int
+    chat_id: int = field(compare=False)
+    text: str = field(compare=False)
+    kwargs: Dict[str, Any] = field(compare=False, default_factory=dict)
+    attempts: int = field(compare=False, default=0)
+    future: Optional[asyncio.Future] = field(compare=False, default=None)
+    trace: Optional[str] = field(compare=False, default=None)  # traceparent события
+
+
+class TelegramDelivery:
+    """Планировщик отправки сообщений в Telegram.
+
+    Сообщения каждого чата уходят по очереди (по приоритету, затем в порядке
+    поступления) с ограничением на чат и на весь бот. На 429 планировщик
+    выжидает retry_after — для чата или, если ограничение общее, для всего
+    бота; сетевые ошибки повторяет с нарастающей паузой —
+    до DELIVERY_MAX_ATTEMPTS попыток.
+    """
+    _bot: Optional[Bot] = None
+    _runner: Optional[asyncio.Task] = None
+    _wakeup: Optional[asyncio.Event] = None
+    _space: Optional[asyncio.Semaphore] = None
+    _seq = count()
+
+    _global: Optional[TokenBucket] = None
+    _chat_buckets: Dict[int, TokenBucket] = {}
+    _pending: Dict[int, List[Outgoing]] = {}  # очередь сообщений каждого чата
+    _paused_until: Dict[int, float] = {}
+    _global_paused_until = 0.0  # пауза всего бота после ограничения, наложенного не на один чат
+    _last_flood: Tuple[int, float] = (0, 0.0)  # (chat_id, до какого времени) — последний 429 на чат
+    _ready: List[Tuple[int, int, int]] = []  # (priority, seq, chat_id) — чаты, готовые к отправке
+    _waiting: List[Tuple[float, int]] = []  # (ready_at, chat_id) — чаты, ждущие своего лимита
+    _active: Set[int] = set()  # чаты в _ready, _waiting или с сообщением в отправке
+    _sending: Set[asyncio.Task] = set()
+
+    # Статистика
+    sent_total = 0
+    failed_total = 0
+    retried_total = 0
+
+    @classmethod
+    def start(cls, bot: Bot):
+        if cls._runner is not None:
+            return
+        cls._bot = bot
+        cls._wakeup = asyncio.Event()
+        cls._space = asyncio.Semaphore(DELIVERY_QUEUE_SIZE)
+        cls._global = TokenBucket(DELIVERY_GLOBAL_RATE, DELIVERY_GLOBAL_BURST)
+        cls._runner = asyncio.create_task(cls._run())
+
+    @classmethod
+    async def send(cls, chat_id: int, text: str, priority: int = PRIORITY_NORMAL, **kwargs) -> asyncio.Future:
+        """Ставит сообщение в очередь. Возвращает future с результатом доставки (True/False).
+
+        Если очередь заполнена, ждёт освобождения места.
+        """
+        if cls._runner is None:
+            raise RuntimeError("TelegramDelivery is not started")
+
+        await cls._space.acquire()
+        chat_id = int(chat_id)
+        item = Outgoing(priority, next(cls._seq), chat_id, text, kwargs,
+                        future=asyncio.get_running_loop().create_future(),
+                        trace=current_traceparent())
+        heapq.heappush(cls._pending.setdefault(chat_id, []), item)
+        cls._schedule(chat_id)
+        return item.future
+
+    @classmethod
+    def depth(cls) -> int:
+        return sum(len(items) for items in cls._pending.values())
+
+    @classmethod
+    def _chat_bucket(cls, chat_id: int) -> TokenBucket:
+        bucket = cls._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = cls._chat_buckets[chat_id] = TokenBucket(DELIVERY_CHAT_RATE, DELIVERY_CHAT_BURST)
+        return bucket
+
+    @classmethod
+    def _schedule(cls, chat_id: int):
+        """Ставит чат в очередь готовых или ожидающих, если у него есть сообщения"""
+        if chat_id in cls._active or not cls._pending.get(chat_id):
+            return
+        cls._active.add(chat_id)
+        now = monotonic()
+        ready_at = max(now + cls._chat_bucket(chat_id).wait_time(), cls._paused_until.get(chat_id, 0))
+        if ready_at <= now:
+            top = cls._pending[chat_id][0]
+            heapq.heappush(cls._ready, (top.priority, top.seq, chat_id))
+        else:
+            heapq.heappush(cls._waiting, (ready_at, chat_id))
+        cls._wakeup.set()
+
+    @classmethod
+    async def _run(cls):
+        while True:
+            now = monotonic()
+            while cls._waiting and cls._waiting[0][0] <= now:
+                _, chat_id = heapq.heappop(cls._waiting)
+                cls._active.discard(chat_id)
+                cls._schedule(chat_id)
+
+            if not cls._ready:
+                timeout = cls._waiting[0][0] - now if cls._waiting else None
+                cls._wakeup.clear()
+                try:
+                    await asyncio.wait_for(cls._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            delay = max(cls._global.wait_time(), cls._global_paused_until - now)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            _, _, chat_id = heapq.heappop(cls._ready)
+            item = heapq.heappop(cls._pending[chat_id])
+            cls._global.consume()
+            cls._chat_bucket(chat_id).consume()
+
+            task = asyncio.create_task(cls._deliver(item))
+            cls._sending.add(task)
+            task.add_done_callback(cls._sending.discard)
+
+    @classmethod
+    async def _deliver(cls, item: Outgoing):
+        chat_id = item.chat_id
+        item.attempts += 1
+        retry_in = None
+        try:
+            trace_span = span("telegram sendMessage", kind=KIND_CLIENT, parent=item.trace, **{
+                "telegram.chat_id": chat_id,
+                "telegram.attempt": item.attempts
+            }) if item.trace else nullcontext()
+            with WEBHOOK_PHASE_SECONDS.time(phase="telegram"), trace_span:
+                await cls._bot.send_message(chat_id, item.text, **item.kwargs)
+            cls._complete(item, True)
+        except TelegramRetryAfter as e:
+            retry_in = e.retry_after
+            if cls._is_bot_wide_limit(chat_id):
+                cls._global_paused_until = max(cls._global_paused_until, monotonic() + retry_in)
+                logging.warning(f"Telegram flood control for the bot, pausing all chats for {retry_in}s")
+            else:
+                cls._last_flood = (chat_id, monotonic() + retry_in)
+                logging.warning(f"Telegram flood control for chat {chat_id}, retry in {retry_in}s")
+        except (TelegramNetworkError, TelegramServerError) as e:
+            retry_in = min(2 ** item.attempts, 60)
+            logging.warning(f"Telegram send to chat {chat_id} failed (attempt {item.attempts}): {e}")
+        except Exception as e:
+            logging.error(f"Failed to send notification to chat {chat_id}: {e}")
+            cls._complete(item, False)
+        finally:
+            if retry_in is not None:
+                if item.attempts < DELIVERY_MAX_ATTEMPTS:
+                    cls.retried_total += 1
+                    TELEGRAM_MESSAGES.inc(outcome="retried")
+                    cls._paused_until[chat_id] = monotonic() + retry_in
+                    heapq.heappush(cls._pending[chat_id], item)
+                else:
+                    logging.error(f"Notification to chat {chat_id} dropped after {item.attempts} attempts")
+                    cls._complete(item, False)
+
+            cls._active.discard(chat_id)
+            cls._schedule(chat_id)
+            cls._cleanup(chat_id)
+
+    @classmethod
+    def _is_bot_wide_limit(cls, chat_id: int) -> bool:
+        """429 относится ко всему боту, а не к чату: общий лимит исчерпан
+        или другой чат ещё ждёт после такого же ответа"""
+        if cls._global.wait_time() > 0:
+            return True
+        other, until = cls._last_flood
+        return other != chat_id and until > monotonic()
+
+    @classmethod
+    def _complete(cls, item: Outgoing, delivered: bool):
+        if delivered:
+            cls.sent_total += 1
+        else:
+            cls.failed_total += 1
+        TELEGRAM_MESSAGES.inc(outcome="sent" if delivered else "failed")
+        if item.future is not None and not item.future.done():
+            item.future.set_result(delivered)
+        cls._space.release()
+
+    @classmethod
+    def _cleanup(cls, chat_id: int):
+        """Удаляет состояние чата, которому больше нечего отправлять"""
+        if cls._pending.get(chat_id) or chat_id in cls._active:
+            return
+        cls._pending.pop(chat_id, None)
+        if cls._paused_until.get(chat_id, 0) <= monotonic():
+            cls._paused_until.pop(chat_id, None)
+            bucket = cls._chat_buckets.get(chat_id)
+            if bucket is not None and bucket.is_full():
+                del cls._chat_buckets[chat_id]
+
+    @classmethod
+    async def stop(cls, timeout: float = DELIVERY_DRAIN_TIMEOUT):
+        """Дожидается отправки сообщений из очереди и останавливает планировщик"""
+        if cls._runner is None:
+            return
+        deadline = monotonic() + timeout
+        while (cls._active or cls._sending) and monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if cls._active:
+            logging.warning(f"Telegram delivery stopped with {cls.depth()} messages undelivered")
+
+        cls._runner.cancel()
+        await asyncio.gather(cls._runner, *cls._sending, return_exceptions=True)
+        cls._runner = None
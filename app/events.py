@@ -0,0 +1,108 @@
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Union
+from urllib.parse import unquote_plus
+
+
+def _unquote(value: str) -> str:
+    # Большинство значений от Битрикса не экранированы — пропускаем декодирование
+    return unquote_plus(value) if "%" in value or "+" in value else value
+
+
+@lru_cache(maxsize=1024)
+def _split_key(raw_key: str) -> tuple:
+    """auth%5Bdomain%5D → ("auth", ("domain",)). Набор ключей у Битрикса постоянный, поэтому разбор кэшируется"""
+    key = _unquote(raw_key)
+    start = key.find("[")
+    if start <= 0 or key[-1] != "]":
+        return key, ()
+    return key[:start], tuple(key[start + 1:-1].split("]["))
+
+
+def _to_list(container: dict) -> Union[dict, list]:
+    """Словарь с ключами 0..n-1 превращается в список, как массивы PHP"""
+    if all(key.isdigit() for key in container):
+        indexes = sorted(container, key=int)
+        if [int(key) for key in indexes] == list(range(len(indexes))):
+            return [container[key] for key in indexes]
+    return container
+
+
+def parse_bracket_body(body: Union[bytes, str]) -> Dict[str, Any]:
+    """Разбор тела application/x-www-form-urlencoded в нотации PHP за один проход.
+
+    a=1&data[FIELDS][ID]=5&list[]=x&list[]=y&arr[0]=p&arr[1]=q →
+    {"a": "1", "data": {"FIELDS": {"ID": "5"}}, "list": ["x", "y"], "arr": ["p", "q"]}
+    """
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", errors="replace")
+
+    result: Dict[str, Any] = {}
+    numeric: List[tuple] = []  # (родитель, ключ) контейнеров с числовыми индексами
+
+    for pair in body.split("&"):
+        if not pair:
+            continue
+        key, _, value = pair.partition("=")
+        name, segments = _split_key(key)
+        value = _unquote(value)
+
+        if not segments:
+            result[name] = value
+            continue
+
+        current = result
+        for segment in segments:
+            node = current.get(name)
+            if not isinstance(node, dict):
+                node = current[name] = {}
+                if segment == "" or segment.isdigit():
+                    numeric.append((current, name))
+            current = node
+            # [] — следующий индекс массива
+            name = str(len(node)) if segment == "" else segment
+
+        current[name] = value
+
+    # Контейнеры с числовыми ключами превращаем в списки — с самых вложенных
+    for parent, name in reversed(numeric):
+        parent[name] = _to_list(parent[name])
+
+    return result
+
+
+@dataclass(slots=True)
+class BitrixEvent:
+    """Событие Битрикс24 из вебхука /callback"""
+    name: str  # имя события в нижнем регистре, например ontaskupdate
+    member_id: Optional[str]
+    domain: Optional[str]
+    application_token: Optional[str]
+    entity_id: Optional[str]  # ID задачи, сделки или комментария
+    task_id: Optional[str]  # для комментариев — ID задачи
+    ts: Optional[str]
+    data: Dict[str, Any] = field(repr=False)  # исходные данные целиком
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "BitrixEvent":
+        auth = data.get("auth") or {}
+        fields = data.get("data") or {}
+        entity = fields.get("FIELDS_AFTER") or fields.get("FIELDS") or {}
+        if not isinstance(auth, dict):
+            auth = {}
+        if not isinstance(entity, dict):
+            entity = {}
+        return cls(
+            name=str(data.get("event", "")).lower(),
+            member_id=auth.get("member_id"),
+            domain=auth.get("domain"),
+            application_token=auth.get("application_token"),
+            entity_id=entity.get("ID"),
+            task_id=entity.get("TASK_ID"),
+            ts=data.get("ts"),
+            data=data
+        )
+
+    @classmethod
+    def from_body(cls, body: Union[bytes, str]) -> "BitrixEvent":
+        return cls.from_dict(parse_bracket_body(body))
@@ -0,0 +1,275 @@
+import os
+import json
+import asyncio
+import logging
+
+from time import time, monotonic
+from typing import Any, Dict, Optional, Set
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType, DefaultKeyBuilder
+
+from config import *
+from db import Database, PgListener
+
+EMPTY_DATA = "{}"
+
+# Удалять просроченные сессии из PostgreSQL не чаще, чем раз в столько секунд
+_CLEANUP_INTERVAL = 600
+# Ограничение на длину уведомления NOTIFY (8000 байт) — ключи отправляются пачками
+_NOTIFY_KEYS = 100
+
+_key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+
+
+def dump_data(data: Dict[str, Any]) -> str:
+    """Компактная сериализация данных диалога"""
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def load_data(raw: Optional[str]) -> Dict[str, Any]:
+    return json.loads(raw) if raw else {}
+
+
+def _state_name(state: StateType) -> Optional[str]:
+    return state.state if isinstance(state, State) else state
+
+
+class _Session:
+    """Состояние и данные диалога. Данные хранятся строкой — get_data всегда отдаёт копию"""
+    __slots__ = ("state", "data", "expires_at", "loaded_at")
+
+    def __init__(self, state: Optional[str] = None, data: str = EMPTY_DATA,
+                 expires_at: float = float("inf"), loaded_at: float = 0.0):
+        self.state = state
+        self.data = data
+        self.expires_at = expires_at
+        self.loaded_at = loaded_at
+
+    def is_empty(self) -> bool:
+        return self.state is None and self.data == EMPTY_DATA
+
+
+class MemoryFSMStorage(BaseStorage):
+    """Состояния диалогов в памяти процесса.
+
+    Замена MemoryStorage из aiogram с удалением брошенных диалогов через
+    FSM_TTL секунд после последнего изменения. Подходит для разработки
+    и одного процесса — при перезапуске состояния теряются.
+    """
+    _SWEEP_EVERY = 1000
+
+    def __init__(self, ttl: int = FSM_TTL):
+        self.ttl = ttl
+        self._sessions: Dict[str, _Session] = {}
+        self._writes = 0
+
+    async def _load(self, key: str) -> Optional[_Session]:
+        session = self._sessions.get(key)
+        if session is not None and session.expires_at <= time():
+            del self._sessions[key]
+            return None
+        return session
+
+    def _store(self, key: str, session: _Session):
+        session.expires_at = time() + self.ttl
+        if session.is_empty():
+            self._sessions.pop(key, None)
+        else:
+            self._sessions[key] = session
+
+        self._writes += 1
+        if self._writes % self._SWEEP_EVERY == 0:
+            self._sweep()
+
+    def _sweep(self):
+        now = time()
+        for key in [key for key, session in self._sessions.items() if session.expires_at <= now]:
+            del self._sessions[key]
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = _key_builder.build(key)
+        session = await self._load(storage_key) or _Session()
+        session.state = _state_name(state)
+        self._store(storage_key, session)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        session = await self._load(_key_builder.build(key))
+        return session.state if session else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        storage_key = _key_builder.build(key)
+        session = await self._load(storage_key) or _Session()
+        session.data = dump_data(data)
+        self._store(storage_key, session)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        session = await self._load(_key_builder.build(key))
+        return load_data(session.data) if session else {}
+
+    async def close(self) -> None:
+        pass
+
+
+class PostgresFSMStorage(MemoryFSMStorage):
+    """Состояния диалогов в таблице fsm_sessions — переживают перезапуск и общие для всех процессов бота.
+
+    Сессии кэшируются в памяти процесса (в том числе отсутствие сессии, чтобы
+    обычные сообщения не ходили в базу). Изменения записываются в PostgreSQL
+    пачкой раз в FSM_FLUSH_INTERVAL секунд (write-behind), после чего другие
+    процессы получают NOTIFY fsm_sessions и сбрасывают свою копию. С
+    write_through (FSM_WRITE_THROUGH) set_state и set_data возвращаются только
+    после записи — так состояние сразу видно обработчикам в других процессах.
+    """
+
+    def __init__(self, ttl: int = FSM_TTL, flush_interval: float = FSM_FLUSH_INTERVAL,
+                 cache_ttl: float = FSM_CACHE_TTL, write_through: bool = FSM_WRITE_THROUGH):
+        super().__init__(ttl)
+        self.flush_interval = flush_interval
+        self.cache_ttl = cache_ttl
+        self.write_through = write_through
+        self._dirty: Set[str] = set()
+        self._flusher: Optional[asyncio.Task] = None
+        self._subscribed = False
+        self._cleaned_at = monotonic()
+
+    async def _load(self, key: str) -> Optional[_Session]:
+        now = time()
+        session = self._sessions.get(key)
+        if session is None or (key not in self._dirty and now - session.loaded_at >= self.cache_ttl):
+            await self._subscribe()
+            async with Database.acquire() as conn:
+                row = await conn.fetchrow("""
+                    SELECT state, data, EXTRACT(EPOCH FROM expires_at)::float8 AS expires_at
+                    FROM fsm_sessions
+                    WHERE key = $1 AND expires_at > now()
+                """, key)
+
+            # Пока шёл запрос, сессию мог изменить этот же процесс — его версия новее
+            if key in self._dirty:
+                session = self._sessions[key]
+            else:
+                session = _Session(row["state"], row["data"], row["expires_at"]) if row else _Session()
+                session.loaded_at = time()
+                self._sessions[key] = session
+
+        if session.is_empty() or session.expires_at <= now:
+            return None
+        return session
+
+    def _store(self, key: str, session: _Session):
+        session.expires_at = time() + self.ttl
+        session.loaded_at = time()
+        # Пустая сессия остаётся в кэше как «диалога нет», а из базы удаляется
+        self._sessions[key] = session
+        self._dirty.add(key)
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._run())
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await super().set_state(key, state)
+        if self.write_through:
+            await self.flush()
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await super().set_data(key, data)
+        if self.write_through:
+            await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            self._evict()
+            if monotonic() - self._cleaned_at > _CLEANUP_INTERVAL:
+                await self._cleanup()
+            if not self._dirty and not self._sessions:
+                return
+
+    async def flush(self):
+        """Записывает изменённые сессии в PostgreSQL"""
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+
+        upserts, deletes = [], []
+        for key in keys:
+            session = self._sessions.get(key)
+            if session is None or session.is_empty():
+                deletes.append(key)
+            else:
+                upserts.append((key, session.state, session.data, session.expires_at))
+
+        try:
+            async with Database.acquire() as conn:
+                async with conn.transaction():
+                    if upserts:
+                        await conn.executemany("""
+                            INSERT INTO fsm_sessions (key, state, data, expires_at)
+                            VALUES ($1, $2, $3, to_timestamp($4))
+                            ON CONFLICT (key) DO UPDATE SET
+                                state = EXCLUDED.state,
+                                data = EXCLUDED.data,
+                                expires_at = EXCLUDED.expires_at
+                        """, upserts)
+                    if deletes:
+                        await conn.execute("DELETE FROM fsm_sessions WHERE key = ANY($1::text[])", deletes)
+
+                    keys = list(keys)
+                    for i in range(0, len(keys), _NOTIFY_KEYS):
+                        await conn.execute(
+                            "SELECT pg_notify('fsm_sessions', $1)",
+                            f"{os.getpid()}:" + "\n".join(keys[i:i + _NOTIFY_KEYS])
+                        )
+        except Exception as e:
+            logging.error(f"FSM flush of {len(keys)} sessions failed: {e}")
+            # Повторим при следующей записи; более новые изменения уже в _dirty
+            self._dirty.update(keys)
+
+    def _evict(self):
+        """Убирает из памяти давно не использованные сессии (в базе они остаются)"""
+        now = time()
+        for key in [
+            key for key, session in self._sessions.items()
+            if key not in self._dirty and now - session.loaded_at >= self.cache_ttl
+        ]:
+            del self._sessions[key]
+
+    async def _cleanup(self):
+        self._cleaned_at = monotonic()
+        try:
+            async with Database.acquire() as conn:
+                await conn.execute("DELETE FROM fsm_sessions WHERE expires_at < now()")
+        except Exception as e:
+            logging.warning(f"FSM cleanup failed: {e}")
+
+    async def _subscribe(self):
+        if not self._subscribed:
+            self._subscribed = True
+            await PgListener.listen("fsm_sessions", self._on_notify)
+
+    def _on_notify(self, payload: str):
+        pid, _, keys = payload.partition(":")
+        # Свои изменения уже в кэше
+        if pid == str(os.getpid()):
+            return
+        for key in keys.split("\n"):
+            if key not in self._dirty:
+                self._sessions.pop(key, None)
+
+    async def close(self) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush()
+
+
+def create_fsm_storage() -> BaseStorage:
+    """Хранилище состояний по настройке FSM_STORAGE"""
+    if FSM_STORAGE == "postgres":
+        return PostgresFSMStorage()
+    return MemoryFSMStorage()
@@ -1,23 +1,75 @@
+import sys
 import asyncio
 import uvicorn
 from api import app
 from bot import dp, bot
-from db import Database
+from config import RUN_MODE, API_HOST, API_PORT, API_WORKERS, TELEGRAM_MODE
+from db import Database, MemberCache, RecipientCache, PgListener
+from bitrix import BitrixClient
+from tokens import TokenManager
+from mirror import EntityMirror
+from tracing import SpanExporter
 
 
-async def main():
-    await Database.get_pool()
-
+async def run_all():
+    """API и поллинг Telegram в одном процессе"""
     # Конфигурируем и запускаем uvicorn — ASGI сервер для FastAPI
-    config = uvicorn.Config(app=app, host="0.0.0.0", port=5000, log_level="info")
+    config = uvicorn.Config(app=app, host=API_HOST, port=API_PORT, log_level="info")
     server = uvicorn.Server(config)
 
-    # Параллельно запускаем FastAPI (uvicorn) и поллинг Telegram-бота
-    await asyncio.gather(server.serve(), dp.start_polling(bot))
+    try:
+        if TELEGRAM_MODE == "webhook":
+            # Обновления Telegram принимает сам API (маршрут TELEGRAM_WEBHOOK_PATH)
+            await server.serve()
+        else:
+            # Параллельно запускаем FastAPI (uvicorn) и поллинг Telegram-бота
+            await asyncio.gather(server.serve(), start_polling())
+    finally:
+        # Пулы API закрываются в lifespan, здесь — то, что мог открыть бот после остановки API
+        await BitrixClient.close()
+        await Database.close()
+
 
+async def start_polling():
+    """Поллинг Telegram. Оставшийся от режима webhook вебхук снимается — иначе getUpdates не работает"""
+    await bot.delete_webhook()
+    await dp.start_polling(bot)
+
+
+async def run_bot():
+    """Только поллинг Telegram — приём вебхуков работает в отдельных процессах"""
+    await Database.get_pool()
+    await Database.init_schema()
+    await MemberCache.subscribe()
+    await RecipientCache.subscribe()
+    await EntityMirror.subscribe()
+    TokenManager.start()
+    SpanExporter.start()
 
-if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        await start_polling()
     finally:
-        asyncio.run(Database.close())
\ No newline at end of file
+        await TokenManager.stop()
+        await BitrixClient.close()
+        await PgListener.close()
+        await Database.close()
+        await SpanExporter.stop()
+
+
+def main():
+    mode = sys.argv[1] if len(sys.argv) > 1 else RUN_MODE
+
+    if mode == "api":
+        # Несколько процессов uvicorn, каждый со своим lifespan (пулы и обработчики очереди).
+        # Процессы делят нагрузку через PostgreSQL (WEBHOOK_QUEUE_BACKEND=postgres).
+        uvicorn.run("api:app", host=API_HOST, port=API_PORT, workers=API_WORKERS, log_level="info")
+    elif mode == "bot":
+        if TELEGRAM_MODE == "webhook":
+            sys.exit("TELEGRAM_MODE=webhook: обновления Telegram принимают процессы API, режим bot не нужен")
+        asyncio.run(run_bot())
+    else:
+        asyncio.run(run_all())
+
+
+if __name__ == "__main__":
+    main()
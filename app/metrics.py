@@ -0,0 +1,211 @@
+from time import perf_counter
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Границы корзин гистограмм по умолчанию, в секундах
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry: List["Metric"] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Метрика с набором меток. Значения хранятся по кортежу значений меток"""
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Монотонно растущий счётчик"""
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def inc_to(self, total: float, **labels):
+        """Доводит счётчик до total — для счётов, которые ведутся в другом месте (пул, кэши)"""
+        key = self._key(labels)
+        self._values[key] = max(self._values.get(key, 0), total)
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Gauge(Metric):
+    """Текущее значение (размер очереди, занятые соединения и т. п.)"""
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple, float] = {}
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Histogram(Metric):
+    """Распределение длительностей по корзинам"""
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # ключ меток → [счётчики корзин, сумма, количество]
+        self._values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        data = self._values.get(key)
+        if data is None:
+            data = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                data[0][i] += 1
+                break
+        data[1] += value
+        data[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Замер длительности блока: with HISTOGRAM.time(phase="db"): ..."""
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - started, **labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+def render_metrics() -> str:
+    """Все метрики процесса в текстовом формате Prometheus"""
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+# Известные события Битрикса; остальные считаются под меткой other
+KNOWN_EVENTS = {
+    "ontaskadd", "ontaskupdate", "ontaskdelete", "ontaskcommentadd",
+    "oncrmdealadd", "oncrmdealupdate", "oncrmdealdelete"
+}
+
+
+def event_label(event: Optional[str]) -> str:
+    event = (event or "").lower()
+    return event if event in KNOWN_EVENTS else "other"
+
+
+# --- Метрики приложения ---
+WEBHOOK_PHASE_SECONDS = Histogram(
+    "webhook_phase_seconds",
+    "Время обработки вебхука по этапам: parse, db, token, bitrix, render, telegram",
+    ("phase",)
+)
+WEBHOOK_PROCESSING_SECONDS = Histogram(
+    "webhook_processing_seconds",
+    "Полное время обработки события из очереди",
+    ("event",)
+)
+WEBHOOK_EVENTS = Counter(
+    "webhook_events_total",
+    "События Битрикса по типу и результату обработки",
+    ("event", "outcome")
+)
+BITRIX_REQUEST_SECONDS = Histogram(
+    "bitrix_request_seconds",
+    "Длительность запросов к REST Битрикс24",
+    ("method", "domain")
+)
+BITRIX_REQUESTS = Counter(
+    "bitrix_requests_total",
+    "Запросы к REST Битрикс24 по методу, домену и HTTP-статусу",
+    ("method", "domain", "status")
+)
+BITRIX_THROTTLED = Counter(
+    "bitrix_throttled_total",
+    "Отказы портала из-за лимитов: query_limit — QUERY_LIMIT_EXCEEDED, operating_time — OPERATION_TIME_LIMIT, "
+    "deferred — запрос отложен целиком (BitrixRetryLater)",
+    ("domain", "reason")
+)
+BITRIX_WAIT_SECONDS = Histogram(
+    "bitrix_rate_wait_seconds",
+    "Ожидание в очереди ограничителя запросов к порталу",
+    ("domain",),
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+)
+TELEGRAM_MESSAGES = Counter(
+    "telegram_messages_total",
+    "Попытки отправки сообщений в Telegram по результату",
+    ("outcome",)
+)
+TELEGRAM_UPDATES = Counter(
+    "telegram_updates_total",
+    "Обновления Telegram, принятые через вебхук, по результату",
+    ("outcome",)
+)
+CATCHUP_CHANGES = Counter(
+    "catchup_changes_total",
+    "Изменения, найденные догоняющей синхронизацией: seen — уже обработаны, queued — поставлены в очередь",
+    ("kind", "outcome")
+)
+DB_POOL = Gauge("db_pool_connections", "Соединения пула PostgreSQL по состоянию", ("state",))
+DB_POOL_WAIT_SECONDS = Counter("db_pool_wait_seconds_total", "Суммарное ожидание свободного соединения")
+QUEUE_DEPTH = Gauge("queue_depth", "Размер внутренних очередей", ("queue",))
+CACHE_REQUESTS = Counter("cache_requests_total", "Обращения к кэшам по результату", ("cache", "result"))
+CACHE_HIT_RATIO = Gauge("cache_hit_ratio", "Доля попаданий в кэш", ("cache",))
@@ -0,0 +1,312 @@
+import os
+import json
+import asyncio
+import logging
+
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from config import *
+from db import *
+from bitrix import *
+from cache import AsyncTTLCache
+from tokens import TokenManager
+
+_UPSERT = """
+    INSERT INTO mirror_entities (domain, kind, id, data, owner_ids, updated_at)
+    VALUES ($1, $2, $3, $4, $5::bigint[], now())
+    ON CONFLICT (domain, kind, id) DO UPDATE SET
+        data = EXCLUDED.data,
+        owner_ids = EXCLUDED.owner_ids,
+        updated_at = now()
+"""
+
+def _ids(*values) -> List[int]:
+    """ID сотрудников из полей сущности (числа, строки и списки) без пустых значений"""
+    result = set()
+    for value in values:
+        for item in value if isinstance(value, (list, tuple)) else (value,):
+            if item not in (None, "", "0", 0):
+                try:
+                    result.add(int(item))
+                except (TypeError, ValueError):
+                    pass
+    return sorted(result)
+
+
+class EntityMirror:
+    """Локальная копия задач или сделок порталов в таблице mirror_entities.
+
+    Начальное наполнение — постраничная выгрузка списочным методом (sync),
+    дальше копию поддерживают вебхуки: загруженная при уведомлении сущность
+    записывается через put, удалённая — убирается через delete. Горячие
+    записи держатся в памяти процесса; изменения рассылаются другим
+    процессам через NOTIFY entity_mirror.
+
+    Списки отдаются из копии, только когда портал выгружен целиком
+    (is_ready); отдельную сущность можно брать из копии всегда — при
+    промахе вызывающий код идёт в Битрикс.
+    """
+    _instances: Dict[str, "EntityMirror"] = {}
+    _subscribed = False
+
+    def __init__(self, kind: str, list_method: str, select: Tuple[str, ...], fields: Tuple[str, ...],
+                 id_field: str, owners: Callable[[dict], List[int]], sync_start: int = 0):
+        self.kind = kind
+        self.list_method = list_method
+        self.select = list(select)
+        self.fields = fields
+        self.id_field = id_field
+        self.owners = owners
+        # start=-1 отключает подсчёт total — быстрее на больших порталах (только для crm.*.list)
+        self.sync_start = sync_start
+        # (domain, id) → сущность или None
+        self.hot = AsyncTTLCache(maxsize=MIRROR_HOT_SIZE, ttl=MIRROR_HOT_TTL)
+        self._ready: Set[str] = set()
+        self._syncing: Set[str] = set()
+        self._instances[kind] = self
+
+    def _compact(self, item: dict) -> dict:
+        return {key: item[key] for key in self.fields if key in item}
+
+    def _row(self, domain: str, item: dict) -> tuple:
+        item = self._compact(item)
+        data = json.dumps(item, ensure_ascii=False, separators=(",", ":"), default=str)
+        return domain, self.kind, int(item[self.id_field]), data, self.owners(item)
+
+    # --- Чтение ---
+    async def get(self, domain: str, entity_id) -> Optional[dict]:
+        """Сущность из копии или None, если её там нет (тогда вызывающий идёт в Битрикс)"""
+        if not MIRROR_ENABLED:
+            return None
+        try:
+            item = await self.hot.get_or_load((domain, int(entity_id)), lambda: self._load(domain, int(entity_id)))
+        except Exception as e:
+            logging.warning(f"Mirror lookup of {self.kind} {entity_id} failed: {e}")
+            return None
+        return dict(item) if item is not None else None
+
+    async def _load(self, domain: str, entity_id: int) -> Optional[dict]:
+        async with Database.acquire() as conn:
+            data = await conn.fetchval(
+                "SELECT data FROM mirror_entities WHERE domain = $1 AND kind = $2 AND id = $3",
+                domain, self.kind, entity_id
+            )
+        return json.loads(data) if data else None
+
+    async def list(self, domain: str, owner_id: Optional[int], offset: int, limit: int) -> Tuple[list, int]:
+        """Страница копии, новые сверху: (записи, всего). owner_id — только сущности этого сотрудника"""
+        async with Database.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT data, count(*) OVER () AS total
+                FROM mirror_entities
+                WHERE domain = $1 AND kind = $2 AND ($3::bigint IS NULL OR $3 = ANY(owner_ids))
+                ORDER BY id DESC
+                OFFSET $4 LIMIT $5
+            """, domain, self.kind, owner_id, offset, limit)
+        if not rows:
+            return [], 0
+        return [json.loads(row["data"]) for row in rows], rows[0]["total"]
+
+    async def is_ready(self, domain: str) -> bool:
+        """Выгружен ли портал целиком (только тогда копии можно доверить списки)"""
+        if not MIRROR_ENABLED:
+            return False
+        if domain in self._ready:
+            return True
+        async with Database.acquire() as conn:
+            synced = await conn.fetchval(
+                "SELECT synced_at IS NOT NULL FROM mirror_sync WHERE domain = $1 AND kind = $2",
+                domain, self.kind
+            )
+        if synced:
+            self._ready.add(domain)
+        return bool(synced)
+
+    # --- Запись ---
+    async def put(self, domain: str, item: dict):
+        """Записывает свежую версию сущности (из вебхука или запроса к Битриксу).
+        Ошибки только логируются — копия не должна мешать уведомлениям."""
+        if not MIRROR_ENABLED or not item or not item.get(self.id_field):
+            return
+        try:
+            row = self._row(domain, item)
+            async with Database.acquire() as conn:
+                await conn.execute(_UPSERT, *row)
+                await self.publish(conn, domain, row[2])
+            self.hot.set((domain, row[2]), json.loads(row[3]))
+        except Exception as e:
+            logging.warning(f"Failed to mirror {self.kind} {item.get(self.id_field)} of {domain}: {e}")
+
+    async def delete(self, domain: str, entity_id):
+        if not MIRROR_ENABLED or not entity_id:
+            return
+        try:
+            async with Database.acquire() as conn:
+                await conn.execute(
+                    "DELETE FROM mirror_entities WHERE domain = $1 AND kind = $2 AND id = $3",
+                    domain, self.kind, int(entity_id)
+                )
+                await self.publish(conn, domain, int(entity_id))
+            self.hot.set((domain, int(entity_id)), None)
+        except Exception as e:
+            logging.warning(f"Failed to remove {self.kind} {entity_id} of {domain} from mirror: {e}")
+
+    async def sync(self, domain: str, access_token: str) -> Optional[int]:
+        """Полная выгрузка сущностей портала постранично по возрастанию ID.
+
+        Возвращает число выгруженных записей или None, если выгрузку этого
+        портала уже ведёт другой процесс. Записи, которых больше нет в
+        Битриксе, удаляются из копии в конце.
+        """
+        async with Database.acquire() as conn:
+            started_at = await conn.fetchval("""
+                INSERT INTO mirror_sync (domain, kind, lease_until)
+                VALUES ($1, $2, now() + make_interval(secs => $3))
+                ON CONFLICT (domain, kind) DO UPDATE SET lease_until = EXCLUDED.lease_until
+                WHERE mirror_sync.lease_until IS NULL OR mirror_sync.lease_until < now()
+                RETURNING now()
+            """, domain, self.kind, MIRROR_SYNC_LEASE)
+        if started_at is None:
+            return None
+
+        count, last_id = 0, 0
+        try:
+            while True:
+                result, _, _ = await BitrixClient.list_page(domain, access_token, self.list_method, {
+                    "order": {"ID": "ASC"},
+                    "filter": {">ID": last_id},
+                    "select": self.select
+                }, self.sync_start)
+                # tasks.task.list оборачивает список в {"tasks": [...]}
+                items = result.get('tasks', []) if isinstance(result, dict) else (result or [])
+                items = [item for item in items if item.get(self.id_field)]
+                if not items:
+                    break
+
+                async with Database.acquire() as conn:
+                    await conn.executemany(_UPSERT, [self._row(domain, item) for item in items])
+                count += len(items)
+                last_id = max(int(item[self.id_field]) for item in items)
+                if len(items) < LIST_LIMIT:
+                    break
+
+            async with Database.acquire() as conn:
+                async with conn.transaction():
+                    # Не попавшие в выгрузку и не обновлённые вебхуками за это время — удалены в Битриксе
+                    await conn.execute("""
+                        DELETE FROM mirror_entities
+                        WHERE domain = $1 AND kind = $2 AND updated_at < $3
+                    """, domain, self.kind, started_at)
+                    await conn.execute("""
+                        UPDATE mirror_sync SET synced_at = now(), lease_until = NULL, items = $3
+                        WHERE domain = $1 AND kind = $2
+                    """, domain, self.kind, count)
+                    await self.publish(conn, domain, "*")
+        except Exception:
+            async with Database.acquire() as conn:
+                await conn.execute(
+                    "UPDATE mirror_sync SET lease_until = NULL WHERE domain = $1 AND kind = $2",
+                    domain, self.kind
+                )
+            raise
+
+        self.hot.invalidate_where(lambda key: key[0] == domain)
+        self._ready.add(domain)
+        logging.info(f"Mirrored {count} {self.kind} entities of {domain}")
+        return count
+
+    def ensure_synced(self, domain: str):
+        """Запускает выгрузку портала в фоне, если она ещё не выполнялась"""
+        if not MIRROR_ENABLED or domain in self._ready or domain in self._syncing:
+            return
+        self._syncing.add(domain)
+        task = asyncio.create_task(self._sync_portal(domain))
+        task.add_done_callback(lambda _: self._syncing.discard(domain))
+
+    async def _sync_portal(self, domain: str):
+        try:
+            if await self.is_ready(domain):
+                return
+            user_data = await portal_admin(domain)
+            if user_data is None:
+                # Токен обычного сотрудника видит не всё — списки остаются в Битриксе
+                logging.info(f"No admin token for {domain}, {self.kind} mirror is not synced")
+                return
+            await self.sync(domain, user_data["access_token"])
+        except Exception as e:
+            logging.error(f"Mirror sync of {self.kind} for {domain} failed: {e}")
+
+    # --- Другие процессы ---
+    async def publish(self, conn, domain: str, entity_id):
+        await conn.execute(
+            "SELECT pg_notify('entity_mirror', $1)",
+            f"{os.getpid()}:{self.kind}:{entity_id}:{domain}"
+        )
+
+    @classmethod
+    def _on_notify(cls, payload: str):
+        pid, kind, entity_id, domain = payload.split(":", 3)
+        mirror = cls._instances.get(kind)
+        # Свои изменения уже в памяти
+        if mirror is None or pid == str(os.getpid()):
+            return
+        if entity_id == "*":
+            mirror.hot.invalidate_where(lambda key: key[0] == domain)
+            mirror._ready.add(domain)
+        else:
+            mirror.hot.invalidate((domain, int(entity_id)))
+
+    @classmethod
+    async def subscribe(cls):
+        """Сброс горячих записей по уведомлениям других процессов"""
+        if MIRROR_ENABLED and not cls._subscribed:
+            cls._subscribed = True
+            await PgListener.listen("entity_mirror", cls._on_notify)
+
+
+async def portal_admin(domain: str) -> Optional[dict]:
+    """Администратор портала с действующим токеном — его токен видит все задачи и сделки"""
+    async with Database.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT * FROM users WHERE domain = $1 AND is_admin ORDER BY expires DESC",
+            domain
+        )
+    for row in rows:
+        user_data = await TokenManager.get_valid_user(row["chat_id"], dict(row))
+        if user_data:
+            return user_data
+    return None
+
+
+def sync_portal(domain: str):
+    """Фоновая выгрузка задач и сделок портала (после авторизации администратора)"""
+    for mirror in (task_mirror, deal_mirror):
+        mirror.ensure_synced(domain)
+
+
+task_mirror = EntityMirror(
+    "task",
+    "tasks.task.list",
+    select=("ID", "TITLE", "DESCRIPTION", "PRIORITY", "STATUS", "RESPONSIBLE_ID", "CREATED_BY",
+            "CHANGED_BY", "DEADLINE", "ACCOMPLICES", "AUDITORS", "CREATED_DATE", "CHANGED_DATE"),
+    fields=("id", "title", "description", "priority", "status", "responsibleId", "createdBy", "creatorId",
+            "changedBy", "deadline", "accomplices", "auditors", "creator", "responsible",
+            "createdDate", "changedDate"),
+    id_field="id",
+    # Участники задачи. Задачу видят и другие (руководители, рабочие группы),
+    # поэтому /tasks не-администратора по ним не строится — его отдаёт Битрикс
+    owners=lambda task: _ids(task.get("responsibleId"), task.get("createdBy"),
+                             task.get("accomplices"), task.get("auditors"))
+)
+
+deal_mirror = EntityMirror(
+    "deal",
+    "crm.deal.list",
+    select=("ID", "TITLE", "COMMENTS", "STAGE_ID", "CATEGORY_ID", "ASSIGNED_BY_ID", "MODIFY_BY_ID",
+            "DATE_CREATE", "DATE_MODIFY"),
+    fields=("ID", "TITLE", "COMMENTS", "STAGE_ID", "CATEGORY_ID", "ASSIGNED_BY_ID", "MODIFY_BY_ID",
+            "DATE_CREATE", "DATE_MODIFY"),
+    id_field="ID",
+    owners=lambda deal: _ids(deal.get("ASSIGNED_BY_ID")),
+    sync_start=-1
+)
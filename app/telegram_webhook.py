@@ -0,0 +1,144 @@
+import hmac
+import asyncio
+import hashlib
+import logging
+
+from contextlib import nullcontext
+from time import monotonic
+from typing import Optional, Set
+from weakref import WeakValueDictionary
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from config import *
+from metrics import TELEGRAM_UPDATES
+
+
+def webhook_secret() -> str:
+    """Секрет вебхука: из TELEGRAM_WEBHOOK_SECRET или производный от токена бота (одинаковый во всех процессах)"""
+    if TELEGRAM_WEBHOOK_SECRET:
+        return TELEGRAM_WEBHOOK_SECRET
+    return hashlib.sha256(f"telegram-webhook:{TELEGRAM_TOKEN}".encode()).hexdigest()
+
+
+def webhook_url() -> str:
+    return TELEGRAM_WEBHOOK_URL or f"{WEBHOOK_DOMAIN}{TELEGRAM_WEBHOOK_PATH}"
+
+
+def update_chat_id(update: Update) -> Optional[int]:
+    """Чат, к которому относится обновление (для нажатия кнопки — чат сообщения с ней)"""
+    event = update.event
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, "from_user", None)
+    return user.id if user is not None else None
+
+
+class TelegramWebhook:
+    """Приём обновлений Telegram через вебхук в процессе API.
+
+    Каждое обновление обрабатывается отдельной задачей через dp.feed_update,
+    одновременно не больше TELEGRAM_WEBHOOK_CONCURRENCY — дальше запрос
+    Telegram ждёт освобождения места. Так приём команд масштабируется
+    вместе с процессами uvicorn, которые обрабатывают /callback.
+
+    Обновления одного чата обрабатываются по очереди, в порядке приёма —
+    как при поллинге, иначе два быстрых ответа в мастере читали бы одно и то же
+    состояние FSM.
+    """
+    _bot: Optional[Bot] = None
+    _dp: Optional[Dispatcher] = None
+    _secret: str = ""
+    _slots: Optional[asyncio.Semaphore] = None
+    _tasks: Set[asyncio.Task] = set()
+    # Блокировка живёт, пока её держат или ждут
+    _chat_locks: "WeakValueDictionary[int, asyncio.Lock]" = WeakValueDictionary()
+
+    @classmethod
+    async def start(cls, bot: Bot, dp: Dispatcher):
+        if cls._bot is not None:
+            return
+        cls._bot = bot
+        cls._dp = dp
+        cls._secret = webhook_secret()
+        cls._slots = asyncio.Semaphore(TELEGRAM_WEBHOOK_CONCURRENCY)
+        await dp.emit_startup(bot=bot, **cls._workflow_data())
+
+        # Все процессы регистрируют один и тот же адрес — повторная установка безвредна
+        try:
+            await bot.set_webhook(
+                url=webhook_url(),
+                secret_token=cls._secret,
+                allowed_updates=dp.resolve_used_update_types(),
+                max_connections=TELEGRAM_WEBHOOK_MAX_CONNECTIONS
+            )
+            logging.info(f"Telegram webhook set to {webhook_url()}")
+        except Exception as e:
+            logging.error(f"Failed to set Telegram webhook {webhook_url()}: {e}")
+
+    @classmethod
+    def _workflow_data(cls) -> dict:
+        """Те же данные, что передаёт обработчикам startup/shutdown dp.start_polling"""
+        data = {"dispatcher": cls._dp, "bots": [cls._bot], **cls._dp.workflow_data}
+        data.pop("bot", None)
+        return data
+
+    @classmethod
+    def check_secret(cls, token: Optional[str]) -> bool:
+        return token is not None and hmac.compare_digest(token, cls._secret)
+
+    @classmethod
+    async def feed(cls, data: dict):
+        """Принимает обновление и запускает его обработку, не дожидаясь ответа обработчиков"""
+        if cls._bot is None:
+            raise RuntimeError("TelegramWebhook is not started")
+
+        update = Update.model_validate(data, context={"bot": cls._bot})
+        lock = None
+        chat_id = update_chat_id(update)
+        if chat_id is not None:
+            lock = cls._chat_locks.get(chat_id)
+            if lock is None:
+                lock = cls._chat_locks[chat_id] = asyncio.Lock()
+
+        await cls._slots.acquire()
+        # Задачи запускаются в порядке создания, asyncio.Lock отдаётся по очереди ожидания
+        task = asyncio.create_task(cls._process(update, lock))
+        cls._tasks.add(task)
+        task.add_done_callback(cls._tasks.discard)
+
+    @classmethod
+    async def _process(cls, update: Update, lock: Optional[asyncio.Lock]):
+        try:
+            async with lock or nullcontext():
+                await cls._dp.feed_update(cls._bot, update)
+            TELEGRAM_UPDATES.inc(outcome="processed")
+        except Exception as e:
+            TELEGRAM_UPDATES.inc(outcome="error")
+            logging.exception(f"Failed to process Telegram update {update.update_id}: {e}")
+        finally:
+            cls._slots.release()
+
+    @classmethod
+    def depth(cls) -> int:
+        return len(cls._tasks)
+
+    @classmethod
+    async def stop(cls, timeout: float = WEBHOOK_DRAIN_TIMEOUT):
+        """Дожидается обработки принятых обновлений. Вебхук не снимается — его обслуживают другие процессы"""
+        if cls._bot is None:
+            return
+        deadline = monotonic() + timeout
+        while cls._tasks and monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if cls._tasks:
+            logging.warning(f"Telegram webhook stopped with {len(cls._tasks)} updates in progress")
+            for task in list(cls._tasks):
+                task.cancel()
+            await asyncio.gather(*cls._tasks, return_exceptions=True)
+
+        await cls._dp.emit_shutdown(bot=cls._bot, **cls._workflow_data())
+        cls._bot = None
+        cls._dp = None
@@ -0,0 +1,189 @@
+import asyncio
+import httpx
+import logging
+
+from time import time, monotonic
+from typing import Optional, Tuple
+from weakref import WeakValueDictionary
+
+from config import *
+from db import *
+from bitrix import *
+
+# Сколько держится аренда обновления токена: дольше запрос к OAuth не идёт (таймаут клиента)
+_REFRESH_LEASE = 30
+# Как часто проверять, обновил ли токен другой процесс, сек
+_REFRESH_POLL = 0.2
+
+
+class TokenManager:
+    """Обновление OAuth-токенов Битрикс24.
+
+    Одновременные обновления токена одного чата объединяются: внутри процесса —
+    через asyncio.Lock, между процессами — через аренду в таблице token_refresh.
+    Запрос к OAuth идёт без занятого соединения пула: короткие запросы к базе
+    до и после него.
+    Фоновый планировщик обновляет токены заранее, чтобы обработка событий не
+    ждала OAuth-запроса.
+    """
+    # Блокировка живёт, пока её держат или ждут — записи не копятся по числу чатов
+    _locks: "WeakValueDictionary[int, asyncio.Lock]" = WeakValueDictionary()
+    _scheduler: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def is_fresh(user_data: dict, margin: int = TOKEN_REFRESH_MARGIN) -> bool:
+        return user_data["expires"] - margin > time()
+
+    @classmethod
+    async def get_valid_user(cls, chat_id: int, user_data: Optional[dict] = None) -> Optional[dict]:
+        """Данные пользователя с действующим токеном (при необходимости токен обновляется)"""
+        if user_data is None:
+            user_data = await get_user(chat_id)
+        if user_data and cls.is_fresh(user_data):
+            return user_data
+        return await cls.refresh(chat_id)
+
+    @classmethod
+    async def refresh(cls, chat_id: int, margin: int = TOKEN_REFRESH_MARGIN, wait: bool = True) -> Optional[dict]:
+        """Обновляет токен, если он истекает в ближайшие margin секунд.
+
+        Возвращает свежие данные пользователя или None, если пользователь удалён
+        или обновить токен не удалось. С wait=False токен, который обновляет
+        другой процесс, пропускается.
+        """
+        chat_id = int(chat_id)
+        lock = cls._locks.get(chat_id)
+        if lock is None:
+            lock = cls._locks[chat_id] = asyncio.Lock()
+        async with lock:
+            deadline = monotonic() + _REFRESH_LEASE
+            while True:
+                user_data, claimed = await cls._claim(chat_id, margin)
+                if user_data is None or claimed:
+                    break
+                # Токен свежий или его обновляет другой процесс
+                if cls.is_fresh(user_data, margin):
+                    return user_data
+                if not wait or monotonic() > deadline:
+                    return None
+                await asyncio.sleep(_REFRESH_POLL)
+            if user_data is None:
+                return None
+
+            # Запрос к OAuth — без соединения из пула и без блокировок в базе
+            revoked = False
+            try:
+                data = await cls._request_token(user_data["refresh_token"])
+            except httpx.HTTPStatusError as e:
+                logging.error(f"Token refresh failed for chat {chat_id}: {e.response.text}")
+                revoked = "invalid_grant" in e.response.text
+                data = None
+            except Exception as e:
+                logging.error(f"Token refresh failed for chat {chat_id}: {e}")
+                data = None
+
+            async with Database.acquire() as conn:
+                async with conn.transaction():
+                    if data:
+                        user_data.update(
+                            access_token=data["access_token"],
+                            refresh_token=data["refresh_token"],
+                            expires=int(time()) + int(data["expires_in"])
+                        )
+                        await conn.execute(
+                            "UPDATE users SET access_token = $2, refresh_token = $3, expires = $4 WHERE chat_id = $1",
+                            chat_id, user_data["access_token"], user_data["refresh_token"], user_data["expires"]
+                        )
+                        await RecipientCache.publish(conn, chat_id)
+                    elif revoked:
+                        # Пока шёл запрос, пользователь мог авторизоваться заново
+                        revoked = await conn.fetchval(
+                            "SELECT refresh_token = $2 FROM users WHERE chat_id = $1",
+                            chat_id, user_data["refresh_token"]
+                        )
+                    await conn.execute("DELETE FROM token_refresh WHERE chat_id = $1", chat_id)
+
+            if data:
+                RecipientCache.update(chat_id, user={
+                    "access_token": user_data["access_token"],
+                    "refresh_token": user_data["refresh_token"],
+                    "expires": user_data["expires"]
+                })
+                return user_data
+            if revoked:
+                # refresh_token отозван — пользователю нужно авторизоваться заново
+                await delete_user(chat_id)
+            return None
+
+    @staticmethod
+    async def _claim(chat_id: int, margin: int) -> Tuple[Optional[dict], bool]:
+        """Берёт обновление токена чата на себя: (данные пользователя, взято ли обновление).
+
+        Сначала аренда, затем чтение строки — так видны токены, записанные
+        предыдущим владельцем аренды. Свежий токен обновлять не нужно.
+        """
+        async with Database.acquire() as conn:
+            claimed = await conn.fetchval("""
+                INSERT INTO token_refresh (chat_id, lease_until)
+                VALUES ($1, now() + make_interval(secs => $2))
+                ON CONFLICT (chat_id) DO UPDATE SET lease_until = EXCLUDED.lease_until
+                WHERE token_refresh.lease_until < now()
+                RETURNING TRUE
+            """, chat_id, _REFRESH_LEASE) is not None
+            row = await conn.fetchrow("SELECT * FROM users WHERE chat_id = $1", chat_id)
+            if claimed and (row is None or TokenManager.is_fresh(dict(row), margin)):
+                await conn.execute("DELETE FROM token_refresh WHERE chat_id = $1", chat_id)
+                claimed = False
+        return (dict(row) if row else None), claimed
+
+    @staticmethod
+    async def _request_token(refresh_token: str) -> dict:
+        resp = await BitrixClient.post(
+            "https://oauth.bitrix.info/oauth/token/",
+            data={
+                "grant_type": "refresh_token",
+                "client_id": BITRIX_CLIENT_ID,
+                "client_secret": BITRIX_CLIENT_SECRET,
+                "refresh_token": refresh_token
+            }
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+    @classmethod
+    async def renew_expiring(cls):
+        """Обновляет все токены, истекающие в ближайшие TOKEN_RENEW_BEFORE секунд"""
+        async with Database.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT chat_id FROM users WHERE expires < $1",
+                int(time()) + TOKEN_RENEW_BEFORE
+            )
+
+        semaphore = asyncio.Semaphore(TOKEN_RENEW_CONCURRENCY)
+
+        async def renew(chat_id: int):
+            async with semaphore:
+                await cls.refresh(chat_id, margin=TOKEN_RENEW_BEFORE, wait=False)
+
+        await asyncio.gather(*(renew(row["chat_id"]) for row in rows))
+
+    @classmethod
+    async def _run_scheduler(cls):
+        while True:
+            try:
+                await cls.renew_expiring()
+            except Exception as e:
+                logging.error(f"Token renewal error: {e}")
+            await asyncio.sleep(TOKEN_RENEW_INTERVAL)
+
+    @classmethod
+    def start(cls):
+        if cls._scheduler is None:
+            cls._scheduler = asyncio.create_task(cls._run_scheduler())
+
+    @classmethod
+    async def stop(cls):
+        if cls._scheduler is not None:
+            cls._scheduler.cancel()
+            await asyncio.gather(cls._scheduler, return_exceptions=True)
+            cls._scheduler = None
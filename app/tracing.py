@@ -0,0 +1,239 @@
+import json
+import httpx
+import random
+import asyncio
+import logging
+
+from time import time_ns
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+from config import *
+
+# Виды спанов OTLP
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+
+_current: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+class Span:
+    """Участок обработки события: имя, время начала и конца, атрибуты"""
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "kind", "sampled",
+                 "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], sampled: bool,
+                 kind: int = KIND_INTERNAL, attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.kind = kind
+        self.sampled = sampled
+        self.start_ns = time_ns()
+        self.end_ns = None
+        self.attributes = attributes or {}
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    @property
+    def traceparent(self) -> str:
+        """Контекст в формате W3C traceparent — для передачи через очередь"""
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time_ns()),
+            "attributes": [_attribute(key, value) for key, value in self.attributes.items() if value is not None],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1}
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def _attribute(key: str, value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def _parse_traceparent(traceparent: Optional[str]):
+    """(trace_id, span_id, sampled) из строки traceparent или None"""
+    try:
+        _, trace_id, span_id, flags = traceparent.split("-")
+        return trace_id, span_id, flags == "01"
+    except (AttributeError, ValueError):
+        return None
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+def current_traceparent() -> Optional[str]:
+    span = _current.get()
+    return span.traceparent if span else None
+
+
+def set_attributes(**attributes):
+    """Добавляет атрибуты текущему спану (если трассировка включена)"""
+    span = _current.get()
+    if span is not None:
+        span.set(**attributes)
+
+
+def span(name: str, kind: int = KIND_INTERNAL, parent: Optional[str] = None, **attributes):
+    """Открывает спан: with span("bitrix user.get", domain=...) as s: ...
+
+    Родитель — текущий спан контекста или явно переданный traceparent (для
+    обработки события, пришедшего через очередь). Без родителя начинается
+    новая трассировка. При выключенной трассировке ничего не делает.
+    """
+    if not TRACING_ENABLED:
+        return nullcontext()
+    return _span(name, kind, parent, attributes)
+
+
+@contextmanager
+def _span(name: str, kind: int, parent: Optional[str], attributes: dict):
+    parent_span = _current.get()
+    context = _parse_traceparent(parent) if parent else None
+    if context is not None:
+        trace_id, parent_id, sampled = context
+    elif parent_span is not None:
+        trace_id, parent_id, sampled = parent_span.trace_id, parent_span.span_id, parent_span.sampled
+    else:
+        trace_id, parent_id = f"{random.getrandbits(128):032x}", None
+        sampled = random.random() < TRACE_SAMPLE_RATE
+
+    current = Span(name, trace_id, parent_id, sampled, kind, attributes)
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        current.end_ns = time_ns()
+        if sampled:
+            SpanExporter.add(current)
+
+
+def record_span(name: str, start_ns: int, end_ns: int, kind: int = KIND_CLIENT,
+                error: Optional[str] = None, **attributes):
+    """Записывает уже завершившийся участок как дочерний спан текущего"""
+    parent = _current.get()
+    if not TRACING_ENABLED or parent is None or not parent.sampled:
+        return
+    recorded = Span(name, parent.trace_id, parent.span_id, True, kind, attributes)
+    recorded.start_ns = start_ns
+    recorded.end_ns = end_ns
+    recorded.error = error
+    SpanExporter.add(recorded)
+
+
+def log_query(record):
+    """Обработчик asyncpg add_query_logger: спан на каждый SQL-запрос.
+
+    asyncpg вызывает его через call_soon, поэтому контекст (и текущий спан)
+    тот же, что у выполнившей запрос задачи.
+    """
+    end_ns = time_ns()
+    query = " ".join(record.query.split())
+    record_span(
+        f"db {query.split(' ', 1)[0].upper()}",
+        end_ns - int(record.elapsed * 1e9),
+        end_ns,
+        error=str(record.exception) if record.exception else None,
+        **{"db.system": "postgresql", "db.statement": query[:500]}
+    )
+
+
+class SpanExporter:
+    """Накопление завершённых спанов и периодическая выгрузка в OTLP JSON"""
+    _buffer: List[Span] = []
+    _task: Optional[asyncio.Task] = None
+    _client: Optional[httpx.AsyncClient] = None
+    _max_buffer = 10000
+    dropped_total = 0
+
+    @classmethod
+    def add(cls, span: Span):
+        if len(cls._buffer) >= cls._max_buffer:
+            cls.dropped_total += 1
+            return
+        cls._buffer.append(span)
+
+    @classmethod
+    def start(cls):
+        if not TRACING_ENABLED or cls._task is not None:
+            return
+        cls._task = asyncio.create_task(cls._run())
+
+    @classmethod
+    async def _run(cls):
+        while True:
+            await asyncio.sleep(TRACE_FLUSH_INTERVAL)
+            await cls.flush()
+
+    @classmethod
+    async def flush(cls):
+        if not cls._buffer:
+            return
+        spans, cls._buffer = cls._buffer, []
+        payload = json.dumps({"resourceSpans": [{
+            "resource": {"attributes": [_attribute("service.name", TRACE_SERVICE_NAME)]},
+            "scopeSpans": [{"scope": {"name": "app.tracing"}, "spans": [s.to_otlp() for s in spans]}]
+        }]}, ensure_ascii=False)
+
+        if TRACE_FILE:
+            try:
+                await asyncio.to_thread(cls._append, payload)
+            except Exception as e:
+                logging.error(f"Failed to write spans to {TRACE_FILE}: {e}")
+        if TRACE_ENDPOINT:
+            if cls._client is None:
+                cls._client = httpx.AsyncClient(timeout=10)
+            try:
+                resp = await cls._client.post(
+                    TRACE_ENDPOINT,
+                    content=payload.encode(),
+                    headers={"Content-Type": "application/json"}
+                )
+                resp.raise_for_status()
+            except Exception as e:
+                logging.error(f"Failed to export {len(spans)} spans to {TRACE_ENDPOINT}: {e}")
+
+    @staticmethod
+    def _append(payload: str):
+        with open(TRACE_FILE, "a", encoding="utf-8") as f:
+            f.write(payload + "\n")
+
+    @classmethod
+    async def stop(cls):
+        if cls._task is not None:
+            cls._task.cancel()
+            try:
+                await cls._task
+            except asyncio.CancelledError:
+                pass
+            cls._task = None
+        await cls.flush()
+        if cls._client is not None:
+            await cls._client.aclose()
+            cls._client = None
@@ -1,100 +1,209 @@
-import httpx
+import asyncio
 import logging
-import json
 
-from time import time
-from typing import Dict
+from time import monotonic
+from typing import Dict, Optional
 
 from config import *
 from db import *
+from bitrix import *
+from cache import AsyncTTLCache
 
+# (domain, user_id) → "Имя Фамилия"
+user_name_cache = AsyncTTLCache(maxsize=USER_NAME_CACHE_SIZE, ttl=USER_NAME_CACHE_TTL)
 
-async def refresh_token(chat_id: str) -> bool:
-    """Обновление access token, используя refresh token"""
-    user_data = await get_user(int(chat_id))
-    if not user_data:
-        return False
+# (domain, category_id) → список стадий направления сделок
+deal_stage_cache = AsyncTTLCache(maxsize=1024, ttl=DEAL_STAGE_CACHE_TTL, refresh_after=DEAL_STAGE_REFRESH_AFTER)
 
-    try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(
-                "https://oauth.bitrix.info/oauth/token/",
-                data={
-                    "grant_type": "refresh_token",
-                    "client_id": BITRIX_CLIENT_ID,
-                    "client_secret": BITRIX_CLIENT_SECRET,
-                    "refresh_token": user_data["refresh_token"]
-                }
-            )
-            resp.raise_for_status()
-            data = resp.json()
+# (chat_id, метод, start) → страница списка из Битрикса для постраничных команд
+list_page_cache = AsyncTTLCache(maxsize=LIST_PAGE_CACHE_SIZE, ttl=LIST_PAGE_CACHE_TTL)
+
+_background_tasks: set = set()
+
+# domain → когда этот процесс прогревал имена сотрудников (monotonic). Отметка живёт
+# рядом с кэшем: после перезапуска или в другом процессе кэш пуст — прогрев нужен снова
+_names_warmed_at: Dict[str, float] = {}
+_names_warming: set = set()  # порталы, которые прогреваются сейчас
 
-            new_data = {
-                "chat_id": int(chat_id),
-                "access_token": data["access_token"],
-                "refresh_token": data["refresh_token"],
-                "expires": int(time()) + int(data["expires_in"]),
-                "domain": user_data["domain"],
-                "member_id": user_data["member_id"],
-                "user_id": user_data["user_id"],
-                "user_name": user_data["user_name"],
-                "is_admin": user_data["is_admin"]
-            }
-            await save_user(new_data)
-            return True
-    except httpx.HTTPStatusError as e:
-        if "invalid_grant" in str(e):
-            await delete_user(int(chat_id))
-        return False
+
+def run_in_background(coro) -> asyncio.Task:
+    """Запускает корутину в фоне, сохраняя ссылку на задачу до её завершения"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
 
 
 async def get_user_info(domain: str, access_token: str) -> Dict:
     """Получение информации о пользователе, включая роли"""
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"https://{domain}/rest/profile.json",
-            params={"auth": access_token}
-        )
-        data = resp.json()
-        data = data.get("result", {})
+    resp = await BitrixClient.get(
+        f"https://{domain}/rest/profile.json",
+        params={"auth": access_token}
+    )
+    data = resp.json()
+    data = data.get("result", {})
 
-        # logging.info(f"Data User Get: {data}") # Логи
+    # logging.info(f"Data User Get: {data}") # Логи
 
-        return {
-            "id": data.get("ID"),
-            "is_admin": data.get("ADMIN"),
-            "name": f"{data.get('NAME')} {data.get('LAST_NAME')}".strip(),
+    return {
+        "id": data.get("ID"),
+        "is_admin": data.get("ADMIN"),
+        "name": f"{data.get('NAME')} {data.get('LAST_NAME')}".strip(),
+    }
+
+
+def format_user_name(user: dict) -> str:
+    return f"{user.get('NAME', '')} {user.get('LAST_NAME', '')}".strip() or "Неизвестный"
+
+
+async def fetch_user_name(domain: str, access_token: str, user_id: int) -> str:
+    """Запрос имени пользователя в Битриксе (без кэша)"""
+    resp = await BitrixClient.get(
+        f"https://{domain}/rest/user.get.json",
+        params={
+            "auth": access_token,
+            "ID": user_id
         }
+    )
+    user_data = resp.json().get('result', [{}])[0]
+    return format_user_name(user_data)
 
 
 async def get_user_name(domain: str, access_token: str, user_id: int) -> str:
     """Получение имени пользователя по ID"""
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(
-                f"https://{domain}/rest/user.get.json",
-                params={
-                    "auth": access_token,
-                    "ID": user_id
-                }
-            )
-            user_data = resp.json().get('result', [{}])[0]
-            return f"{user_data.get('NAME', '')} {user_data.get('LAST_NAME', '')}".strip() or "Неизвестный"
+        return await user_name_cache.get_or_load(
+            (domain, str(user_id)),
+            lambda: fetch_user_name(domain, access_token, user_id)
+        )
     except Exception as e:
         logging.error(f"Error getting user name: {e}")
         return "Неизвестный"
 
 
+async def get_user_names(domain: str, access_token: str, user_ids) -> Dict[str, str]:
+    """Имена нескольких пользователей: из кэша, недостающие — одним запросом batch"""
+    names = {}
+    missing = []
+    for user_id in {str(user_id) for user_id in user_ids if user_id}:
+        name = user_name_cache.get((domain, user_id))
+        if name is None:
+            missing.append(user_id)
+        else:
+            names[user_id] = name
+
+    if missing:
+        try:
+            # Ключи не числовые, иначе PHP вернёт результаты массивом, а не объектом
+            results, errors = await BitrixClient.batch(domain, access_token, {
+                f"user_{user_id}": ("user.get", {"ID": user_id}) for user_id in missing
+            })
+            for user_id in missing:
+                cache_user_names(domain, results.get(f"user_{user_id}"))
+        except Exception as e:
+            logging.error(f"Error getting user names: {e}")
+        for user_id in missing:
+            names[user_id] = user_name_cache.get((domain, user_id), "Неизвестный")
+    return names
+
+
+def cache_user_names(domain: str, users: list):
+    """Кладёт в кэш имена из уже полученного ответа user.get (например, из batch)"""
+    for user in users or []:
+        if user.get('ID'):
+            user_name_cache.set((domain, str(user['ID'])), format_user_name(user))
+
+
+async def warm_user_names(domain: str, access_token: str):
+    """Загружает в кэш имена всех сотрудников портала постранично (по 50 на запрос).
+
+    Не чаще раза в USER_NAME_CACHE_TTL на портал, кто бы из сотрудников ни авторизовался.
+    """
+    if domain in _names_warming or names_warm(domain):
+        return
+    _names_warming.add(domain)
+
+    start = 0
+    loaded = 0
+    try:
+        while start is not None:
+            resp = await BitrixClient.get(
+                f"https://{domain}/rest/user.get.json",
+                params={"auth": access_token, "start": start}
+            )
+            data = resp.json()
+            for user in data.get('result', []):
+                user_name_cache.set((domain, str(user.get('ID'))), format_user_name(user))
+                loaded += 1
+            start = data.get('next')
+        _names_warmed_at[domain] = monotonic()
+        logging.info(f"User name cache warmed for {domain}: {loaded} users")
+    except Exception as e:
+        logging.warning(f"User name warm-up failed for {domain}: {e}")  # повторим при следующей авторизации
+    finally:
+        _names_warming.discard(domain)
+
+
+def names_warm(domain: str) -> bool:
+    """В кэше имена всех сотрудников портала — запрашивать user.get заранее не нужно"""
+    warmed_at = _names_warmed_at.get(domain)
+    return warmed_at is not None and monotonic() - warmed_at < USER_NAME_CACHE_TTL
+
+
+async def fetch_deal_stages(domain: str, access_token: str, category_id: int = 0) -> list:
+    """Запрос стадий направления сделок в Битриксе (без кэша)"""
+    params = {"auth": access_token}
+    if category_id:
+        params["id"] = category_id
+    resp = await BitrixClient.get(
+        f"https://{domain}/rest/crm.dealcategory.stage.list",
+        params=params
+    )
+    data = resp.json()
+    if 'error' in data:
+        raise ValueError(data.get('error_description', data['error']))
+    return data.get('result', [])
+
+
+async def get_deal_stages(domain: str, access_token: str, category_id: int = 0) -> list:
+    """Стадии направления сделок из кэша портала"""
+    category_id = int(category_id or 0)
+    return await deal_stage_cache.get_or_load(
+        (domain, category_id),
+        lambda: fetch_deal_stages(domain, access_token, category_id)
+    )
+
+
+async def get_stage_map(domain: str, access_token: str, category_id: int = 0) -> Dict[str, str]:
+    """Соответствие STATUS_ID → название стадии"""
+    stages = await get_deal_stages(domain, access_token, category_id)
+    return {stage['STATUS_ID']: stage['NAME'] for stage in stages}
+
+
+def cache_deal_stages(domain: str, category_id: int, stages: list):
+    """Кладёт в кэш стадии из уже полученного ответа (например, из batch)"""
+    deal_stage_cache.set((domain, int(category_id or 0)), stages)
+
+
+def invalidate_deal_stages(domain: Optional[str] = None, category_id: Optional[int] = None):
+    """Сбрасывает кэш стадий: всего портала, одного направления или целиком"""
+    if domain is None:
+        deal_stage_cache.clear()
+    elif category_id is None:
+        deal_stage_cache.invalidate_where(lambda key: key[0] == domain)
+    else:
+        deal_stage_cache.invalidate((domain, int(category_id)))
+
+
 async def check_user_exists(domain: str, access_token: str, user_id: int) -> bool:
     """Проверка, существует ли пользователь на портале Битрикс24"""
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"https://{domain}/rest/user.get.json",
-            params={"auth": access_token, "ID": user_id}
-        )
-        data = resp.json()
-        users = data.get("result", [])
-        return len(users) > 0
+    resp = await BitrixClient.get(
+        f"https://{domain}/rest/user.get.json",
+        params={"auth": access_token, "ID": user_id}
+    )
+    data = resp.json()
+    users = data.get("result", [])
+    return len(users) > 0
 
 
 async def register_webhooks(domain: str, access_token: str):
@@ -108,64 +217,104 @@ async def register_webhooks(domain: str, access_token: str):
         "OnCrmDealAdd", "OnCrmDealUpdate"
     ]
 
-    async with httpx.AsyncClient() as client:
-        for event in events:
-            # 1) Получаем все текущие handler’ы для event
-            resp_get = await client.post(
-                f"https://{domain}/rest/event.get",
-                data={
-                    "event": event,
-                    "auth": access_token
-                }
-            )
-            resp_get.raise_for_status()
-            handlers = resp_get.json().get("result", [])
-
-            # 2) Удаляем каждый handler
-            for h in handlers:
-                handler_url = h.get("handler")
-                try:
-                    resp_un = await client.post(
-                        f"https://{domain}/rest/event.unbind",
-                        data={
-                            "event": event,
-                            "handler": handler_url,
-                            "auth": access_token
-                        }
-                    )
-                    resp_un.raise_for_status()
-                    # logging.info(f"Unbound {event} → {handler_url}")  # Логи
-                except Exception as e:
-                    logging.warning(f"Failed to unbind {event} → {handler_url}: {e}")
-
-        # 3) Привязываем заново по одному
-        for event in events:
+    for event in events:
+        # 1) Получаем все текущие handler’ы для event
+        resp_get = await BitrixClient.post(
+            f"https://{domain}/rest/event.get",
+            data={
+                "event": event,
+                "auth": access_token
+            }
+        )
+        resp_get.raise_for_status()
+        handlers = resp_get.json().get("result", [])
+
+        # 2) Удаляем каждый handler
+        for h in handlers:
+            handler_url = h.get("handler")
             try:
-                resp_bind = await client.post(
-                    f"https://{domain}/rest/event.bind",
+                resp_un = await BitrixClient.post(
+                    f"https://{domain}/rest/event.unbind",
                     data={
                         "event": event,
-                        "handler": f"{WEBHOOK_DOMAIN}/callback",
+                        "handler": handler_url,
                         "auth": access_token
                     }
                 )
-                resp_bind.raise_for_status()
-                # logging.info(f"Bound {event} → {WEBHOOK_DOMAIN}/callback")  # Логи
+                resp_un.raise_for_status()
+                # logging.info(f"Unbound {event} → {handler_url}")  # Логи
             except Exception as e:
-                logging.error(f"Failed to bind {event}: {e}")
-
-
-def parse_form_data(form_data: dict) -> dict:
-    """Парсинг полученных данных из Битрикса"""
-    result = {}
-    for key, value in form_data.items():
-        parts = key.split('[')
-        current = result
-        for part in parts[:-1]:
-            part = part.rstrip(']')
-            if part not in current:
-                current[part] = {}
-            current = current[part]
-        last_part = parts[-1].rstrip(']')
-        current[last_part] = value
-    return result
+                logging.warning(f"Failed to unbind {event} → {handler_url}: {e}")
+
+    # 3) Привязываем заново по одному
+    for event in events:
+        try:
+            resp_bind = await BitrixClient.post(
+                f"https://{domain}/rest/event.bind",
+                data={
+                    "event": event,
+                    "handler": f"{WEBHOOK_DOMAIN}/callback",
+                    "auth": access_token
+                }
+            )
+            resp_bind.raise_for_status()
+            # logging.info(f"Bound {event} → {WEBHOOK_DOMAIN}/callback")  # Логи
+        except Exception as e:
+            logging.error(f"Failed to bind {event}: {e}")
+
+
+async def fetch_list_page(domain: str, access_token: str, method: str, params: dict, start: int) -> dict:
+    """Страница списочного метода Битрикса (без кэша)"""
+    result, next_start, total = await BitrixClient.list_page(domain, access_token, method, params, start)
+    # tasks.task.list оборачивает список в {"tasks": [...]}
+    items = result.get('tasks', []) if isinstance(result, dict) else (result or [])
+    return {"items": items, "next": next_start, "total": total if total is not None else start + len(items)}
+
+
+async def get_list_page(user_data: dict, method: str, params: dict, start: int = 0) -> dict:
+    """Страница списка из кэша пользователя"""
+    return await list_page_cache.get_or_load(
+        (user_data['chat_id'], method, start),
+        lambda: fetch_list_page(user_data['domain'], user_data['access_token'], method, params, start)
+    )
+
+
+def prefetch_list_page(user_data: dict, method: str, params: dict, start: int):
+    """Загружает страницу в кэш в фоне, чтобы «Вперёд» открывался без ожидания Битрикса"""
+    if list_page_cache.get((user_data['chat_id'], method, start)) is not None:
+        return
+
+    async def load():
+        try:
+            await get_list_page(user_data, method, params, start)
+        except Exception as e:
+            logging.warning(f"Prefetch of {method} page {start} failed: {e}")
+
+    run_in_background(load())
+
+
+def reset_list_pages(chat_id: int, method: str):
+    """Сбрасывает закэшированные страницы — новая команда показывает актуальный список"""
+    list_page_cache.invalidate_where(lambda key: key[0] == chat_id and key[1] == method)
+
+
+async def get_list_slice(user_data: dict, method: str, params: dict, offset: int, limit: int) -> tuple:
+    """Записи списка с offset по offset + limit и общее число записей.
+
+    Страницы Битрикса (по 50 записей) берутся из кэша; если следующий экран
+    попадает на следующую страницу Битрикса, она загружается заранее.
+    """
+    start = offset - offset % LIST_LIMIT
+    page = await get_list_page(user_data, method, params, start)
+    items = page["items"][offset - start:]
+    total = page["total"]
+    next_start = page["next"]
+
+    while len(items) < limit and next_start is not None:
+        page = await get_list_page(user_data, method, params, next_start)
+        items = items + page["items"]
+        next_start = page["next"]
+
+    if next_start is not None and len(items) < 2 * limit:
+        prefetch_list_page(user_data, method, params, next_start)
+    return items[:limit], total
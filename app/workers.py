@@ -0,0 +1,260 @@
+import asyncio
+import json
+import logging
+
+from typing import Awaitable, Callable, List, Optional
+
+from config import *
+from db import Database, PgListener
+from bitrix import BitrixRetryLater
+
+
+class WebhookQueue:
+    """Ограниченная очередь событий Битрикс и пул обработчиков.
+
+    /callback только кладёт событие в очередь и сразу отвечает, а
+    WEBHOOK_WORKERS задач разбирают очередь в фоне.
+    """
+    _queue: Optional[asyncio.Queue] = None
+    _workers: List[asyncio.Task] = []
+    _handler: Optional[Callable[[dict], Awaitable[None]]] = None
+    coalesces = False  # серии изменений склеивает обработчик (EventCoalescer)
+
+    @classmethod
+    async def start(cls, handler: Callable[[dict], Awaitable[None]],
+                    workers: int = WEBHOOK_WORKERS, maxsize: int = WEBHOOK_QUEUE_SIZE):
+        if cls._queue is not None:
+            return
+        cls._handler = handler
+        cls._queue = asyncio.Queue(maxsize=maxsize)
+        cls._workers = [asyncio.create_task(cls._worker(i)) for i in range(workers)]
+        logging.info(f"Webhook queue started: {workers} workers, maxsize {maxsize}")
+
+    @classmethod
+    async def put(cls, item: dict, timeout: float = WEBHOOK_ENQUEUE_TIMEOUT, key: Optional[str] = None) -> bool:
+        """Кладёт событие в очередь. Если очередь заполнена дольше timeout — возвращает False.
+        key не используется: серии склеивает обработчик"""
+        if cls._queue is None:
+            raise RuntimeError("WebhookQueue is not started")
+        try:
+            cls._queue.put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            pass
+
+        try:
+            await asyncio.wait_for(cls._queue.put(item), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    @classmethod
+    def depth(cls) -> int:
+        return cls._queue.qsize() if cls._queue is not None else 0
+
+    @classmethod
+    def retry_later(cls, item: dict, delay: float):
+        """Возвращает событие в очередь через delay секунд — портал сейчас не принимает запросы"""
+        logging.info(f"Webhook event deferred for {delay:.0f}s: Bitrix portal is rate limited")
+        asyncio.get_running_loop().call_later(delay, cls._requeue, item)
+
+    @classmethod
+    def _requeue(cls, item: dict):
+        try:
+            if cls._queue is None:
+                raise asyncio.QueueFull
+            cls._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            logging.error("Deferred webhook event dropped: queue is full or stopped")
+
+    @classmethod
+    async def _worker(cls, n: int):
+        while True:
+            item = await cls._queue.get()
+            try:
+                await cls._handler(item)
+            except BitrixRetryLater as e:
+                cls.retry_later(item, e.delay)
+            except Exception as e:
+                logging.error(f"Webhook worker {n} error: {e}")
+            finally:
+                cls._queue.task_done()
+
+    @classmethod
+    async def stop(cls, timeout: float = WEBHOOK_DRAIN_TIMEOUT):
+        """Дожидается обработки уже принятых событий и останавливает обработчиков"""
+        if cls._queue is None:
+            return
+        try:
+            await asyncio.wait_for(cls._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Webhook queue drain timed out, {cls._queue.qsize()} events dropped")
+
+        for task in cls._workers:
+            task.cancel()
+        await asyncio.gather(*cls._workers, return_exceptions=True)
+        cls._queue = None
+        cls._workers = []
+
+
+class PostgresWebhookQueue:
+    """Общая для всех процессов очередь событий в таблице webhook_jobs.
+
+    Любой процесс uvicorn может принять событие, а обработает его первый
+    свободный обработчик в любом процессе. Задачи забираются через
+    FOR UPDATE SKIP LOCKED, о новых задачах сообщает NOTIFY webhook_jobs.
+    Упавшая задача снова становится доступной через WEBHOOK_JOB_LOCK_TIMEOUT.
+
+    События с ключом склейки откладываются на COALESCE_WINDOW секунд прямо в
+    таблице: следующее событие с тем же ключом заменяет отложенное, но не
+    позже COALESCE_MAX_LATENCY после первого. Строка удаляется только после
+    обработки, так что отложенное событие переживает перезапуск процесса.
+    """
+    coalesces = True
+    _workers: List[asyncio.Task] = []
+    _handler: Optional[Callable[[dict], Awaitable[None]]] = None
+    _wakeup: Optional[asyncio.Event] = None
+    _stopping = False
+    _in_flight = 0
+    _depth = 0
+
+    @classmethod
+    async def start(cls, handler: Callable[[dict], Awaitable[None]], workers: int = WEBHOOK_WORKERS):
+        if cls._workers:
+            return
+        cls._handler = handler
+        cls._stopping = False
+        cls._wakeup = asyncio.Event()
+        await PgListener.listen("webhook_jobs", lambda payload: cls._wakeup.set())
+        cls._workers = [asyncio.create_task(cls._worker(i)) for i in range(workers)]
+        logging.info(f"Postgres webhook queue started: {workers} workers")
+
+    @classmethod
+    async def put(cls, item: dict, timeout: float = WEBHOOK_ENQUEUE_TIMEOUT, key: Optional[str] = None) -> bool:
+        """Сохраняет событие в таблицу. При переполнении очереди возвращает False.
+
+        key — ключ склейки серии изменений одной сущности (см. api.coalesce_key)
+        """
+        async with Database.acquire() as conn:
+            # Считаем не дальше предела — полный count(*) на каждый вебхук слишком дорог.
+            # Граница приблизительная: параллельные процессы могут превысить её на несколько задач
+            cls._depth = await conn.fetchval(
+                "SELECT count(*) FROM (SELECT 1 FROM webhook_jobs LIMIT $1) AS jobs", WEBHOOK_QUEUE_SIZE
+            )
+            if cls._depth >= WEBHOOK_QUEUE_SIZE:
+                return False
+            if key is None or COALESCE_WINDOW <= 0:
+                await conn.execute("INSERT INTO webhook_jobs (payload) VALUES ($1)", json.dumps(item))
+                await conn.execute("SELECT pg_notify('webhook_jobs', '')")
+            else:
+                merged = await conn.fetchval("""
+                    INSERT INTO webhook_jobs (payload, coalesce_key, available_at)
+                    VALUES ($1, $2, now() + make_interval(secs => $3))
+                    ON CONFLICT (coalesce_key) WHERE attempts = 0 DO UPDATE SET
+                        payload = EXCLUDED.payload,
+                        available_at = LEAST(EXCLUDED.available_at,
+                                             webhook_jobs.created_at + make_interval(secs => $4))
+                    RETURNING xmax <> 0
+                """, json.dumps(item), key, COALESCE_WINDOW, COALESCE_MAX_LATENCY)
+                if merged:
+                    return True  # заменили ещё не взятое в работу событие той же сущности
+                # NOTIFY придёт раньше срока — разбудим своих обработчиков к сроку сами
+                if cls._wakeup is not None:
+                    asyncio.get_running_loop().call_later(COALESCE_WINDOW, cls._wakeup.set)
+        cls._depth += 1
+        return True
+
+    @classmethod
+    def depth(cls) -> int:
+        return cls._depth
+
+    @classmethod
+    async def _claim(cls) -> Optional[tuple]:
+        async with Database.acquire() as conn:
+            row = await conn.fetchrow(f"""
+                UPDATE webhook_jobs SET
+                    attempts = attempts + 1,
+                    locked_until = now() + interval '{WEBHOOK_JOB_LOCK_TIMEOUT} seconds'
+                WHERE id = (
+                    SELECT id FROM webhook_jobs
+                    WHERE (locked_until IS NULL OR locked_until < now()) AND available_at <= now()
+                    ORDER BY id
+                    FOR UPDATE SKIP LOCKED
+                    LIMIT 1
+                )
+                RETURNING id, payload, attempts
+            """)
+        return (row["id"], json.loads(row["payload"]), row["attempts"]) if row else None
+
+    @classmethod
+    async def _finish(cls, job_id: int):
+        async with Database.acquire() as conn:
+            await conn.execute("DELETE FROM webhook_jobs WHERE id = $1", job_id)
+
+    @classmethod
+    async def _retry_later(cls, job_id: int, delay: float):
+        """Откладывает задачу на delay секунд, не считая это неудачной попыткой"""
+        async with Database.acquire() as conn:
+            await conn.execute("""
+                UPDATE webhook_jobs SET
+                    locked_until = NULL,
+                    available_at = now() + make_interval(secs => $2),
+                    attempts = GREATEST(attempts - 1, 1)
+                WHERE id = $1
+            """, job_id, delay)
+
+    @classmethod
+    async def _worker(cls, n: int):
+        while not cls._stopping:
+            try:
+                job = await cls._claim()
+            except Exception as e:
+                logging.error(f"Webhook worker {n} failed to claim a job: {e}")
+                job = None
+
+            if job is None:
+                cls._wakeup.clear()
+                try:
+                    await asyncio.wait_for(cls._wakeup.wait(), WEBHOOK_JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            job_id, payload, attempts = job
+            cls._in_flight += 1
+            try:
+                await cls._handler(payload)
+                await cls._finish(job_id)
+            except BitrixRetryLater as e:
+                logging.info(f"Webhook job {job_id} deferred for {e.delay:.0f}s: {e}")
+                try:
+                    await cls._retry_later(job_id, e.delay)
+                except Exception as e:
+                    logging.error(f"Failed to defer webhook job {job_id}: {e}")
+            except Exception as e:
+                logging.error(f"Webhook worker {n} error on job {job_id} (attempt {attempts}): {e}")
+                if attempts >= WEBHOOK_JOB_MAX_ATTEMPTS:
+                    logging.error(f"Webhook job {job_id} dropped after {attempts} attempts")
+                    await cls._finish(job_id)
+            finally:
+                cls._in_flight -= 1
+
+    @classmethod
+    async def stop(cls, timeout: float = WEBHOOK_DRAIN_TIMEOUT):
+        """Дожидается задач в работе. Необработанные задачи остаются в таблице для других процессов"""
+        if not cls._workers:
+            return
+        cls._stopping = True
+        cls._wakeup.set()
+        try:
+            await asyncio.wait_for(asyncio.gather(*cls._workers, return_exceptions=True), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Webhook workers did not finish in time, {cls._in_flight} jobs will be retried")
+            for task in cls._workers:
+                task.cancel()
+            await asyncio.gather(*cls._workers, return_exceptions=True)
+        cls._workers = []
+
+
+# Очередь, которую использует приложение
+EventQueue = PostgresWebhookQueue if WEBHOOK_QUEUE_BACKEND == "postgres" else WebhookQueue
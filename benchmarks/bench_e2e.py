@@ -0,0 +1,322 @@
+"""Сквозной нагрузочный тест: вебхуки Битрикса → /callback → уведомления в Telegram.
+
+Поднимает заглушки Битрикс24 и Telegram (benchmarks/fakes.py), запускает API
+отдельным процессом (python app/main.py api), заводит в базе тестовый портал
+с --chats пользователями и отправляет --events событий OnTaskUpdate /
+OnCrmDealAdd / OnTaskCommentAdd. Нужна рабочая база PostgreSQL (DATABASE_URL).
+
+Отчёт: событий в секунду, задержка p50/p99 от отправки вебхука до первого и
+до последнего сообщения в Telegram, число запросов к Битриксу и Telegram на
+событие. С --save результат пишется в JSON, с --baseline сравнивается с
+сохранённым ранее.
+
+Пример:
+    python benchmarks/bench_e2e.py --events 500 --concurrency 20 --chats 3 \\
+        --bitrix-latency 0.05 --save baseline.json
+
+Настройки самого приложения (COALESCE_WINDOW, DELIVERY_*, WEBHOOK_* и т. д.)
+передаются через окружение как обычно. Лимиты Telegram (DELIVERY_GLOBAL_RATE,
+DELIVERY_CHAT_RATE) ограничивают пропускную способность так же, как в работе.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+
+from pathlib import Path
+from time import perf_counter, time
+from typing import Dict, List, Optional
+from urllib.parse import urlencode
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "app"))
+
+from fakes import FakeBitrix, FakeTelegram  # noqa: E402
+
+BENCH_DOMAIN = "bench.bitrix24.ru"
+BENCH_MEMBER_ID = "bench-member"
+BENCH_CHAT_BASE = 9_000_000_000
+
+# У каждого типа события свой диапазон номеров — по номеру в тексте сообщения
+# находится событие, к которому оно относится
+EVENT_ID_BASE = {
+    "ONTASKUPDATE": 1_000_000,
+    "ONCRMDEALADD": 2_000_000,
+    "ONTASKCOMMENTADD": 3_000_000,
+}
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def webhook_body(event: str, entity_id: int, seq: int) -> str:
+    """Тело вебхука в том виде, в каком его отправляет Битрикс"""
+    fields = [("event", event), ("event_handler_id", "1")]
+    if event == "ONTASKCOMMENTADD":
+        fields += [
+            ("data[FIELDS_AFTER][ID]", str(seq)),
+            ("data[FIELDS_AFTER][TASK_ID]", str(entity_id)),
+        ]
+    elif event == "ONCRMDEALADD":
+        fields += [("data[FIELDS][ID]", str(entity_id))]
+    else:
+        fields += [
+            ("data[FIELDS_BEFORE][ID]", str(entity_id)),
+            ("data[FIELDS_AFTER][ID]", str(entity_id)),
+            ("data[IS_ACCESSIBLE_BEFORE]", "N"),
+            ("data[IS_ACCESSIBLE_AFTER]", "undefined"),
+        ]
+    fields += [
+        ("ts", str(int(time()))),
+        ("auth[domain]", BENCH_DOMAIN),
+        ("auth[client_endpoint]", f"https://{BENCH_DOMAIN}/rest/"),
+        ("auth[server_endpoint]", "https://oauth.bitrix.info/rest/"),
+        ("auth[member_id]", BENCH_MEMBER_ID),
+        ("auth[application_token]", "bench-application-token"),
+    ]
+    return urlencode(fields)
+
+
+async def seed_portal(chats: int):
+    """Тестовый портал: chats администраторов с токенами, действующими сутки"""
+    from db import Database, save_user, create_notification_settings
+
+    await Database.get_pool()
+    await Database.init_schema()
+    for i in range(chats):
+        chat_id = BENCH_CHAT_BASE + i
+        await save_user({
+            "chat_id": chat_id,
+            "access_token": f"bench-access-{i}",
+            "refresh_token": f"bench-refresh-{i}",
+            "expires": int(time()) + 86400,
+            "domain": BENCH_DOMAIN,
+            "member_id": BENCH_MEMBER_ID,
+            "user_id": i + 1,
+            "user_name": f"Сотрудник {i + 1}",
+            "is_admin": True
+        })
+        await create_notification_settings(chat_id)
+
+
+async def cleanup_portal(chats: int):
+    from db import Database, delete_user
+
+    for i in range(chats):
+        await delete_user(BENCH_CHAT_BASE + i)
+    await Database.close()
+
+
+def start_api(port: int, env: Dict[str, str]) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "main.py", "api"],
+        cwd=ROOT / "app",
+        env={**os.environ, **env, "API_PORT": str(port)},
+    )
+
+
+async def wait_ready(client: httpx.AsyncClient, api_url: str, timeout: float = 30):
+    deadline = perf_counter() + timeout
+    while perf_counter() < deadline:
+        try:
+            if (await client.get(f"{api_url}/stats")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"API at {api_url} did not start in {timeout}s")
+
+
+async def run(args) -> dict:
+    bitrix = FakeBitrix(latency=args.bitrix_latency, jitter=args.bitrix_jitter, error_rate=args.bitrix_error_rate,
+                        rate_limit=args.bitrix_rate_limit, burst=args.bitrix_burst)
+    telegram = FakeTelegram(latency=args.telegram_latency, error_rate=args.telegram_error_rate)
+    bitrix_url = await bitrix.start(port=args.bitrix_port)
+    telegram_url = await telegram.start(port=args.telegram_port)
+
+    env = {
+        "BITRIX_API_OVERRIDE": bitrix_url,
+        "TELEGRAM_API_URL": telegram_url,
+        "TELEGRAM_TOKEN": "123456:BENCH",
+        "BITRIX_DOMAIN": BENCH_DOMAIN,
+    }
+    os.environ.update(env)  # для seed_portal в этом процессе
+
+    await seed_portal(args.chats)
+    api = None
+    api_url = args.api_url
+    if api_url is None:
+        api = start_api(args.api_port, env)
+        api_url = f"http://127.0.0.1:{args.api_port}"
+
+    weights = dict(zip(EVENT_ID_BASE, args.mix))
+    kinds = random.choices(list(weights), weights=list(weights.values()), k=args.events)
+
+    sent_at: Dict[str, float] = {}
+    accept_times: List[float] = []
+    statuses: Dict[int, int] = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def fire(client: httpx.AsyncClient, seq: int, event: str):
+        entity_id = EVENT_ID_BASE[event] + seq
+        body = webhook_body(event, entity_id, seq)
+        async with semaphore:
+            started = perf_counter()
+            sent_at[str(entity_id)] = started
+            try:
+                resp = await client.post(
+                    f"{api_url}/callback",
+                    content=body,
+                    headers={"Content-Type": "application/x-www-form-urlencoded"}
+                )
+                status = resp.status_code
+            except httpx.HTTPError:
+                status = 0
+            accept_times.append(perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    try:
+        async with httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=args.concurrency)) as client:
+            await wait_ready(client, api_url)
+            bitrix.reset()
+            telegram.reset()
+
+            started = perf_counter()
+            await asyncio.gather(*(fire(client, seq, event) for seq, event in enumerate(kinds)))
+            sent = perf_counter()
+
+            # Ждём, пока все события дойдут до всех чатов
+            expected = statuses.get(200, 0) * args.chats
+            deadline = sent + args.drain_timeout
+            while perf_counter() < deadline:
+                if sum(len(v) for v in telegram.deliveries.values()) >= expected:
+                    break
+                await asyncio.sleep(0.05)
+    finally:
+        if api is not None:
+            # API при остановке дочищает очередь отправки — заглушки должны отвечать
+            api.terminate()
+            try:
+                await asyncio.to_thread(api.wait, 30)
+            except subprocess.TimeoutExpired:
+                api.kill()
+        await cleanup_portal(args.chats)
+        await bitrix.stop()
+        await telegram.stop()
+
+    first, last = [], []
+    finished = started
+    for entity_id, times in telegram.deliveries.items():
+        if entity_id not in sent_at:
+            continue
+        first.append(min(times) - sent_at[entity_id])
+        last.append(max(times) - sent_at[entity_id])
+        finished = max(finished, max(times))
+
+    delivered = len(first)
+    events = args.events
+    bitrix_calls = sum(bitrix.requests.values())
+    return {
+        "events": events,
+        "chats": args.chats,
+        "concurrency": args.concurrency,
+        "statuses": statuses,
+        "delivered_events": delivered,
+        "messages": sum(len(v) for v in telegram.deliveries.values()),
+        "send_duration": round(sent - started, 3),
+        "total_duration": round(finished - started, 3),
+        "events_per_sec": round(delivered / (finished - started), 2) if finished > started else None,
+        "accept_p50": percentile(accept_times, 50),
+        "accept_p99": percentile(accept_times, 99),
+        "first_message_p50": percentile(first, 50),
+        "first_message_p99": percentile(first, 99),
+        "all_chats_p50": percentile(last, 50),
+        "all_chats_p99": percentile(last, 99),
+        "bitrix_calls_per_event": round(bitrix_calls / events, 3),
+        "bitrix_commands_per_event": round(sum(bitrix.commands.values()) / events, 3),
+        "bitrix_requests": dict(bitrix.requests),
+        "bitrix_batch_commands": dict(bitrix.commands),
+        "bitrix_errors": dict(bitrix.errors),
+        "telegram_calls_per_event": round(sum(telegram.requests.values()) / events, 3),
+        "telegram_errors": dict(telegram.errors),
+    }
+
+
+def print_report(result: dict, baseline: Optional[dict] = None):
+    def fmt(value, latency: bool) -> str:
+        if value is None:
+            return "-"
+        return f"{value * 1000:.1f} ms" if latency else str(value)
+
+    rows = [
+        ("events/sec", "events_per_sec", False),
+        ("webhook accept p50", "accept_p50", True),
+        ("webhook accept p99", "accept_p99", True),
+        ("first message p50", "first_message_p50", True),
+        ("first message p99", "first_message_p99", True),
+        ("all chats p50", "all_chats_p50", True),
+        ("all chats p99", "all_chats_p99", True),
+        ("bitrix calls/event", "bitrix_calls_per_event", False),
+        ("bitrix commands/event", "bitrix_commands_per_event", False),
+        ("telegram calls/event", "telegram_calls_per_event", False),
+    ]
+    print(f"events: {result['events']}, delivered: {result['delivered_events']}, "
+          f"messages: {result['messages']}, webhook statuses: {result['statuses']}")
+    for title, key, latency in rows:
+        value = result.get(key)
+        line = f"{title:24} {fmt(value, latency)}"
+        if baseline and isinstance(value, (int, float)) and baseline.get(key):
+            line += f"   ({(value - baseline[key]) / baseline[key] * 100:+.1f}% vs baseline)"
+        print(line)
+    print(f"bitrix requests: {result['bitrix_requests']}")
+    if result["bitrix_batch_commands"]:
+        print(f"bitrix batch commands: {result['bitrix_batch_commands']}")
+    if result["bitrix_errors"] or result["telegram_errors"]:
+        print(f"injected errors: bitrix {result['bitrix_errors']}, telegram {result['telegram_errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--events", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20, help="одновременных вебхуков")
+    parser.add_argument("--chats", type=int, default=3, help="пользователей бота на портале")
+    parser.add_argument("--mix", type=float, nargs=3, default=[0.6, 0.2, 0.2], metavar=("TASK", "DEAL", "COMMENT"),
+                        help="доли OnTaskUpdate, OnCrmDealAdd и OnTaskCommentAdd")
+    parser.add_argument("--bitrix-latency", type=float, default=0.05)
+    parser.add_argument("--bitrix-jitter", type=float, default=0.0)
+    parser.add_argument("--bitrix-error-rate", type=float, default=0.0)
+    parser.add_argument("--bitrix-rate-limit", type=float, default=0.0,
+                        help="лимит заглушки Битрикса, запросов/с (0 — без лимита, как у портала: 2)")
+    parser.add_argument("--bitrix-burst", type=float, default=50, help="ёмкость ведра лимита заглушки")
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    parser.add_argument("--telegram-error-rate", type=float, default=0.0)
+    parser.add_argument("--api-port", type=int, default=8765)
+    parser.add_argument("--api-url", help="уже запущенный API, настроенный на заглушки с --bitrix-port и --telegram-port")
+    parser.add_argument("--bitrix-port", type=int, default=0, help="порт заглушки Битрикса (0 — любой свободный)")
+    parser.add_argument("--telegram-port", type=int, default=0, help="порт заглушки Telegram (0 — любой свободный)")
+    parser.add_argument("--drain-timeout", type=float, default=120, help="сколько ждать доставки после отправки")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="записать результат в JSON")
+    parser.add_argument("--baseline", help="сравнить с результатом, сохранённым через --save")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    result = asyncio.run(run(args))
+
+    baseline = json.loads(Path(args.baseline).read_text()) if args.baseline else None
+    print_report(result, baseline)
+    if args.save:
+        Path(args.save).write_text(json.dumps(result, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Сравнение разбора тела вебхука Битрикса: parse_form_data и parse_bracket_body.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_parse.py [число повторов]
+"""
+import sys
+import timeit
+
+from pathlib import Path
+from urllib.parse import parse_qsl, urlencode
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from events import BitrixEvent, parse_bracket_body  # noqa: E402
+
+
+def parse_form_data(form_data: dict) -> dict:
+    """Прежний разбор из utils.py (после request.form())"""
+    result = {}
+    for key, value in form_data.items():
+        parts = key.split('[')
+        current = result
+        for part in parts[:-1]:
+            part = part.rstrip(']')
+            if part not in current:
+                current[part] = {}
+            current = current[part]
+        last_part = parts[-1].rstrip(']')
+        current[last_part] = value
+    return result
+
+
+def legacy(body: str) -> dict:
+    data = parse_form_data(dict(parse_qsl(body, keep_blank_values=True)))
+    auth = data.get('auth', {})
+    fields = data.get('data', {})
+    return {
+        "event": data.get('event', '').lower(),
+        "member_id": auth.get('member_id'),
+        "entity_id": (fields.get('FIELDS_AFTER') or fields.get('FIELDS') or {}).get('ID'),
+    }
+
+
+# Типичное тело ONTASKUPDATE
+BODY = urlencode([
+    ("event", "ONTASKUPDATE"),
+    ("event_handler_id", "17"),
+    ("data[FIELDS_BEFORE][ID]", "4211"),
+    ("data[FIELDS_AFTER][ID]", "4211"),
+    ("data[IS_ACCESSIBLE_BEFORE]", "N"),
+    ("data[IS_ACCESSIBLE_AFTER]", "undefined"),
+    ("ts", "1729087345"),
+    ("auth[access_token]", "s6p6eclrzjrkf7bv0uozhfoljqpppq8e0f2ddbd8a50b10c36fb2ea6d0009d84"),
+    ("auth[expires]", "1729090945"),
+    ("auth[expires_in]", "3600"),
+    ("auth[scope]", "crm,task,user"),
+    ("auth[domain]", "example.bitrix24.ru"),
+    ("auth[server_endpoint]", "https://oauth.bitrix.info/rest/"),
+    ("auth[status]", "L"),
+    ("auth[client_endpoint]", "https://example.bitrix24.ru/rest/"),
+    ("auth[member_id]", "a223c6b3710f85df22e9377d6c4f7553"),
+    ("auth[user_id]", "1"),
+    ("auth[refresh_token]", "4s386p3q0tr8dy89xvmt96234v3dljg8e0f2ddbd8a50b10c36fb2ea6d0009d84"),
+    ("auth[application_token]", "51856fefc120afa4b628cc82d3935cce"),
+])
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    new = BitrixEvent.from_body(BODY)
+    old = legacy(BODY)
+    assert (new.name, new.member_id, new.entity_id) == (old["event"], old["member_id"], old["entity_id"])
+
+    print(f"body: {len(BODY)} bytes, {BODY.count('&') + 1} fields, {number} runs")
+    results = {}
+    for name, func in (
+        ("parse_qsl + parse_form_data", lambda: legacy(BODY)),
+        ("parse_bracket_body", lambda: parse_bracket_body(BODY)),
+        ("BitrixEvent.from_body", lambda: BitrixEvent.from_body(BODY)),
+    ):
+        best = min(timeit.repeat(func, number=number, repeat=5))
+        results[name] = best
+        print(f"{name:30} {best / number * 1e6:8.2f} us/op")
+
+    baseline = results["parse_qsl + parse_form_data"]
+    print(f"speedup: {baseline / results['BitrixEvent.from_body']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+"""Заглушки Битрикс24 REST и Telegram Bot API для нагрузочных тестов.
+
+Оба сервера отвечают с настраиваемой задержкой и долей ошибок и считают
+входящие запросы по методам. Приложение направляется на них переменными
+BITRIX_API_OVERRIDE и TELEGRAM_API_URL.
+"""
+import asyncio
+import json
+import random
+import re
+import sys
+
+from collections import Counter
+from pathlib import Path
+from time import perf_counter, time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from events import parse_bracket_body  # noqa: E402
+
+_REFERENCE = re.compile(r"\$result\[([^\]]+)\]((?:\[[^\]]*\])*)")
+_MESSAGE_ID = re.compile(r"№(\d+)")
+
+
+class FakeServer:
+    """Общая часть заглушек: задержка, ошибки, счётчики, запуск на порту"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests: Counter = Counter()
+        self.errors: Counter = Counter()
+        self._runner: Optional[web.AppRunner] = None
+
+    def routes(self) -> List[web.RouteDef]:
+        raise NotImplementedError
+
+    async def delay(self):
+        latency = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+        if latency > 0:
+            await asyncio.sleep(latency)
+
+    def should_fail(self) -> bool:
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.add_routes(self.routes())
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def reset(self):
+        self.requests.clear()
+        self.errors.clear()
+
+
+class FakeBitrix(FakeServer):
+    """REST Битрикс24: задачи, сделки, сотрудники, стадии, комментарии, batch и OAuth.
+
+    Данные генерируются по ID: задача 42 называется «Задача 42» и т. д., так что
+    в тексте уведомления остаётся номер сущности, по которому считается задержка.
+    """
+
+    def __init__(self, users: int = 50, entities: int = 200, rate_limit: float = 0.0, burst: float = 50, **kwargs):
+        super().__init__(**kwargs)
+        self.users = users
+        # Лимит портала (leaky bucket): rate_limit запросов/с, ёмкость burst; 0 — без лимита
+        self.rate_limit = rate_limit
+        self.burst = burst
+        self._bucket = 0.0
+        self._bucket_at = perf_counter()
+        self.entities = entities  # задач и сделок в списках (выгрузка в локальную копию)
+        self.commands: Counter = Counter()  # команды внутри batch по методам
+        self.methods: Dict[str, Callable[[dict], Any]] = {
+            "tasks.task.get": self.task_get,
+            "crm.deal.get": self.deal_get,
+            "user.get": self.user_get,
+            "crm.dealcategory.stage.list": self.stage_list,
+            "task.commentitem.get": self.comment_get,
+            "tasks.task.list": self.task_list,
+            "crm.deal.list": self.deal_list,
+            "profile": self.profile,
+        }
+
+    def routes(self) -> List[web.RouteDef]:
+        return [
+            web.route("*", "/oauth/token/", self.handle_oauth),
+            web.route("*", "/rest/batch", self.handle_batch),
+            web.route("*", "/rest/batch.json", self.handle_batch),
+            web.route("*", "/rest/{method}", self.handle_method),
+        ]
+
+    def reset(self):
+        super().reset()
+        self.commands.clear()
+
+    # --- Методы REST ---
+    def user(self, user_id) -> dict:
+        return {"ID": str(user_id), "NAME": "Сотрудник", "LAST_NAME": str(user_id), "ACTIVE": True}
+
+    def task_get(self, params: dict) -> dict:
+        task_id = str(params.get("taskId") or params.get("id"))
+        return {"task": {
+            "id": task_id,
+            "title": f"Задача {task_id}",
+            "description": "Нагрузочный тест",
+            "priority": "1",
+            "status": "2",
+            "responsibleId": "1",
+            "createdBy": "1",
+            "changedBy": "2",
+            "deadline": "2030-01-01T18:00:00+03:00",
+            "creator": {"id": "1", "name": "Сотрудник 1"},
+            "responsible": {"id": "1", "name": "Сотрудник 1"},
+        }}
+
+    def deal_get(self, params: dict) -> dict:
+        deal_id = str(params.get("id") or params.get("ID"))
+        return {
+            "ID": deal_id,
+            "TITLE": f"Сделка {deal_id}",
+            "COMMENTS": "ул. Тестовая, 1",
+            "STAGE_ID": "NEW",
+            "CATEGORY_ID": "0",
+            "ASSIGNED_BY_ID": "1",
+            "MODIFY_BY_ID": "2",
+        }
+
+    def list_ids(self, params: dict) -> range:
+        """ID страницы списка: после filter[>ID] и start, по 50 штук"""
+        after = int((params.get("filter") or {}).get(">ID") or 0)
+        start = max(int(params.get("start") or 0), 0)
+        first = after + start + 1
+        return range(first, min(first + 50, self.entities + 1))
+
+    @staticmethod
+    def by_change_date(params: dict) -> bool:
+        return any("CHANGED_DATE" in key or "DATE_MODIFY" in key for key in params.get("filter") or {})
+
+    def task_list(self, params: dict) -> dict:
+        # Истории изменений у заглушки нет — догоняющая синхронизация ничего не находит
+        if self.by_change_date(params):
+            return {"tasks": []}
+        return {"tasks": [self.task_get({"taskId": i})["task"] for i in self.list_ids(params)]}
+
+    def deal_list(self, params: dict) -> list:
+        if self.by_change_date(params):
+            return []
+        return [self.deal_get({"id": i}) for i in self.list_ids(params)]
+
+    def user_get(self, params: dict) -> Any:
+        if params.get("ID"):
+            return [self.user(params["ID"])]
+        start = int(params.get("start") or 0)
+        return [self.user(i) for i in range(start + 1, min(start + 50, self.users) + 1)]
+
+    def stage_list(self, params: dict) -> list:
+        return [
+            {"STATUS_ID": "NEW", "NAME": "Новая", "SORT": "10"},
+            {"STATUS_ID": "PREPARATION", "NAME": "Подготовка", "SORT": "20"},
+            {"STATUS_ID": "WON", "NAME": "Успешная", "SORT": "30"},
+        ]
+
+    def comment_get(self, params: dict) -> dict:
+        return {
+            "ID": str(params.get("itemId")),
+            "AUTHOR_ID": "2",
+            "AUTHOR_NAME": "Сотрудник 2",
+            "POST_MESSAGE": "Комментарий нагрузочного теста",
+            "POST_DATE": "2024-10-16T12:00:00+03:00",
+        }
+
+    def profile(self, params: dict) -> dict:
+        return {"ID": "1", "ADMIN": True, "NAME": "Сотрудник", "LAST_NAME": "1"}
+
+    def execute(self, method: str, params: dict) -> Tuple[Any, Optional[dict]]:
+        """(result, error) одного метода"""
+        method = method[:-5] if method.endswith(".json") else method
+        handler = self.methods.get(method)
+        if handler is None:
+            return None, {"error": "ERROR_METHOD_NOT_FOUND", "error_description": f"Method {method} not found"}
+        return handler(params), None
+
+    # --- HTTP ---
+    async def read_params(self, request: web.Request) -> dict:
+        params = dict(parse_bracket_body(request.query_string))
+        if request.body_exists:
+            body = await request.read()
+            if request.content_type == "application/json":
+                params.update(json.loads(body or b"{}"))
+            else:
+                params.update(parse_bracket_body(body))
+        return params
+
+    def over_limit(self) -> bool:
+        """Запрос не помещается в ведро портала — ответ QUERY_LIMIT_EXCEEDED"""
+        if not self.rate_limit:
+            return False
+        now = perf_counter()
+        self._bucket = max(0.0, self._bucket - (now - self._bucket_at) * self.rate_limit)
+        self._bucket_at = now
+        if self._bucket + 1 > self.burst:
+            return True
+        self._bucket += 1
+        return False
+
+    def limit_response(self) -> web.Response:
+        self.errors["QUERY_LIMIT_EXCEEDED"] += 1
+        return web.json_response(
+            {"error": "QUERY_LIMIT_EXCEEDED", "error_description": "Too many requests"},
+            status=503
+        )
+
+    def error_response(self, name: str) -> web.Response:
+        self.errors[name] += 1
+        return web.json_response(
+            {"error": "INTERNAL_SERVER_ERROR", "error_description": "Injected by benchmark"},
+            status=500
+        )
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        method = method[:-5] if method.endswith(".json") else method
+        self.requests[method] += 1
+        if self.over_limit():
+            return self.limit_response()
+        params = await self.read_params(request)
+        await self.delay()
+        if self.should_fail():
+            return self.error_response(method)
+
+        result, error = self.execute(method, params)
+        if error:
+            return web.json_response(error, status=400)
+        payload = {"result": result, "time": {"start": time()}}
+        if method == "user.get" and not params.get("ID"):
+            start = int(params.get("start") or 0)
+            payload["total"] = self.users
+            if start + 50 < self.users:
+                payload["next"] = start + 50
+        return web.json_response(payload)
+
+    async def handle_batch(self, request: web.Request) -> web.Response:
+        self.requests["batch"] += 1
+        if self.over_limit():
+            return self.limit_response()
+        params = await self.read_params(request)
+        await self.delay()
+        if self.should_fail():
+            return self.error_response("batch")
+
+        results, errors = {}, {}
+        for key, command in (params.get("cmd") or {}).items():
+            method, _, query = command.partition("?")
+            self.commands[method] += 1
+            query = _REFERENCE.sub(lambda m: str(self.resolve(results, m)), query)
+            result, error = self.execute(method, parse_bracket_body(query))
+            if error:
+                errors[key] = error
+            else:
+                results[key] = result
+        return web.json_response({"result": {
+            "result": results or [],
+            "result_error": errors or [],
+            "result_total": [],
+            "result_next": [],
+            "result_time": [],
+        }, "time": {"start": time()}})
+
+    @staticmethod
+    def resolve(results: dict, match: re.Match) -> Any:
+        """Значение ссылки $result[key][field]... на результат предыдущей команды"""
+        value = results.get(match.group(1))
+        for part in re.findall(r"\[([^\]]*)\]", match.group(2)):
+            if isinstance(value, list):
+                value = value[int(part)] if part.isdigit() and int(part) < len(value) else None
+            elif isinstance(value, dict):
+                value = value.get(part)
+            else:
+                value = None
+        return "" if value is None else value
+
+    async def handle_oauth(self, request: web.Request) -> web.Response:
+        self.requests["oauth.token"] += 1
+        await self.delay()
+        return web.json_response({
+            "access_token": f"bench-access-{random.getrandbits(64):x}",
+            "refresh_token": f"bench-refresh-{random.getrandbits(64):x}",
+            "expires_in": 3600,
+            "domain": "oauth.bitrix.info",
+            "member_id": request.query.get("member_id", ""),
+        })
+
+
+class FakeTelegram(FakeServer):
+    """Bot API: принимает sendMessage и записывает время доставки по номеру сущности из текста.
+
+    Ошибки отдаются как 429 с retry_after — так Telegram ограничивает частоту.
+    """
+
+    def __init__(self, retry_after: int = 1, **kwargs):
+        super().__init__(**kwargs)
+        self.retry_after = retry_after
+        self.message_id = 0
+        # номер сущности → список моментов доставки (perf_counter)
+        self.deliveries: Dict[str, List[float]] = {}
+
+    def routes(self) -> List[web.RouteDef]:
+        return [web.route("*", "/bot{token}/{method}", self.handle_method)]
+
+    def reset(self):
+        super().reset()
+        self.deliveries.clear()
+
+    async def read_params(self, request: web.Request) -> dict:
+        if request.content_type == "application/json":
+            return await request.json()
+        if request.content_type.startswith("multipart/"):
+            params = {}
+            reader = await request.multipart()
+            async for part in reader:
+                params[part.name] = (await part.read()).decode()
+            return params
+        return dict(parse_qsl((await request.read()).decode()))
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.requests[method] += 1
+        params = await self.read_params(request)
+        await self.delay()
+        if self.should_fail():
+            self.errors[method] += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {
+                "id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"
+            }})
+        if method != "sendMessage":
+            return web.json_response({"ok": True, "result": True})
+
+        text = params.get("text", "")
+        match = _MESSAGE_ID.search(text)
+        if match:
+            self.deliveries.setdefault(match.group(1), []).append(perf_counter())
+
+        self.message_id += 1
+        chat_id = int(params.get("chat_id", 0))
+        return web.json_response({"ok": True, "result": {
+            "message_id": self.message_id,
+            "date": int(time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": text,
+        }})
@@ -0,0 +1,52 @@
+"""Функции db.py поверх подменённого соединения (без PostgreSQL)"""
+import asyncio
+import sys
+
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+import db  # noqa: E402
+
+
+class FakeConnection:
+    def __init__(self, fetchval=None):
+        self.result = fetchval
+        self.queries = []
+
+    async def fetchval(self, query, *args):
+        self.queries.append((query, args))
+        return self.result
+
+    async def execute(self, query, *args):
+        self.queries.append((query, args))
+
+
+@pytest.fixture
+def conn(monkeypatch):
+    conn = FakeConnection()
+
+    @asynccontextmanager
+    async def acquire():
+        yield conn
+
+    monkeypatch.setattr(db.Database, "acquire", acquire)
+    monkeypatch.setattr(db, "_registered_domains", set())
+    return conn
+
+
+def test_events_registered_from_db(conn):
+    conn.result = True
+    assert asyncio.run(db.is_events_registered("a.bitrix24.ru")) is True
+    # Ответ запомнен в процессе — второй раз без запроса
+    assert asyncio.run(db.is_events_registered("a.bitrix24.ru")) is True
+    assert len(conn.queries) == 1
+
+
+@pytest.mark.parametrize("value", [None, False])
+def test_events_not_registered(conn, value):
+    conn.result = value
+    assert asyncio.run(db.is_events_registered("b.bitrix24.ru")) is False
@@ -0,0 +1,151 @@
+"""parse_bracket_body даёт тот же результат, что прежний parse_qsl + parse_form_data"""
+import sys
+
+from pathlib import Path
+from urllib.parse import parse_qsl, urlencode
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from events import BitrixEvent, parse_bracket_body  # noqa: E402
+
+
+def parse_form_data(form_data: dict) -> dict:
+    """Прежний разбор из utils.py (после request.form())"""
+    result = {}
+    for key, value in form_data.items():
+        parts = key.split('[')
+        current = result
+        for part in parts[:-1]:
+            part = part.rstrip(']')
+            if part not in current:
+                current[part] = {}
+            current = current[part]
+        last_part = parts[-1].rstrip(']')
+        current[last_part] = value
+    return result
+
+
+def legacy(body: str) -> dict:
+    return parse_form_data(dict(parse_qsl(body, keep_blank_values=True)))
+
+
+def php_arrays(value):
+    """Словари с ключами 0..n-1 из прежнего разбора — списками, как их отдаёт новый"""
+    if not isinstance(value, dict):
+        return value
+    value = {key: php_arrays(item) for key, item in value.items()}
+    if value and all(key.isdigit() for key in value) and sorted(map(int, value)) == list(range(len(value))):
+        return [value[str(i)] for i in range(len(value))]
+    return value
+
+
+AUTH = [
+    ("auth[access_token]", "s6p6eclrzjrkf7bv0uozhfoljqpppq8e0f2ddbd8a50b10c36fb2ea6d0009d84"),
+    ("auth[expires]", "1729090945"),
+    ("auth[expires_in]", "3600"),
+    ("auth[scope]", "crm,task,user"),
+    ("auth[domain]", "example.bitrix24.ru"),
+    ("auth[server_endpoint]", "https://oauth.bitrix.info/rest/"),
+    ("auth[status]", "L"),
+    ("auth[client_endpoint]", "https://example.bitrix24.ru/rest/"),
+    ("auth[member_id]", "a223c6b3710f85df22e9377d6c4f7553"),
+    ("auth[user_id]", "1"),
+    ("auth[refresh_token]", ""),
+    ("auth[application_token]", "51856fefc120afa4b628cc82d3935cce"),
+]
+
+TASK_UPDATE = urlencode([
+    ("event", "ONTASKUPDATE"),
+    ("event_handler_id", "17"),
+    ("data[FIELDS_BEFORE][ID]", "4211"),
+    ("data[FIELDS_AFTER][ID]", "4211"),
+    ("data[IS_ACCESSIBLE_BEFORE]", "N"),
+    ("data[IS_ACCESSIBLE_AFTER]", "undefined"),
+    ("ts", "1729087345"),
+    *AUTH,
+])
+
+TASK_DELETE = urlencode([
+    ("event", "ONTASKDELETE"),
+    ("event_handler_id", "19"),
+    ("data[FIELDS_BEFORE][ID]", "4212"),
+    ("data[FIELDS_AFTER]", ""),
+    ("ts", "1729087346"),
+    *AUTH,
+])
+
+DEAL_ADD = urlencode([
+    ("event", "ONCRMDEALADD"),
+    ("event_handler_id", "23"),
+    ("data[FIELDS][ID]", "815"),
+    ("ts", "1729087400"),
+    *AUTH,
+])
+
+COMMENT_ADD = urlencode([
+    ("event", "ONTASKCOMMENTADD"),
+    ("event_handler_id", "29"),
+    ("data[FIELDS_AFTER][ID]", "30311"),
+    ("data[FIELDS_AFTER][MESSAGE_ID]", "30311"),
+    ("data[FIELDS_AFTER][TASK_ID]", "4211"),
+    ("data[FIELDS_AFTER][POST_MESSAGE]", "Готово, проверьте + отпишитесь & закройте"),
+    ("ts", "1729087500"),
+    *AUTH,
+])
+
+# Массивы PHP: data[FIELDS_AFTER][ACCOMPLICES][0]=...
+TASK_ADD_WITH_LISTS = urlencode([
+    ("event", "ONTASKADD"),
+    ("data[FIELDS_AFTER][ID]", "4213"),
+    ("data[FIELDS_AFTER][ACCOMPLICES][0]", "7"),
+    ("data[FIELDS_AFTER][ACCOMPLICES][1]", "12"),
+    ("data[FIELDS_AFTER][ACCOMPLICES][2]", "31"),
+    ("data[FIELDS_AFTER][AUDITORS][0]", ""),
+    ("data[FIELDS_AFTER][TAGS][5]", "срочно"),
+    ("data[FIELDS_AFTER][TITLE]", ""),
+    *AUTH,
+])
+
+
+@pytest.mark.parametrize("body", [TASK_UPDATE, TASK_DELETE, DEAL_ADD, COMMENT_ADD])
+def test_same_as_legacy(body):
+    assert parse_bracket_body(body) == legacy(body)
+
+
+def test_bytes_body():
+    assert parse_bracket_body(COMMENT_ADD.encode()) == legacy(COMMENT_ADD)
+
+
+def test_numeric_keys_become_lists():
+    parsed = parse_bracket_body(TASK_ADD_WITH_LISTS)
+    assert parsed == php_arrays(legacy(TASK_ADD_WITH_LISTS))
+    fields = parsed["data"]["FIELDS_AFTER"]
+    assert fields["ACCOMPLICES"] == ["7", "12", "31"]
+    assert fields["AUDITORS"] == [""]
+    # Индексы не с нуля — остаётся словарём
+    assert fields["TAGS"] == {"5": "срочно"}
+
+
+def test_empty_values():
+    body = "a=&b&auth[refresh_token]=&data[FIELDS_AFTER]="
+    assert parse_bracket_body(body) == legacy(body) == {
+        "a": "", "b": "", "auth": {"refresh_token": ""}, "data": {"FIELDS_AFTER": ""}
+    }
+
+
+def test_append_brackets():
+    assert parse_bracket_body("list[]=x&list[]=y") == {"list": ["x", "y"]}
+
+
+@pytest.mark.parametrize("body", [TASK_UPDATE, TASK_DELETE, DEAL_ADD, COMMENT_ADD, TASK_ADD_WITH_LISTS])
+def test_event_fields(body):
+    data = legacy(body)
+    event = BitrixEvent.from_body(body)
+    fields = data.get("data", {})
+    entity = fields.get("FIELDS_AFTER") or fields.get("FIELDS") or {}
+    assert event.name == data["event"].lower()
+    assert event.member_id == data["auth"]["member_id"]
+    assert event.domain == data["auth"]["domain"]
+    assert event.entity_id == (entity.get("ID") if isinstance(entity, dict) else None)
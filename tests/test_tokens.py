@@ -0,0 +1,118 @@
+"""Обновление токена: запрос к OAuth без соединения из пула (без PostgreSQL)"""
+import asyncio
+import sys
+
+from contextlib import asynccontextmanager
+from pathlib import Path
+from time import time
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+import tokens  # noqa: E402
+
+
+class FakeDatabase:
+    """users и token_refresh в памяти; считает занятые соединения"""
+
+    def __init__(self):
+        self.user = {"chat_id": 1, "access_token": "old", "refresh_token": "r1", "expires": int(time()) - 1}
+        self.lease = False
+        self.in_use = 0
+
+    @asynccontextmanager
+    async def acquire(self):
+        self.in_use += 1
+        try:
+            yield self
+        finally:
+            self.in_use -= 1
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def fetchval(self, query, *args):
+        if "INSERT INTO token_refresh" in query:
+            if self.lease:
+                return None
+            self.lease = True
+            return True
+        if "SELECT refresh_token" in query:
+            return self.user is not None and self.user["refresh_token"] == args[1]
+
+    async def fetchrow(self, query, *args):
+        return dict(self.user) if self.user else None
+
+    async def execute(self, query, *args):
+        if "DELETE FROM token_refresh" in query:
+            self.lease = False
+        elif "UPDATE users" in query:
+            self.user.update(access_token=args[1], refresh_token=args[2], expires=args[3])
+
+
+@pytest.fixture
+def database(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(tokens.Database, "acquire", database.acquire)
+
+    async def publish(conn, chat_id):
+        pass
+
+    monkeypatch.setattr(tokens.RecipientCache, "publish", publish)
+    monkeypatch.setattr(tokens.RecipientCache, "update", lambda chat_id, **kwargs: None)
+    monkeypatch.setattr(tokens, "_REFRESH_POLL", 0.01)
+    return database
+
+
+def test_no_connection_during_oauth_request(database, monkeypatch):
+    calls = []
+
+    async def request_token(refresh_token):
+        calls.append(database.in_use)
+        await asyncio.sleep(0.05)
+        return {"access_token": "new", "refresh_token": "r2", "expires_in": 3600}
+
+    monkeypatch.setattr(tokens.TokenManager, "_request_token", staticmethod(request_token))
+
+    async def run():
+        return await asyncio.gather(*(tokens.TokenManager.refresh(1) for _ in range(3)))
+
+    results = asyncio.run(run())
+    assert calls == [0]
+    assert all(user["access_token"] == "new" for user in results)
+    assert database.user["refresh_token"] == "r2"
+    assert database.lease is False
+
+
+def test_other_process_holds_lease(database, monkeypatch):
+    database.lease = True
+
+    async def request_token(refresh_token):
+        raise AssertionError("токен обновляет другой процесс")
+
+    monkeypatch.setattr(tokens.TokenManager, "_request_token", staticmethod(request_token))
+    # Планировщик не ждёт
+    assert asyncio.run(tokens.TokenManager.refresh(1, wait=False)) is None
+
+    async def other_process():
+        await asyncio.sleep(0.03)
+        database.user.update(access_token="new", expires=int(time()) + 3600)
+        database.lease = False
+
+    async def run():
+        result, _ = await asyncio.gather(tokens.TokenManager.refresh(1), other_process())
+        return result
+
+    assert asyncio.run(run())["access_token"] == "new"
+
+
+def test_failed_refresh_releases_lease(database, monkeypatch):
+    async def request_token(refresh_token):
+        raise RuntimeError("oauth unavailable")
+
+    monkeypatch.setattr(tokens.TokenManager, "_request_token", staticmethod(request_token))
+    assert asyncio.run(tokens.TokenManager.refresh(1)) is None
+    assert database.lease is False
+    assert database.user["access_token"] == "old"
@@ -0,0 +1,68 @@
+"""Прогрев кэша имён сотрудников (без Битрикса)"""
+import asyncio
+import sys
+
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+import utils  # noqa: E402
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+@pytest.fixture
+def bitrix(monkeypatch):
+    calls = []
+
+    async def get(url, params=None, **kwargs):
+        calls.append(params.get("start"))
+        if get.fail:
+            raise RuntimeError("portal unavailable")
+        start = params.get("start") or 0
+        users = [{"ID": str(start + i), "NAME": f"User {start + i}"} for i in range(50 if start == 0 else 10)]
+        return FakeResponse({"result": users, "next": 50 if start == 0 else None})
+
+    monkeypatch.setattr(utils.BitrixClient, "get", get)
+    monkeypatch.setattr(utils, "_names_warmed_at", {})
+    utils.user_name_cache.clear()
+    get.calls = calls
+    get.fail = False
+    return get
+
+
+def test_warm_once_per_process(bitrix):
+    asyncio.run(utils.warm_user_names("a.bitrix24.ru", "token"))
+    assert bitrix.calls == [0, 50]
+    assert utils.user_name_cache.get(("a.bitrix24.ru", "55")) == "User 55"
+
+    # Второй вход сотрудника того же портала — без повторной выгрузки
+    asyncio.run(utils.warm_user_names("a.bitrix24.ru", "token"))
+    assert bitrix.calls == [0, 50]
+
+
+def test_warm_again_in_new_process(bitrix, monkeypatch):
+    asyncio.run(utils.warm_user_names("a.bitrix24.ru", "token"))
+    # Новый процесс: ни кэша, ни отметки
+    monkeypatch.setattr(utils, "_names_warmed_at", {})
+    utils.user_name_cache.clear()
+    asyncio.run(utils.warm_user_names("a.bitrix24.ru", "token"))
+    assert bitrix.calls == [0, 50, 0, 50]
+
+
+def test_failed_warm_up_is_retried(bitrix):
+    bitrix.fail = True
+    asyncio.run(utils.warm_user_names("a.bitrix24.ru", "token"))
+    assert "a.bitrix24.ru" not in utils._names_warmed_at
+
+    bitrix.fail = False
+    asyncio.run(utils.warm_user_names("a.bitrix24.ru", "token"))
+    assert bitrix.calls == [0, 0, 50]